@@ -1,3 +1,24 @@
 # -*- coding: utf-8 -*-
-from naruto.layer import NarutoLayer
-from naruto.layer import LayerNotFound
+"""
+Wrapper around aufs to make a snapshotting filesystem
+
+NarutoLayer and LayerNotFound are loaded on first use so that entry points like naruto.client
+start quickly.
+"""
+_LAZY_ATTRIBUTES = {
+    'NarutoLayer': 'naruto.layer',
+    'LayerNotFound': 'naruto.layer',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    import importlib
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
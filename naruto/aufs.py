@@ -3,24 +3,45 @@
 aufs code
 """
 import collections
+import contextlib
 import logging
+import os
 import pathlib
 import re
+import threading
+import time
+
+import naruto.mount
 from naruto.mount import mount, umount
 
 DEV_LOGGER = logging.getLogger(__name__)
 AUFS_SYS_FOLDER = pathlib.Path('/sys/fs/aufs/')
 BR_REGEX = re.compile(r'^br(?P<id>\d+)$')
 
+# Whiteouts hide names in lower branches. Names starting with WHITEOUT_META_PREFIX are aufs
+# internals, apart from the opaque marker which hides everything below in that directory.
+WHITEOUT_PREFIX = '.wh.'
+WHITEOUT_META_PREFIX = '.wh..wh.'
+OPAQUE_MARKER = '.wh..wh..opq'
+
+# rr tells aufs a branch never changes so it skips checking it for changes
+RO_PERMISSIONS = ('ro', 'rr')
+BRANCH_PERMISSIONS = ('rw',) + RO_PERMISSIONS
+
+# The kernel copies at most a page of mount data, including the trailing NUL
+MOUNT_DATA_LIMIT = os.sysconf('SC_PAGE_SIZE') - 1
+
 
 AUFSBranch = collections.namedtuple('AUFSBranch', 'path permission index brid si_code')
 
 
-def get_aufs_branch_info_iter(si_code):
+def get_aufs_branch_info_iter(si_code, aufs_sys_folder=None):
     '''
     Look up metadata around aufs
     '''
-    metadata_folder = AUFS_SYS_FOLDER / ('si_' + si_code)
+    if aufs_sys_folder is None:
+        aufs_sys_folder = AUFS_SYS_FOLDER
+    metadata_folder = pathlib.Path(aufs_sys_folder) / ('si_' + si_code)
     if not metadata_folder.is_dir():
         raise KeyError('Unable to find metadata for {}'.format(si_code))
 
@@ -47,6 +68,7 @@ class AUFSMount(object):
     '''
     def __init__(self, mount_entry, aufs_branches=None):
         self._mount_entry = mount_entry
+        self._pending_directives = None
         self.update(aufs_branches)
 
     @property
@@ -57,8 +79,48 @@ class AUFSMount(object):
     def file(self):
         return pathlib.Path(self._mount_entry.file)
 
-    def _run_mount(self, *args, **kwargs):
-        mount('none', str(self.file.resolve()), *args, types='aufs', **kwargs)
+    def _run_mount(self, options):
+        try:
+            mount(
+                'none',
+                str(self.file.resolve()),
+                types='aufs',
+                options=options,
+                mntops=self._mount_entry.mntops)
+        finally:
+            refresh_mount_table()
+
+    def _remount(self, directive):
+        '''
+        Apply a single remount directive, or queue it if in a transaction
+        '''
+        if self._pending_directives is not None:
+            DEV_LOGGER.debug('Queueing %r on %r', directive, self)
+            self._pending_directives.append(directive)
+        else:
+            self._run_mount(options='remount,{}'.format(directive))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Queue branch changes and apply them all with a single remount on exit.
+
+        Nothing is applied if the block raises. Nested transactions join the outer one.
+        '''
+        if self._pending_directives is not None:
+            yield self
+            return
+
+        self._pending_directives = []
+        try:
+            yield self
+            directives = self._pending_directives
+        finally:
+            self._pending_directives = None
+
+        if directives:
+            DEV_LOGGER.debug('Applying %d queued changes to %r', len(directives), self)
+            self._run_mount(options='remount,{}'.format(','.join(directives)))
 
     def update(self, aufs_branches=None):
         '''
@@ -78,6 +140,13 @@ class AUFSMount(object):
 
         self._branches.sort(key=lambda branch: branch.index)
 
+    @property
+    def branches(self):
+        '''
+        Branches ordered by index
+        '''
+        return tuple(self._branches)
+
     def get_branch_by_path(self, path):
         for branch in self._branches:
             if branch.path == path:
@@ -87,7 +156,10 @@ class AUFSMount(object):
 
     def unmount(self):
         DEV_LOGGER.debug('Unmounting %r', self)
-        umount(str(self.file.resolve()))
+        try:
+            umount(str(self.file.resolve()))
+        finally:
+            refresh_mount_table()
 
     def get_leaf(self):
         '''
@@ -95,6 +167,16 @@ class AUFSMount(object):
         '''
         return self._branches[0]
 
+    @property
+    def ro_permission(self):
+        '''
+        Permission read only branches of this mount use, so branches made read only match
+        '''
+        for branch in self._branches:
+            if branch.permission in RO_PERMISSIONS:
+                return branch.permission
+        return 'ro'
+
 
 class AUFSMountBranch(object):
     '''
@@ -104,7 +186,7 @@ class AUFSMountBranch(object):
         self._mount = mount
         self._path = pathlib.Path(path)
         self._permission = permission
-        assert permission in ('rw', 'ro')
+        assert permission in BRANCH_PERMISSIONS
         self._index = int(index)
         self._brid = int(brid)
 
@@ -128,27 +210,177 @@ class AUFSMountBranch(object):
     def permission(self):
         return self._permission
 
+    @property
+    def read_only(self):
+        return self._permission in RO_PERMISSIONS
+
     @permission.setter
     def permission(self, permission):
-        assert permission in ('rw', 'ro')
-        self._mount._run_mount(
-            options='remount,mod:{self._path!s}={permission}'.format(
-                self=self, permission=permission))
+        assert permission in BRANCH_PERMISSIONS
+        self._mount._remount(
+            'mod:{self._path!s}={permission}'.format(self=self, permission=permission))
 
     def delete(self):
         '''
         Delete this branch
         '''
-        self._mount._run_mount(
-            options='remount,del:{self._path!s}'.format(self=self))
+        self._mount._remount('del:{self._path!s}'.format(self=self))
 
     def insert_after(self, branch_path, permission='rw'):
         '''
         Insert new branch after this one
         '''
-        self._mount._run_mount(
-            options='remount,add:{index}:{branch_path!s}={permission}'.format(
+        self._mount._remount(
+            'add:{index}:{branch_path!s}={permission}'.format(
                 index=self._index, branch_path=branch_path, permission=permission))
 
     def __str__(self):
         return '{self._path} on {self._mount.file}'.format(self=self)
+
+
+class MountTableSnapshot(object):
+    '''
+    Mount table and aufs branch info read once.
+
+    Keeps a reverse index of branch path to the aufs branches using it.
+    '''
+    def __init__(self, mountinfo_contents=None, aufs_sys_folder=None):
+        self._mounts = tuple(naruto.mount.get_mountinfo_iter(mountinfo_contents))
+        self._aufs_mounts = {}
+        self._branches_by_path = collections.defaultdict(list)
+
+        for mount_entry in self._mounts:
+            if mount_entry.vfstype != 'aufs':
+                continue
+
+            try:
+                aufs_mount = AUFSMount(
+                    mount_entry,
+                    tuple(get_aufs_branch_info_iter(mount_entry.mntops['si'], aufs_sys_folder)))
+            except KeyError as error:
+                # Mount may have gone away since we read the mount table
+                DEV_LOGGER.debug('Skipping aufs mount %r: %s', mount_entry, error)
+                continue
+
+            self._aufs_mounts[aufs_mount.file] = aufs_mount
+            for branch in aufs_mount.branches:
+                self._branches_by_path[branch.path].append(branch)
+
+        DEV_LOGGER.debug(
+            'Read %d mounts of which %d are aufs', len(self._mounts), len(self._aufs_mounts))
+
+    @property
+    def mounts(self):
+        '''
+        All mounts as MountEntry
+        '''
+        return self._mounts
+
+    @property
+    def aufs_mounts(self):
+        '''
+        All aufs mounts as AUFSMount
+        '''
+        return tuple(self._aufs_mounts.values())
+
+    def get_aufs_mount(self, mount_point):
+        '''
+        Get AUFSMount by mount point
+        '''
+        return self._aufs_mounts[pathlib.Path(mount_point)]
+
+    def find_branches(self, path):
+        '''
+        Get all aufs branches, on any mount, that use path
+        '''
+        return tuple(self._branches_by_path.get(pathlib.Path(path), ()))
+
+
+def split_branch_options(branches, limit=MOUNT_DATA_LIMIT):
+    '''
+    Split branches, 'path=permission' strings from top to bottom, into mount options whose data
+    each fit in limit bytes. The first mounts the top branches and the rest append the others
+    below them, packing as many branches into each as fit.
+
+    >>> split_branch_options(['/a=rw', '/b=ro', '/c=ro'])
+    ['br:/a=rw:/b=ro:/c=ro']
+    >>> split_branch_options(['/a=rw', '/b=ro', '/c=ro', '/d=ro'], limit=14)
+    ['br:/a=rw:/b=ro', 'remount,append:/c=ro', 'remount,append:/d=ro']
+    >>> split_branch_options(['/a=rw', '/b=ro', '/c=ro', '/d=ro', '/e=ro', '/f=ro'], limit=25)
+    ['br:/a=rw:/b=ro:/c=ro', 'remount,append:/d=ro,append:/e=ro', 'remount,append:/f=ro']
+    '''
+    options = []
+    data = None
+    for branch in branches:
+        if data is None:
+            data = 'br:{}'.format(branch)
+        elif not options and len(data) + len(branch) + 1 <= limit:
+            data = '{}:{}'.format(data, branch)
+        else:
+            directive = 'append:{}'.format(branch)
+            if options and len(data) + len(directive) + 1 <= limit:
+                data = '{},{}'.format(data, directive)
+            else:
+                options.append(data)
+                data = directive
+        if len(data) > limit:
+            raise ValueError('Branch {} is too long to mount'.format(branch))
+
+    if data is not None:
+        options.append(data)
+    return [options[0]] + ['remount,{}'.format(data) for data in options[1:]]
+
+
+def mount_branches(mount_point, branches, options=(), limit=MOUNT_DATA_LIMIT):
+    '''
+    Mount aufs on mount_point with branches, 'path=permission' strings from top to bottom, and
+    other aufs options.
+
+    Branch lists too long for one mount call are mounted in part and the rest appended with as
+    few remounts as possible. If any remount fails the mount is removed again.
+    '''
+    extra = ''.join(',{}'.format(option) for option in options)
+    options = split_branch_options(branches, limit=limit - len(extra))
+    options[0] += extra
+    start = time.monotonic()
+    try:
+        mount('none', mount_point, types='aufs', options=options[0])
+        # The mount table isn't reread between calls so the remounts keep the flags from here
+        mntops = dict.fromkeys(options[0].split(','))
+        try:
+            for remount_options in options[1:]:
+                mount('none', mount_point, types='aufs', options=remount_options, mntops=mntops)
+        except Exception:
+            # Don't leave a mount with only some of the ancestors
+            DEV_LOGGER.warning('Appending branches to %s failed. Unmounting.', mount_point)
+            umount(mount_point)
+            raise
+    finally:
+        refresh_mount_table()
+    DEV_LOGGER.debug(
+        'Mounted %d branches on %s with %d mount calls in %.3fs',
+        len(branches), mount_point, len(options), time.monotonic() - start)
+
+
+_MOUNT_TABLE = None
+_MOUNT_TABLE_LOCK = threading.Lock()
+
+
+def get_mount_table():
+    '''
+    Get shared MountTableSnapshot, reading it if it's not been read since the last refresh
+    '''
+    global _MOUNT_TABLE
+    with _MOUNT_TABLE_LOCK:
+        if _MOUNT_TABLE is None:
+            _MOUNT_TABLE = MountTableSnapshot()
+        return _MOUNT_TABLE
+
+
+def refresh_mount_table():
+    '''
+    Mark shared MountTableSnapshot out of date. Call after anything that changes mounts.
+    '''
+    global _MOUNT_TABLE
+    with _MOUNT_TABLE_LOCK:
+        _MOUNT_TABLE = None
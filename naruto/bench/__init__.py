@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for layer operations.
+
+These run against naruto.bench.simulate.SimulatedAUFS so need neither aufs nor root. Results are
+written as JSON so they can be compared between runs.
+"""
+import json
+import logging
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import click.testing
+
+import naruto.aufs
+from naruto.bench.simulate import simulated_aufs
+from naruto.layer import CHILDREN_SUBDIR, NarutoLayer
+
+DEV_LOGGER = logging.getLogger(__name__)
+RESULTS_VERSION = 1
+BENCH_TREE_NAME = 'bench'
+
+
+def generate_tree(parent_directory, width, depth, tag_every=10):
+    '''
+    Create a synthetic layer tree.
+
+    Every layer gets width children down to depth generations below the root. Every
+    tag_every-th layer is tagged bench-<n>. Returns the root and all layers, root first then
+    each generation in turn.
+    '''
+    root = NarutoLayer.create(parent_directory)
+    layers = [root]
+    generation = [root]
+    for _ in range(depth):
+        next_generation = []
+        for layer in generation:
+            for _ in range(width):
+                next_generation.append(
+                    NarutoLayer.create(layer.path / CHILDREN_SUBDIR, is_root=False))
+        layers.extend(next_generation)
+        generation = next_generation
+
+    for index, layer in enumerate(layers):
+        if index % tag_every == 0:
+            layer.tags = ('bench-{}'.format(index),)
+
+    return root, layers
+
+
+def time_operation(operation, repeat, setup=None):
+    '''
+    Time operation repeat times. setup is called before each run and not timed, and its
+    return value is passed to operation.
+    '''
+    timings = []
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        start = time.perf_counter()
+        if setup is not None:
+            operation(argument)
+        else:
+            operation()
+        timings.append(time.perf_counter() - start)
+
+    return {
+        'runs': repeat,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.mean(timings),
+        'max': max(timings),
+    }
+
+
+class LayerBenchmarks(object):
+    '''
+    Set of benchmarks run against one synthetic tree
+    '''
+    def __init__(self, work_dir, width, depth, mounts):
+        self._work_dir = pathlib.Path(work_dir)
+        self._width = width
+        self._depth = depth
+        self._mounts = mounts
+        self._mount_count = 0
+
+        self._naruto_home = self._work_dir / 'home'
+        tree_dir = self._naruto_home / BENCH_TREE_NAME
+        tree_dir.mkdir(parents=True)
+
+        DEV_LOGGER.info('Generating tree width=%d depth=%d', width, depth)
+        self.root, self.layers = generate_tree(tree_dir, width, depth)
+        self.deepest_tagged = [layer for layer in self.layers if layer.tags][-1]
+
+    def _new_mount_point(self):
+        self._mount_count += 1
+        mount_point = self._work_dir / 'mounts' / str(self._mount_count)
+        mount_point.mkdir(parents=True)
+        return mount_point
+
+    def _mounted_leaf(self):
+        '''
+        New leaf of the deepest layer mounted at many places
+        '''
+        leaf = NarutoLayer.create(self.layers[-1].path / CHILDREN_SUBDIR, is_root=False)
+        for _ in range(self._mounts):
+            leaf.mount(self._new_mount_point())
+        return leaf
+
+    def bench_find_layer(self, repeat):
+        tag, = self.deepest_tagged.tags
+        return time_operation(lambda: self.root.find_layer(tag), repeat)
+
+    def bench_info(self, repeat):
+        runner = click.testing.CliRunner()
+        # Import here as cli is what's being measured
+        from naruto.cli import naruto_cli
+        args = [
+            '--naruto-home', str(self._naruto_home),
+            'info', '--layer', '{}:{}'.format(BENCH_TREE_NAME, self.layers[-1].layer_id)]
+
+        def info():
+            result = runner.invoke(naruto_cli, args)
+            if result.exit_code != 0:
+                raise Exception('info failed: {}'.format(result.output))
+
+        return time_operation(info, repeat)
+
+    def bench_cli_startup(self, repeat):
+        '''
+        Run naruto tags in a fresh interpreter, which is mostly imports
+        '''
+        env = dict(os.environ)
+        env['NARUTO_NO_DAEMON'] = '1'
+        env['PYTHONPATH'] = os.pathsep.join(
+            [str(pathlib.Path(naruto.__file__).parent.parent)] +
+            [path for path in (env.get('PYTHONPATH'),) if path])
+        args = [
+            sys.executable, '-m', 'naruto.client',
+            '--naruto-home', str(self._naruto_home),
+            'tags', '--layer', BENCH_TREE_NAME]
+
+        def tags():
+            subprocess.run(args, env=env, check=True, stdout=subprocess.DEVNULL)
+
+        return time_operation(tags, repeat)
+
+    def bench_find_mounted_branches(self, repeat):
+        self._mounted_leaf()
+
+        def find_mounted_branches():
+            naruto.aufs.refresh_mount_table()
+            return tuple(self.root.find_mounted_branches_iter())
+
+        return time_operation(find_mounted_branches, repeat)
+
+    def bench_freeze_mounts(self, repeat):
+        return time_operation(
+            lambda leaf: leaf.freeze_mounts().raise_for_failures(),
+            repeat,
+            setup=self._mounted_leaf)
+
+    def bench_delete(self, repeat):
+        def setup():
+            subtree_root = NarutoLayer.create(self.root.path / CHILDREN_SUBDIR, is_root=False)
+            generation = [subtree_root]
+            for _ in range(self._depth):
+                generation = [
+                    NarutoLayer.create(layer.path / CHILDREN_SUBDIR, is_root=False)
+                    for layer in generation for _ in range(self._width)]
+            return subtree_root
+
+        return time_operation(lambda layer: layer.delete(), repeat, setup=setup)
+
+    def run(self, repeat):
+        '''
+        Run all benchmarks
+        '''
+        results = {}
+        for name in sorted(dir(self)):
+            if not name.startswith('bench_'):
+                continue
+            DEV_LOGGER.info('Running %s', name)
+            results[name[len('bench_'):]] = getattr(self, name)(repeat)
+        return results
+
+
+def run_benchmarks(width=3, depth=5, mounts=20, repeat=5):
+    '''
+    Run all benchmarks and return results as a dict
+    '''
+    with tempfile.TemporaryDirectory() as work_dir:
+        with simulated_aufs():
+            benchmarks = LayerBenchmarks(work_dir, width, depth, mounts)
+            results = benchmarks.run(repeat)
+            layer_count = len(benchmarks.layers)
+
+    return {
+        'version': RESULTS_VERSION,
+        'python': sys.version,
+        'platform': platform.platform(),
+        'parameters': {
+            'width': width,
+            'depth': depth,
+            'layers': layer_count,
+            'mounts': mounts,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+@click.command()
+@click.option('--width', default=3, type=click.IntRange(min=1), help='Children per layer')
+@click.option('--depth', default=5, type=click.IntRange(min=1), help='Generations below root')
+@click.option('--mounts', default=20, type=click.IntRange(min=1), help='Mounts per layer')
+@click.option('--repeat', default=5, type=click.IntRange(min=1), help='Runs per benchmark')
+@click.option(
+    '--output', type=click.File('w'), default='-', help='Where to write JSON results')
+@click.option(
+    '--verbosity',
+    '-V',
+    help='Set verbosity level explicitly (int or CRITICAL, ERROR, WARNING, INFO, DEBUG, NOTSET)',
+    default=logging.WARNING,
+    type=str)
+def bench_cli(width, depth, mounts, repeat, output, verbosity):
+    '''
+    Benchmark layer operations against simulated aufs
+    '''
+    try:
+        verbosity = int(verbosity)
+    except ValueError:
+        #Ints and strings are ok
+        pass
+    logging.basicConfig(level=verbosity)
+
+    results = run_benchmarks(width=width, depth=depth, mounts=mounts, repeat=repeat)
+    json.dump(results, output, indent=2, sort_keys=True)
+    output.write('\n')
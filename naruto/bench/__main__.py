@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+"""
+Allow running benchmarks with python -m naruto.bench
+"""
+from naruto.bench import bench_cli
+
+bench_cli()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated aufs so layer operations can be run without aufs or root
+"""
+import contextlib
+import logging
+import pathlib
+import shutil
+import tempfile
+import threading
+
+import naruto.aufs
+import naruto.mount
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+
+class SimulatedAUFS(naruto.mount.MountBackend):
+    '''
+    Mount backend that keeps a fake /proc/self/mountinfo and /sys/fs/aufs up to date.
+
+    Use as a context manager to point naruto at the fake files while it's active.
+    '''
+    def __init__(self, base_dir):
+        self._base_dir = pathlib.Path(base_dir)
+        self.mountinfo_path = self._base_dir / 'mountinfo'
+        self.aufs_sys_folder = self._base_dir / 'aufs'
+        self.aufs_sys_folder.mkdir(parents=True, exist_ok=True)
+        self.calls = []
+        self._mounts = {}
+        self._next_id = 100
+        self._previous = None
+        self._lock = threading.Lock()
+        self._write_mountinfo()
+
+    def __enter__(self):
+        self._previous = (
+            naruto.mount.MOUNTINFO_PATH,
+            naruto.aufs.AUFS_SYS_FOLDER,
+            naruto.mount.set_backend(self))
+        naruto.mount.MOUNTINFO_PATH = str(self.mountinfo_path)
+        naruto.aufs.AUFS_SYS_FOLDER = self.aufs_sys_folder
+        naruto.aufs.refresh_mount_table()
+        return self
+
+    def __exit__(self, *exc_info):
+        naruto.mount.MOUNTINFO_PATH, naruto.aufs.AUFS_SYS_FOLDER, backend = self._previous
+        naruto.mount.set_backend(backend)
+        naruto.aufs.refresh_mount_table()
+
+    def _write_mountinfo(self):
+        lines = ['22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw']
+        for mount_point, (mount_id, _branches) in sorted(self._mounts.items()):
+            lines.append(
+                '{mount_id} 22 0:{mount_id} / {mount_point} rw,relatime - aufs none '
+                'rw,si={si}'.format(
+                    mount_id=mount_id, mount_point=mount_point, si=self._si(mount_id)))
+        self.mountinfo_path.write_text('\n'.join(lines) + '\n')
+
+    @staticmethod
+    def _si(mount_id):
+        return '{:x}'.format(mount_id)
+
+    def _write_branches(self, mount_id, branches):
+        si_dir = self.aufs_sys_folder / ('si_' + self._si(mount_id))
+        if si_dir.exists():
+            shutil.rmtree(str(si_dir))
+        si_dir.mkdir()
+        for index, (path, permission) in enumerate(branches):
+            (si_dir / 'br{}'.format(index)).write_text('{}={}\n'.format(path, permission))
+            (si_dir / 'brid{}'.format(index)).write_text('{}\n'.format(index))
+
+    @staticmethod
+    def _parse_branch(branch):
+        path, _, permission = branch.rpartition('=')
+        return path, permission
+
+    def _apply_directive(self, branches, directive):
+        command, _, argument = directive.partition(':')
+        if command == 'mod':
+            path, permission = self._parse_branch(argument)
+            branches[[branch_path for branch_path, _ in branches].index(path)] = (
+                path, permission)
+        elif command == 'add':
+            index, _, branch = argument.partition(':')
+            branches.insert(int(index), self._parse_branch(branch))
+        elif command == 'append':
+            branches.append(self._parse_branch(argument))
+        elif command == 'del':
+            branches.pop([branch_path for branch_path, _ in branches].index(argument))
+        else:
+            DEV_LOGGER.debug('Ignoring option %r', directive)
+
+    def mount(self, spec, file, types=None, options=None, mntops=None):
+        with self._lock:
+            self._mount(spec, file, types, options)
+
+    def _mount(self, spec, file, types, options):
+        self.calls.append(('mount', spec, file, types, options))
+        directives = (options or '').split(',')
+
+        if 'remount' in directives:
+            mount_id, branches = self._mounts[file]
+            for directive in directives:
+                self._apply_directive(branches, directive)
+        else:
+            mount_id = self._next_id
+            self._next_id += 1
+            branches = []
+            for directive in directives:
+                if directive.startswith('br:'):
+                    branches.extend(
+                        self._parse_branch(branch) for branch in directive[3:].split(':'))
+                else:
+                    self._apply_directive(branches, directive)
+            self._mounts[file] = (mount_id, branches)
+
+        self._write_branches(mount_id, branches)
+        self._write_mountinfo()
+
+    def umount(self, file):
+        with self._lock:
+            self.calls.append(('umount', file))
+            mount_id, _branches = self._mounts.pop(file)
+            shutil.rmtree(str(self.aufs_sys_folder / ('si_' + self._si(mount_id))))
+            self._write_mountinfo()
+
+
+@contextlib.contextmanager
+def simulated_aufs():
+    '''
+    Run naruto against a SimulatedAUFS in a temporary directory
+    '''
+    with tempfile.TemporaryDirectory() as base_dir:
+        with SimulatedAUFS(base_dir) as simulation:
+            yield simulation
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Optional SQLite catalog of layers.
+
+The per layer naruto_metadata.json files stay the source of truth. The catalog holds a copy of
+them, plus the shape of the tree, in a single database so queries don't need to walk the tree.
+"""
+import contextlib
+import logging
+import os
+import pathlib
+import threading
+
+import naruto.layer
+import naruto.tree
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+CATALOG_NAME = 'naruto_catalog.sqlite'
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS layers (
+    layer_id TEXT PRIMARY KEY,
+    parent_id TEXT,
+    root_id TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    is_root INTEGER NOT NULL,
+    description TEXT,
+    created REAL,
+    modified REAL,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS layers_parent_id ON layers (parent_id);
+CREATE INDEX IF NOT EXISTS layers_root_id ON layers (root_id);
+CREATE TABLE IF NOT EXISTS tags (
+    layer_id TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (layer_id, tag)
+);
+CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag);
+'''
+
+
+def _contents_size(contents_path):
+    '''
+    Total apparent size of files in contents_path
+    '''
+    total = 0
+    stack = [str(contents_path)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+class LayerCatalog(object):
+    '''
+    SQLite database of layer ids, parents, tags, descriptions, timestamps and sizes
+    '''
+    def __init__(self, db_path):
+        self._db_path = pathlib.Path(db_path)
+        self._lock = threading.RLock()
+        # Only import when catalog mode is used
+        import sqlite3
+        self._connection = sqlite3.connect(
+            str(self._db_path), check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+
+        version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+        if version not in (0, SCHEMA_VERSION):
+            raise ValueError('Unsupported catalog version {} in {}'.format(version, db_path))
+        self._connection.executescript(SCHEMA)
+        self._connection.execute('PRAGMA user_version={}'.format(SCHEMA_VERSION))
+
+    def __repr__(self):
+        return (
+            '{self.__class__.__module__}.{self.__class__.__name__}'
+            '({self._db_path!r})'.format(
+                self=self))
+
+    def close(self):
+        self._connection.close()
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        '''
+        Hold lock and run block in a single transaction
+        '''
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+    def _record(self, layer_id, parent_id, root_id, layer_dir, metadata, size=None):
+        '''
+        Insert or replace one layer. Must be called inside _transaction.
+        '''
+        metadata_stat = os.stat(str(pathlib.Path(layer_dir) / naruto.layer.METADATA_NAME))
+        self._connection.execute(
+            'INSERT OR REPLACE INTO layers '
+            '(layer_id, parent_id, root_id, path, is_root, description, created, modified, size) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, '
+            'COALESCE(?, (SELECT size FROM layers WHERE layer_id = ?)))',
+            (layer_id, parent_id, root_id, str(layer_dir), bool(metadata['is_root']),
+             metadata.get('description'),
+             metadata.get('created', metadata_stat.st_mtime), metadata_stat.st_mtime,
+             size, layer_id))
+        self._connection.execute('DELETE FROM tags WHERE layer_id = ?', (layer_id,))
+        self._connection.executemany(
+            'INSERT INTO tags (layer_id, tag) VALUES (?, ?)',
+            ((layer_id, tag) for tag in sorted(set(metadata.get('tags', ())))))
+
+    def record_layer(self, layer):
+        '''
+        Add or update a NarutoLayer from its metadata
+        '''
+        parent = layer.parent
+        with self._transaction():
+            self._record(
+                layer.layer_id,
+                None if parent is None else parent.layer_id,
+                layer.get_root().layer_id,
+                layer.path,
+                layer.get_metadata())
+
+    def remove_layer(self, layer_id):
+        '''
+        Remove a layer and all its descendants
+        '''
+        with self._transaction() as connection:
+            connection.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS removed (layer_id TEXT PRIMARY KEY)')
+            connection.execute('DELETE FROM removed')
+            connection.execute(
+                'WITH RECURSIVE subtree(layer_id) AS ('
+                '  VALUES (?) '
+                '  UNION SELECT layers.layer_id FROM layers '
+                '  JOIN subtree ON layers.parent_id = subtree.layer_id) '
+                'INSERT INTO removed SELECT layer_id FROM subtree',
+                (layer_id,))
+            connection.execute(
+                'DELETE FROM tags WHERE layer_id IN (SELECT layer_id FROM removed)')
+            connection.execute(
+                'DELETE FROM layers WHERE layer_id IN (SELECT layer_id FROM removed)')
+
+    def get_by_path(self, layer_dir):
+        '''
+        Get dict of catalog entry for layer directory, or None if it's not in the catalog
+        '''
+        rows = self._execute('SELECT * FROM layers WHERE path = ?', (str(layer_dir),))
+        if not rows:
+            return None
+        entry = dict(rows[0])
+        entry['is_root'] = bool(entry['is_root'])
+        entry['tags'] = frozenset(
+            row['tag'] for row in self._execute(
+                'SELECT tag FROM tags WHERE layer_id = ?', (entry['layer_id'],)))
+        return entry
+
+    def _paths(self, sql, parameters=()):
+        return [pathlib.Path(row['path']) for row in self._execute(sql, parameters)]
+
+    def find_by_tag(self, tag, root_id=None):
+        '''
+        Layer directories with tag, optionally only in the tree of root_id
+        '''
+        return self._paths(
+            'SELECT layers.path FROM tags JOIN layers USING (layer_id) '
+            'WHERE tags.tag = ? AND (? IS NULL OR layers.root_id = ?) ORDER BY layers.created',
+            (tag, root_id, root_id))
+
+    def find_by_description(self, pattern, root_id=None):
+        '''
+        Layer directories with description matching SQL LIKE pattern
+        '''
+        return self._paths(
+            'SELECT path FROM layers '
+            'WHERE description LIKE ? AND (? IS NULL OR root_id = ?) ORDER BY created',
+            (pattern, root_id, root_id))
+
+    def find_leaves(self, root_id=None):
+        '''
+        Layer directories of layers without children
+        '''
+        return self._paths(
+            'SELECT path FROM layers WHERE (? IS NULL OR root_id = ?) AND NOT EXISTS ('
+            '  SELECT 1 FROM layers AS children WHERE children.parent_id = layers.layer_id) '
+            'ORDER BY created',
+            (root_id, root_id))
+
+    def find_all(self, root_id=None):
+        '''
+        All layer directories
+        '''
+        return self._paths(
+            'SELECT path FROM layers WHERE (? IS NULL OR root_id = ?) ORDER BY created',
+            (root_id, root_id))
+
+    def rebuild(self, naruto_home, with_sizes=False):
+        '''
+        Throw away catalog and rebuild it from the metadata of every tree in naruto_home.
+
+        Returns number of layers recorded.
+        '''
+        trees = []
+        for tree_dir in sorted(pathlib.Path(naruto_home).iterdir()):
+            if not tree_dir.is_dir():
+                continue
+            for root_dir in tree_dir.iterdir():
+                try:
+                    trees.append(naruto.tree.LayerTree(root_dir))
+                except (ValueError, OSError) as error:
+                    DEV_LOGGER.warning('Skipping %s: %s', root_dir, error)
+
+        count = 0
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM tags')
+            connection.execute('DELETE FROM layers')
+            for tree in trees:
+                for node in tree:
+                    self._record(
+                        node.layer_id,
+                        None if node.parent is None else node.parent.layer_id,
+                        tree.root.layer_id,
+                        node.path,
+                        node.metadata,
+                        _contents_size(node.contents_path) if with_sizes else None)
+                    count += 1
+
+        DEV_LOGGER.info('Recorded %d layers in %r', count, self)
+        return count
+
+
+_CATALOG = None
+
+
+def get_catalog():
+    '''
+    Get catalog in use, or None if catalog mode isn't enabled
+    '''
+    return _CATALOG
+
+
+def set_catalog(catalog):
+    '''
+    Enable catalog mode with the given LayerCatalog, or disable it with None.
+
+    Returns previous catalog.
+    '''
+    global _CATALOG
+    previous, _CATALOG = _CATALOG, catalog
+    return previous
+
+
+def open_catalog(naruto_home):
+    '''
+    Open catalog stored in naruto_home and enable catalog mode
+    '''
+    catalog = LayerCatalog(pathlib.Path(naruto_home) / CATALOG_NAME)
+    set_catalog(catalog)
+    return catalog
@@ -2,15 +2,29 @@
 """
 Main group for naruto cli
 """
-import io
+import errno
 import logging
 import os
 import pathlib
-import shutil
+import sys
 
 import click
 
+import naruto.aufs
+import naruto.catalog
+import naruto.client
+import naruto.dedupe
+import naruto.delete
+import naruto.gc
+import naruto.info
+import naruto.layer
+import naruto.layout
+import naruto.profile
+import naruto.scratch
+import naruto.transfer
+import naruto.usage
 from naruto import NarutoLayer, LayerNotFound
+from naruto.parallel import DEFAULT_PARALLELISM, MountOperationError
 
 DEV_LOGGER = logging.getLogger(__name__)
 DEFAULT_NARUTO_HOME = pathlib.Path(os.path.expanduser('~/.naruto'))
@@ -23,6 +37,7 @@ class CLIContext(object):
     '''
     def __init__(self):
         self.naruto_home = DEFAULT_NARUTO_HOME
+        self.parallelism = DEFAULT_PARALLELISM
 
 
 cli_context = click.make_pass_decorator(CLIContext, ensure=True)
@@ -48,8 +63,21 @@ cli_context = click.make_pass_decorator(CLIContext, ensure=True)
     help='Set verbosity level explicitly (int or CRITICAL, ERROR, WARNING, INFO, DEBUG, NOTSET)',
     default=DEFAULT_LOG_LEVEL,
     type=str)
+@click.option(
+    '--parallelism',
+    '-j',
+    help='Maximum number of mount points to change or threads to delete with at once. '
+    'Default: {}'.format(
+        DEFAULT_PARALLELISM),
+    default=DEFAULT_PARALLELISM,
+    type=click.IntRange(min=1))
+@click.option(
+    '--catalog/--no-catalog',
+    default=False,
+    envvar='NARUTO_CATALOG',
+    help='Keep and use a SQLite catalog of layers in the naruto home directory')
 @cli_context
-def naruto_cli(ctx, naruto_home, verbosity):
+def naruto_cli(ctx, naruto_home, verbosity, parallelism, catalog):
     '''
     CLI for naruto
     '''
@@ -64,6 +92,12 @@ def naruto_cli(ctx, naruto_home, verbosity):
     ctx.naruto_home = pathlib.Path(naruto_home)
     DEV_LOGGER.debug('Home path is %r', ctx.naruto_home)
 
+    ctx.parallelism = parallelism
+
+    if catalog:
+        ctx.naruto_home.mkdir(parents=True, exist_ok=True)
+        naruto.catalog.open_catalog(ctx.naruto_home)
+
 
 class _LayerLookup(click.ParamType):
     '''
@@ -96,7 +130,9 @@ class _LayerLookup(click.ParamType):
                 naruto_root = cli_context.naruto_home / root_spec
 
             try:
-                naruto_root, = tuple(naruto_root.iterdir())
+                # Roots being deleted are renamed to hidden directories
+                naruto_root, = tuple(
+                    path for path in naruto_root.iterdir() if not path.name.startswith('.'))
             except FileNotFoundError:
                 self.fail('Directory {} does not exist'.format(naruto_root))
             except ValueError:
@@ -117,8 +153,13 @@ class _LayerLookup(click.ParamType):
 @naruto_cli.command()
 @click.argument('name_or_path')
 @click.option('--description', help='Add description to new naruto layer')
+@click.option(
+    '--layout',
+    type=click.Choice(sorted(naruto.layer.LAYOUTS)),
+    default='nested',
+    help='Keep children inside their parent, or every layer in one directory of the root')
 @cli_context
-def create(ctx, name_or_path, description):
+def create(ctx, name_or_path, description, layout):
     '''
     Create new NarutoLayer
     '''
@@ -143,7 +184,7 @@ def create(ctx, name_or_path, description):
         if len(tuple(path.iterdir())) != 0:
             raise Exception('Expected create directory {!s} to be empty'.format(path))
 
-    NarutoLayer.create(path, description=description)
+    NarutoLayer.create(path, description=description, layout=naruto.layer.LAYOUTS[layout])
 
 
 @naruto_cli.command()
@@ -153,7 +194,89 @@ def list_home_layers(ctx):
     List layers stored in home directory
     '''
     for path in ctx.naruto_home.iterdir():
-        click.echo(str(path))
+        if path.is_dir():
+            click.echo(str(path))
+
+
+@naruto_cli.command()
+@click.option('--sizes', default=False, is_flag=True, help='Also record size of each layer')
+@cli_context
+def catalog_rebuild(ctx, sizes):
+    '''
+    Rebuild layer catalog from layer metadata
+    '''
+    catalog = naruto.catalog.get_catalog() or naruto.catalog.open_catalog(ctx.naruto_home)
+    count = catalog.rebuild(ctx.naruto_home, with_sizes=sizes)
+    click.echo('Catalogued {} layers'.format(count))
+
+
+@naruto_cli.command()
+@click.option('--tag', help='Layers with this tag')
+@click.option('--description', help='Layers with description matching SQL LIKE pattern')
+@click.option('--leaves', default=False, is_flag=True, help='Only layers without children')
+@click.option('--mounted', default=False, is_flag=True, help='Only layers that are mounted')
+@cli_context
+def query(ctx, tag, description, leaves, mounted):
+    '''
+    Find layers in all trees using the layer catalog
+    '''
+    catalog = naruto.catalog.get_catalog() or naruto.catalog.open_catalog(ctx.naruto_home)
+
+    queries = []
+    if tag is not None:
+        queries.append(catalog.find_by_tag(tag))
+    if description is not None:
+        queries.append(catalog.find_by_description(description))
+    if leaves:
+        queries.append(catalog.find_leaves())
+    if not queries:
+        queries.append(catalog.find_all())
+
+    matches = set(queries[0]).intersection(*queries[1:])
+    if mounted:
+        mount_table = naruto.aufs.get_mount_table()
+
+        def is_mounted(layer_dir):
+            try:
+                # Ephemeral layers are mounted from scratch
+                branch_path = naruto.layer.NarutoLayer(layer_dir).branch_path
+            except ValueError:
+                DEV_LOGGER.debug('Catalogued layer %s has gone', layer_dir)
+                return False
+            return bool(mount_table.find_branches(branch_path))
+
+        matches = set(layer_dir for layer_dir in matches if is_mounted(layer_dir))
+
+    for layer_dir in queries[0]:
+        if layer_dir in matches:
+            click.echo(str(layer_dir))
+
+
+@naruto_cli.command()
+@click.option(
+    '--socket',
+    'socket_path',
+    type=click.Path(dir_okay=False, resolve_path=True),
+    default=None,
+    help='Unix socket to listen on. Default: ${} or {}'.format(
+        naruto.client.SOCKET_ENV, naruto.client.DEFAULT_SOCKET_PATH))
+def daemon(socket_path):
+    '''
+    Serve naruto commands on a unix socket until stopped.
+
+    The naruto command sends its command line to the daemon when one is running, which avoids
+    Python startup and reloading state on every call. Set NARUTO_NO_DAEMON=1 to run in process
+    anyway.
+    '''
+    # Only the daemon needs socket and friends
+    import naruto.daemon
+    if socket_path is None:
+        socket_path = naruto.client.get_socket_path()
+    pathlib.Path(socket_path).parent.mkdir(parents=True, exist_ok=True)
+    try:
+        naruto.daemon.run_daemon(socket_path, naruto_cli)
+    except naruto.daemon.DaemonRunning as error:
+        raise click.ClickException(str(error))
 
 
 #################################################################################################
@@ -172,57 +295,168 @@ def _modification_command(fn):
     return fn
 
 
-class InfoNodeAdapter(object):
+@_modification_command
+@click.option(
+    '--max-depth',
+    type=click.IntRange(min=0),
+    default=None,
+    help='Only show layers this many generations below the root')
+@click.option('--json', 'as_json', default=False, is_flag=True, help='Output as JSON')
+@click.option(
+    '--sizes', default=False, is_flag=True, help='Include disk usage of each layer and subtree')
+@cli_context
+def info(ctx, layer, max_depth, as_json, sizes):
     '''
-    Adapt NarutoLayer for info printout
+    Get info about a layer
     '''
-    def __init__(self, layer):
-        self._layer = layer
-
-    def output(self, io_stream, level, highlight):
-        io_stream.write('{indent}+-- {highlight}{layer!s}{highlight}\n'.format(
-            indent='  ' * level,
-            layer=self._layer,
-            highlight='!!!!' if self._layer in highlight else ''))
-        for child in self._layer:
-            self.__class__(child).output(io_stream, level + 1, highlight)
+    tree = layer.get_tree()
+    usage = None
+    if sizes:
+        usage = naruto.usage.get_tree_usage(tree, parallelism=ctx.parallelism)
+    render = naruto.info.render_json if as_json else naruto.info.render_text
+    render(
+        sys.stdout,
+        tree,
+        highlight=(tree.get_node(layer),),
+        max_depth=max_depth,
+        usage=usage)
 
 
 @_modification_command
-def info(layer):
+@click.option(
+    '--human-readable', '-h', default=False, is_flag=True, help='Print sizes like 1K, 23M, 2G')
+@click.option(
+    '--refresh', default=False, is_flag=True, help='Rescan layers even if usage is cached')
+@cli_context
+def du(ctx, layer, human_readable, refresh):
     '''
-    Get info about a layer
+    Show disk usage of a layer and its descendants.
+
+    Columns are the total of the layer and its descendants, the layer on its own, the
+    number of inodes in the layer and the layer id. Descendants come before their parents.
+    '''
+    tree = layer.get_tree()
+    node = tree.get_node(layer)
+    usage = naruto.usage.get_tree_usage(
+        tree, nodes=(node,), parallelism=ctx.parallelism, refresh=refresh)
+    size_format = naruto.usage.format_size if human_readable else str
+
+    for du_node in reversed((node,) + node.descendants):
+        exclusive, total = usage[du_node]
+        click.echo('{}\t{}\t{}\t{}'.format(
+            size_format(total.bytes),
+            size_format(exclusive.bytes),
+            exclusive.inodes,
+            du_node.layer_id))
+
+
+def _profile_option(fn):
+    return click.option(
+        '--profile',
+        default=None,
+        help='Mount profile with the aufs options to use. Default: the default in {} in the '
+        'naruto home, or aufs\'s own defaults'.format(naruto.profile.PROFILES_NAME))(fn)
+
+
+def _get_profile(ctx, name):
+    try:
+        return naruto.profile.get_profile(name, naruto_home=ctx.naruto_home)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+
+
+@naruto_cli.command()
+@cli_context
+def list_profiles(ctx):
+    '''
+    List mount profiles and their aufs options
     '''
-    io_stream = io.StringIO()
-    InfoNodeAdapter(layer.get_root()).output(io_stream, 0, highlight=(layer,))
-    click.echo(io_stream.getvalue())
+    profiles, default = naruto.profile.load_profiles(ctx.naruto_home)
+    for name, profile in sorted(profiles.items()):
+        click.echo('{}{}\t{}\tancestors={}'.format(
+            name,
+            ' (default)' if name == default else '',
+            ','.join(profile.options) or '-',
+            profile.ro_permission))
 
 
 @_modification_command
 @click.argument('mount_dest')
-def mount(layer, mount_dest):
+@_profile_option
+@cli_context
+def mount(ctx, layer, mount_dest, profile):
     '''
     Mount a layer
     '''
-    layer.mount(mount_dest)
+    layer.mount(mount_dest, profile=_get_profile(ctx, profile))
+
+
+def _report_mount_operation(result):
+    '''
+    Report MountOperationResult and fail if any mount failed
+    '''
+    for mount_point in result.succeeded:
+        DEV_LOGGER.info('Succeeded on %s', mount_point)
+
+    try:
+        result.raise_for_failures()
+    except MountOperationError as error:
+        raise click.ClickException(str(error))
 
 
 @_modification_command
 @click.argument('mount_dest')
 @click.option('--description', help='Add description to new naruto layer')
-def branch_and_mount(layer, mount_dest, description):
+@_profile_option
+@click.option(
+    '--ephemeral',
+    default=False,
+    is_flag=True,
+    help='Keep writes in the scratch directory until the layer is frozen or committed')
+@click.option(
+    '--scratch-dir',
+    default=str(naruto.scratch.DEFAULT_SCRATCH_DIR),
+    envvar=naruto.scratch.SCRATCH_ENV,
+    type=click.Path(file_okay=False, resolve_path=True),
+    help='Where ephemeral layers are written, ideally a tmpfs. Default: {}'.format(
+        naruto.scratch.DEFAULT_SCRATCH_DIR))
+@cli_context
+def branch_and_mount(ctx, layer, mount_dest, description, profile, ephemeral, scratch_dir):
     '''
     Branch a layer and mount at new dest
     '''
-    layer.create_child(description=description).mount(mount_dest)
+    profile = _get_profile(ctx, profile)
+    try:
+        child = layer.create_child(
+            description=description,
+            parallelism=ctx.parallelism,
+            scratch_dir=scratch_dir if ephemeral else None)
+    except MountOperationError as error:
+        raise click.ClickException(str(error))
+    child.mount(mount_dest, profile=profile)
 
 
 @_modification_command
-def unmount_all(layer):
+@cli_context
+def commit(ctx, layer):
+    '''
+    Make a layer read only, moving writes of its mounts to a new child. Ephemeral layers are
+    copied out of scratch and the new child is ephemeral too.
+    '''
+    try:
+        result = layer.freeze_mounts(parallelism=ctx.parallelism)
+    except MountOperationError as error:
+        raise click.ClickException(str(error))
+    _report_mount_operation(result)
+
+
+@_modification_command
+@cli_context
+def unmount_all(ctx, layer):
     '''
     Unmount all uses of this layer
     '''
-    layer.unmount_all()
+    _report_mount_operation(layer.unmount_all(parallelism=ctx.parallelism))
 
 
 @_modification_command
@@ -235,9 +469,22 @@ def find_mounts(layer):
             branch=branch))
 
 
+def _report_delete_progress(progress):
+    click.echo(
+        'Removed {progress.files} files and {progress.directories} directories '
+        '({progress.rate:.0f}/s)'.format(progress=progress),
+        err=True)
+
+
 @_modification_command
 @click.option('--no-prompt', default=False, is_flag=True)
-def delete(layer, no_prompt):
+@click.option(
+    '--background',
+    default=False,
+    is_flag=True,
+    help='Return as soon as layer is removed from the tree and free space in the background')
+@cli_context
+def delete(ctx, layer, no_prompt, background):
     '''
     Delete a layer
     '''
@@ -246,25 +493,259 @@ def delete(layer, no_prompt):
     else:
         confirm = lambda message: click.confirm(message, abort=True)
 
-    if layer.has_children:
+    node = layer.get_tree().get_node(layer)
+    descendant_count = len(node.descendants)
+
+    if node.has_children:
         click.secho(
             'WARNING: This layer has {} direct children and a further {} descendants.'.format(
-                len(layer.children),
-                len(layer.descendants)),
+                len(node.children),
+                descendant_count),
             fg='red')
 
     if layer.mounted:
         confirm(
-            '{} is currently mounted. Must unmount first. Continue?'.format(layer))
-        layer.unmount_all()
+            '{} is currently mounted. Must unmount first. Continue?'.format(node))
+        _report_mount_operation(layer.unmount_all(parallelism=ctx.parallelism))
 
     confirm(
         click.style(
             'This will irreversible delete {} and all {} descendants. Continue?'.format(
-                layer, len(layer.descendants)),
+                node, descendant_count),
             fg='red'))
 
-    shutil.rmtree(str(layer.path.resolve()))
+    layer.delete(
+        parallelism=ctx.parallelism,
+        background=background,
+        progress=naruto.delete.DeleteProgress(_report_delete_progress))
+
+
+@_modification_command
+@cli_context
+def empty_trash(ctx, layer):
+    '''
+    Free space of deletes that didn't finish
+    '''
+    for trash_path in naruto.delete.iter_trash(layer.get_root().path):
+        click.echo('Removing {}'.format(trash_path))
+        naruto.delete.reclaim(
+            trash_path,
+            parallelism=ctx.parallelism,
+            progress=naruto.delete.DeleteProgress(_report_delete_progress))
+
+
+@_modification_command
+@click.argument('base', required=False)
+@click.option(
+    '--hash',
+    'hash_contents',
+    default=False,
+    is_flag=True,
+    help='Compare contents of files with the same size rather than modification times')
+def diff(layer, base, hash_contents):
+    '''
+    Show files added (A), modified (M) or deleted (D) going from BASE to the layer.
+
+    BASE is a layer spec relative to the layer, like 'root' or '^2'. Defaults to the parent.
+    '''
+    base_layer = None if base is None else layer.find_layer(base)
+    for entry in layer.diff(base_layer, hash_contents=hash_contents):
+        click.echo('{entry.change} {entry.path}{suffix}'.format(
+            entry=entry, suffix='/' if entry.is_dir else ''))
+
+
+@_modification_command
+@click.option(
+    '--chain', default=False, is_flag=True, help='Also export all ancestors of the layer')
+@click.option(
+    '--compression',
+    type=click.Choice(naruto.transfer.COMPRESSIONS),
+    default='none',
+    help='Compress the tar stream. zstd needs the zstandard module.')
+@click.option('--output', type=click.File('wb'), default='-', help='Where to write the tar')
+def export(layer, chain, compression, output):
+    '''
+    Write layer contents and metadata as a tar
+    '''
+    try:
+        naruto.transfer.export_layers(layer, output, chain=chain, compression=compression)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+
+
+@naruto_cli.command('import')
+@click.argument('name_or_path')
+@click.option(
+    '--input',
+    'input_file',
+    type=click.File('rb'),
+    default='-',
+    help='Tar written by export. gzip and zstd compression are detected.')
+@cli_context
+def import_(ctx, name_or_path, input_file):
+    '''
+    Import layers from a tar into a naruto home name or path, skipping layers already there
+    '''
+    if os.sep in name_or_path:
+        path = pathlib.Path(name_or_path)
+    else:
+        path = ctx.naruto_home / name_or_path
+        path.mkdir(parents=True, exist_ok=True)
+
+    try:
+        imported, skipped = naruto.transfer.import_layers(input_file, path)
+    except (naruto.transfer.ArchiveError, ValueError) as error:
+        raise click.ClickException(str(error))
+    click.echo('Imported {} layers. Skipped {} existing layers.'.format(
+        len(imported), len(skipped)), err=True)
+
+
+@_modification_command
+@click.option(
+    '--reflink',
+    default=False,
+    is_flag=True,
+    help='Reflink rather than hard link duplicates. Needs a filesystem like btrfs or xfs.')
+@click.option(
+    '--min-size',
+    default=naruto.dedupe.DEFAULT_MIN_SIZE,
+    type=click.IntRange(min=1),
+    help='Ignore files smaller than this many bytes')
+@cli_context
+def dedupe(ctx, layer, reflink, min_size):
+    '''
+    Share identical files between read only layers in the layer's tree
+    '''
+    try:
+        result = naruto.dedupe.dedupe_tree(
+            layer.get_tree(), use_reflink=reflink, min_size=min_size, parallelism=ctx.parallelism)
+    except OSError as error:
+        if error.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.EXDEV) or not reflink:
+            raise
+        raise click.ClickException('Unable to reflink: {}'.format(error))
+
+    click.echo(
+        'Scanned {result.scanned} files, hashed {result.hashed}, linked {result.linked} '
+        'saving {result.bytes_saved} bytes. Removed {result.objects_removed} unused '
+        'objects.'.format(result=result))
+
+
+@_modification_command
+@click.option('--dry-run', default=False, is_flag=True, help='Only report what would be removed')
+@click.option('--no-prompt', default=False, is_flag=True)
+@click.option(
+    '--empty-leaves', default=False, is_flag=True, help='Remove unmounted leaves with no contents')
+@click.option(
+    '--expire-tag',
+    multiple=True,
+    help='Expire unmounted leaves with tags matching this glob. Can be given several times.')
+@click.option(
+    '--max-age',
+    type=click.FloatRange(min=0),
+    default=None,
+    help='Expire tagged layers older than this many days')
+@click.option(
+    '--keep',
+    type=click.IntRange(min=0),
+    default=None,
+    help='Expire all but this many of the newest layers with each tag')
+@cli_context
+def gc(ctx, layer, dry_run, no_prompt, empty_leaves, expire_tag, max_age, keep):
+    '''
+    Remove malformed layers, interrupted creates, leftover trash and, optionally, empty and
+    expired leaves from the layer's tree.
+
+    Malformed directories are listed with how many layers are in them. Anything with a mounted
+    branch in it is left alone.
+    '''
+    if expire_tag and max_age is None and keep is None:
+        raise click.UsageError('--expire-tag needs --max-age or --keep')
+
+    policies = [
+        naruto.gc.ExpiryPolicy(
+            tag_pattern,
+            max_age=None if max_age is None else max_age * 24 * 60 * 60,
+            keep=keep)
+        for tag_pattern in expire_tag]
+
+    tree = layer.get_tree()
+    garbage = list(naruto.gc.find_garbage(tree, empty_leaves=empty_leaves, policies=policies))
+    for item in garbage:
+        if item.reason == naruto.gc.MALFORMED:
+            click.echo('{item.reason}\t{item.path}\t{layers} layers'.format(
+                item=item, layers=naruto.gc.count_layers(item.path)))
+        else:
+            click.echo('{item.reason}\t{item.path}'.format(item=item))
+
+    if dry_run or not garbage:
+        return
+
+    if not no_prompt:
+        click.confirm(
+            click.style('Remove these {} items?'.format(len(garbage)), fg='red'), abort=True)
+
+    naruto.gc.collect_garbage(
+        tree,
+        garbage,
+        parallelism=ctx.parallelism,
+        progress=naruto.delete.DeleteProgress(_report_delete_progress))
+
+
+@_modification_command
+@click.option('--rebuild', default=False, is_flag=True, help='Rebuild even if no problems found')
+def check_index(layer, rebuild):
+    '''
+    Check tag and layer id index and rebuild it if needed
+    '''
+    index = layer.get_index()
+    problems = index.check()
+    for problem in problems:
+        click.echo(problem)
+
+    if problems or rebuild:
+        index.rebuild()
+        click.echo('Rebuilt {!s}'.format(index.path))
+
+
+@_modification_command
+@click.option(
+    '--depth',
+    type=click.IntRange(min=2),
+    default=None,
+    help='Number of layers to merge, counting this one. Default: all the way to the root')
+def squash(layer, depth):
+    '''
+    Merge a read only layer and its ancestors into one branch for later mounts
+    '''
+    try:
+        layer.squash(depth=depth)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+
+
+@_modification_command
+def migrate_layout(layer):
+    '''
+    Move the layer's tree to the flat layout. Nothing in the tree may be mounted.
+    '''
+    try:
+        moved = naruto.layout.migrate_to_flat(layer.get_root())
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    click.echo('Moved {} layers'.format(moved))
+
+
+@_modification_command
+@click.argument('new_parent')
+@cli_context
+def reparent(ctx, layer, new_parent):
+    '''
+    Move a layer and its descendants under NEW_PARENT, a layer spec, in a flat tree
+    '''
+    try:
+        layer.reparent(layer.find_layer(new_parent), parallelism=ctx.parallelism)
+    except (ValueError, KeyError) as error:
+        raise click.ClickException(str(error))
 
 
 @_modification_command
@@ -295,11 +776,11 @@ def tags(layer, tags):
 @click.argument('tags', nargs=-1)
 def add_tags(layer, tags):
     ''' Add tag to layer'''
-    layer.tags = layer.tags.union(tags)
+    layer.update(add_tags=tags)
 
 
 @_modification_command
 @click.argument('tags', nargs=-1)
 def remove_tags(layer, tags):
     ''' Remove tag from layer'''
-    layer.tags = layer.tags.difference(tags)
+    layer.update(remove_tags=tags)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight naruto entry point.
+
+If a naruto daemon is listening the command line is sent to it, otherwise the CLI runs in
+process as usual. Only the standard library is imported until falling back, so calls served by
+the daemon skip loading the rest of naruto.
+
+The daemon and client exchange frames of a one byte channel, a four byte length and a payload.
+The daemon starts with a ready frame, which the client waits HANDSHAKE_TIMEOUT seconds for before
+sending its request and otherwise runs in process. Either way the command runs exactly once.
+"""
+import json
+import os
+import struct
+import sys
+
+SOCKET_ENV = 'NARUTO_SOCKET'
+NO_DAEMON_ENV = 'NARUTO_NO_DAEMON'
+SOCKET_NAME = 'naruto.sock'
+DEFAULT_SOCKET_PATH = os.path.join(os.path.expanduser('~/.naruto'), SOCKET_NAME)
+# Environment the CLI reads, passed through to the daemon
+FORWARD_ENV_PREFIX = 'NARUTO_'
+
+READY = b'y'
+REQUEST = b'r'
+STDOUT = b'o'
+STDERR = b'e'
+STDIN = b'i'
+EXIT = b'x'
+
+_HEADER = struct.Struct('!cI')
+_INT = struct.Struct('!i')
+_PEER_CREDENTIALS = struct.Struct('3i')
+
+# Seconds to wait for a daemon that's busy or stuck before running in process
+HANDSHAKE_TIMEOUT = 5.0
+# Top level options of naruto_cli that take a value
+_GLOBAL_VALUE_OPTIONS = ('--naruto-home', '--verbosity', '-V', '--parallelism', '-j')
+
+
+class ProtocolError(Exception):
+    '''
+    Other end sent something unexpected
+    '''
+
+
+class DaemonBusy(Exception):
+    '''
+    Daemon didn't take the command in time. Nothing was run.
+    '''
+
+
+def send_frame(sock, channel, payload=b''):
+    sock.sendall(_HEADER.pack(channel, len(payload)) + payload)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise ProtocolError('Connection closed mid frame')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_frame(sock):
+    '''
+    Get (channel, payload) of next frame, or (None, None) if the connection was closed
+    '''
+    import socket
+    header = sock.recv(_HEADER.size, socket.MSG_WAITALL)
+    if not header:
+        return None, None
+    if len(header) != _HEADER.size:
+        raise ProtocolError('Connection closed mid frame')
+    channel, size = _HEADER.unpack(header)
+    return channel, _recv_exactly(sock, size) if size else b''
+
+
+def pack_int(value):
+    return _INT.pack(value)
+
+
+def unpack_int(payload):
+    return _INT.unpack(payload)[0]
+
+
+def get_socket_path():
+    return os.environ.get(SOCKET_ENV, DEFAULT_SOCKET_PATH)
+
+
+def get_peer_uid(sock):
+    '''
+    Get uid of the process at the other end of unix socket sock
+    '''
+    import socket
+    _, uid, _ = _PEER_CREDENTIALS.unpack(
+        sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _PEER_CREDENTIALS.size))
+    return uid
+
+
+def connect(socket_path=None):
+    '''
+    Connect to daemon. Returns None if none is listening or it's run by another user.
+    '''
+    socket_path = socket_path or get_socket_path()
+    if not os.path.exists(socket_path):
+        # Don't spend time importing socket when running in process
+        return None
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(HANDSHAKE_TIMEOUT)
+    try:
+        sock.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError, socket.timeout):
+        sock.close()
+        return None
+
+    # Whoever runs the daemon sees everything the command does
+    peer_uid = get_peer_uid(sock)
+    if peer_uid not in (os.geteuid(), 0):
+        sock.close()
+        sys.stderr.write('Ignoring naruto daemon on {} run by uid {}\n'.format(
+            socket_path, peer_uid))
+        return None
+    return sock
+
+
+def run_remote(sock, argv, stdin=None, stdout=None, stderr=None):
+    '''
+    Run naruto command line argv in the daemon connected to by sock. Returns exit code.
+
+    Streams are binary files and default to the process's own. Raises DaemonBusy if the daemon
+    isn't ready for the command within HANDSHAKE_TIMEOUT.
+    '''
+    stdin = sys.stdin.buffer if stdin is None else stdin
+    stdout = sys.stdout.buffer if stdout is None else stdout
+    stderr = sys.stderr.buffer if stderr is None else stderr
+    outputs = {STDOUT: stdout, STDERR: stderr}
+
+    request = {
+        'argv': list(argv),
+        'cwd': os.getcwd(),
+        'env': dict(
+            (key, value) for key, value in os.environ.items()
+            if key.startswith(FORWARD_ENV_PREFIX)),
+    }
+    import socket
+    try:
+        channel, payload = recv_frame(sock)
+    except socket.timeout:
+        raise DaemonBusy('Daemon did not answer in {} seconds'.format(HANDSHAKE_TIMEOUT))
+    if channel == READY:
+        send_frame(sock, REQUEST, json.dumps(request).encode('utf-8'))
+        # Commands can take as long as they like, prompts included
+        sock.settimeout(None)
+        channel, payload = recv_frame(sock)
+
+    while True:
+        if channel is None:
+            raise ProtocolError('Daemon closed connection without an exit code')
+        elif channel in outputs:
+            outputs[channel].write(payload)
+            outputs[channel].flush()
+        elif channel == STDIN:
+            data = stdin.read1(unpack_int(payload)) if hasattr(stdin, 'read1') else \
+                stdin.read(unpack_int(payload))
+            send_frame(sock, STDIN, data)
+        elif channel == EXIT:
+            return unpack_int(payload)
+        else:
+            raise ProtocolError('Unknown channel {!r}'.format(channel))
+        channel, payload = recv_frame(sock)
+
+
+def _run_local(argv):
+    from naruto.cli import naruto_cli
+    naruto_cli(args=argv, prog_name='naruto')
+
+
+def get_subcommand(argv):
+    '''
+    Get name of the subcommand in naruto command line argv, or None if there isn't one
+
+    >>> get_subcommand(['--naruto-home', 'daemon', 'info', '--layer', 'daemon'])
+    'info'
+    >>> get_subcommand(['-j4', '-V', 'DEBUG', 'daemon'])
+    'daemon'
+    >>> get_subcommand(['--help']) is None
+    True
+    '''
+    arguments = iter(argv)
+    for argument in arguments:
+        if argument == '--':
+            return next(arguments, None)
+        if not argument.startswith('-'):
+            return argument
+        if argument in _GLOBAL_VALUE_OPTIONS:
+            next(arguments, None)
+    return None
+
+
+def main(argv=None):
+    '''
+    Run naruto through the daemon if one is running, otherwise in process
+    '''
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if os.environ.get(NO_DAEMON_ENV) or get_subcommand(argv) == 'daemon':
+        return _run_local(argv)
+
+    sock = connect()
+    if sock is None:
+        return _run_local(argv)
+    try:
+        with sock:
+            exit_code = run_remote(sock, argv)
+    except DaemonBusy:
+        return _run_local(argv)
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
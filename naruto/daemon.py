@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Serve naruto commands over a unix socket.
+
+The daemon keeps naruto imported, along with the metadata cache and mount table snapshot, so
+commands sent by naruto.client skip Python startup and rereading state. Commands run one at a
+time in the daemon's process with the client's working directory, NARUTO_ environment and
+standard streams. The mount table is refreshed whenever the kernel reports it changed. Clients
+that don't send their request within naruto.client.HANDSHAKE_TIMEOUT are dropped.
+
+Only the user running the daemon, and root, may connect.
+"""
+import io
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+import traceback
+
+import naruto.aufs
+import naruto.catalog
+import naruto.client
+import naruto.mount
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+LISTEN_BACKLOG = 64
+
+
+class DaemonRunning(Exception):
+    '''
+    Another daemon is listening on the socket
+    '''
+
+
+class _SocketWriter(io.RawIOBase):
+    '''
+    Send whatever is written as frames on one channel
+    '''
+    def __init__(self, sock, channel):
+        super().__init__()
+        self._sock = sock
+        self._channel = channel
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        naruto.client.send_frame(self._sock, self._channel, data)
+        return len(data)
+
+
+class _SocketReader(io.RawIOBase):
+    '''
+    Ask the client for stdin as it's read
+    '''
+    def __init__(self, sock):
+        super().__init__()
+        self._sock = sock
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        naruto.client.send_frame(
+            self._sock, naruto.client.STDIN, naruto.client.pack_int(len(buffer)))
+        channel, payload = naruto.client.recv_frame(self._sock)
+        if channel != naruto.client.STDIN:
+            raise naruto.client.ProtocolError('Expected stdin but got {!r}'.format(channel))
+        buffer[:len(payload)] = payload
+        return len(payload)
+
+
+def _exit_code(error):
+    if error.code is None:
+        return 0
+    if isinstance(error.code, int):
+        return error.code
+    sys.stderr.write('{}\n'.format(error.code))
+    return 1
+
+
+class NarutoDaemon(object):
+    '''
+    Serve cli, a click command, on a unix socket at socket_path
+    '''
+    def __init__(self, socket_path, cli):
+        self.socket_path = str(socket_path)
+        self._cli = cli
+        self._uid = os.geteuid()
+        self._stop_read, self._stop_write = os.pipe()
+        self._listener = None
+
+    def _bind(self):
+        stale = naruto.client.connect(self.socket_path)
+        if stale is not None:
+            stale.close()
+            raise DaemonRunning('A daemon is already listening on {}'.format(self.socket_path))
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        previous_umask = os.umask(0o177)
+        try:
+            listener.bind(self.socket_path)
+        finally:
+            os.umask(previous_umask)
+        listener.listen(LISTEN_BACKLOG)
+        return listener
+
+    def _is_allowed(self, connection):
+        return naruto.client.get_peer_uid(connection) in (self._uid, 0)
+
+    def stop(self):
+        '''
+        Make serve_forever return. Safe to call from other threads and signal handlers.
+        '''
+        os.write(self._stop_write, b'x')
+
+    def serve_forever(self):
+        '''
+        Handle connections until stop is called
+        '''
+        self._listener = self._bind()
+        poller = select.poll()
+        poller.register(self._listener, select.POLLIN)
+        poller.register(self._stop_read, select.POLLIN)
+        # The kernel flags mountinfo with POLLPRI whenever the mount table changes
+        mountinfo = open(naruto.mount.MOUNTINFO_PATH, 'rb')
+        poller.register(mountinfo, select.POLLPRI | select.POLLERR)
+        DEV_LOGGER.info('Listening on %s', self.socket_path)
+
+        try:
+            while True:
+                events = dict(poller.poll())
+                if self._stop_read in events:
+                    return
+                if mountinfo.fileno() in events:
+                    DEV_LOGGER.debug('Mount table changed')
+                    naruto.aufs.refresh_mount_table()
+                if self._listener.fileno() in events:
+                    connection, _ = self._listener.accept()
+                    with connection:
+                        # A client that never sends its request mustn't hold up the rest
+                        connection.settimeout(naruto.client.HANDSHAKE_TIMEOUT)
+                        self._handle(connection)
+        finally:
+            mountinfo.close()
+            self._listener.close()
+            try:
+                os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+            DEV_LOGGER.info('Stopped listening on %s', self.socket_path)
+
+    def _handle(self, connection):
+        try:
+            if not self._is_allowed(connection):
+                DEV_LOGGER.warning('Refused connection from another user')
+                naruto.client.send_frame(
+                    connection, naruto.client.STDERR, b'Permission denied\n')
+                naruto.client.send_frame(
+                    connection, naruto.client.EXIT, naruto.client.pack_int(1))
+                return
+
+            naruto.client.send_frame(connection, naruto.client.READY)
+            channel, payload = naruto.client.recv_frame(connection)
+            if channel != naruto.client.REQUEST:
+                raise naruto.client.ProtocolError('Expected request but got {!r}'.format(channel))
+            request = json.loads(payload.decode('utf-8'))
+            # Prompts wait on the user
+            connection.settimeout(None)
+            DEV_LOGGER.debug('Running %r', request['argv'])
+            exit_code = self._run(connection, request)
+            naruto.client.send_frame(
+                connection, naruto.client.EXIT, naruto.client.pack_int(exit_code))
+        except (OSError, naruto.client.ProtocolError) as error:
+            DEV_LOGGER.warning('Lost client: %s', error)
+
+    def _run(self, connection, request):
+        '''
+        Run one command line as if in the client's process. Returns exit code.
+        '''
+        stdin = io.TextIOWrapper(io.BufferedReader(_SocketReader(connection)), encoding='utf-8')
+        stdout = io.TextIOWrapper(
+            io.BufferedWriter(_SocketWriter(connection, naruto.client.STDOUT)), encoding='utf-8')
+        stderr = io.TextIOWrapper(
+            io.BufferedWriter(_SocketWriter(connection, naruto.client.STDERR)), encoding='utf-8')
+
+        saved_streams = sys.stdin, sys.stdout, sys.stderr
+        saved_cwd = os.getcwd()
+        saved_env = dict(
+            (key, value) for key, value in os.environ.items()
+            if key.startswith(naruto.client.FORWARD_ENV_PREFIX))
+        root_logger = logging.getLogger()
+        saved_handlers = root_logger.handlers[:]
+        saved_level = root_logger.level
+        saved_catalog = naruto.catalog.set_catalog(None)
+
+        # Let the command set up logging to the client's stderr
+        root_logger.handlers = []
+        for key in saved_env:
+            del os.environ[key]
+        os.environ.update(request['env'])
+        sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+        try:
+            os.chdir(request['cwd'])
+            try:
+                self._cli.main(args=request['argv'], prog_name='naruto')
+                exit_code = 0
+            except SystemExit as error:
+                exit_code = _exit_code(error)
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+            stdout.flush()
+            stderr.flush()
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = saved_streams
+            os.chdir(saved_cwd)
+            for key in request['env']:
+                del os.environ[key]
+            os.environ.update(saved_env)
+            root_logger.handlers = saved_handlers
+            root_logger.setLevel(saved_level)
+            catalog = naruto.catalog.set_catalog(saved_catalog)
+            if catalog is not None:
+                catalog.close()
+        return exit_code
+
+
+def run_daemon(socket_path, cli):
+    '''
+    Serve cli on socket_path until SIGTERM or SIGINT
+    '''
+    daemon = NarutoDaemon(socket_path, cli)
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda *_: daemon.stop())
+    daemon.serve_forever()
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Deduplicate identical files in read only layers of a tree.
+
+Files are hashed and linked to a content addressed object store kept in the root layer. Only
+read only layers are touched. Their contents never change, so sharing an inode between layers
+is safe.
+"""
+import concurrent.futures
+import contextlib
+import errno
+import fcntl
+import logging
+import os
+import stat
+import uuid
+
+import naruto.diff
+import naruto.layer
+import naruto.metadata
+import naruto.usage
+import naruto.walk
+from naruto.parallel import DEFAULT_PARALLELISM
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+OBJECTS_SUBDIR = 'objects'
+HASH_CACHE_NAME = 'naruto_hashes.sqlite'
+DEFAULT_MIN_SIZE = 4096
+# From linux/fs.h
+FICLONE = 0x40049409
+
+HASH_CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hashes (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    seen INTEGER NOT NULL,
+    PRIMARY KEY (device, inode)
+);
+'''
+
+
+class HashCache(object):
+    '''
+    sha256 of files keyed by inode, only trusted while mtime and size are unchanged
+    '''
+    def __init__(self, db_path):
+        import sqlite3
+        self._connection = sqlite3.connect(str(db_path))
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript(HASH_CACHE_SCHEMA)
+        self._run = self._connection.execute(
+            'SELECT COALESCE(MAX(seen), 0) + 1 FROM hashes').fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+    def get(self, file_stat):
+        '''
+        Get cached digest for file, or None
+        '''
+        row = self._connection.execute(
+            'SELECT digest FROM hashes '
+            'WHERE device = ? AND inode = ? AND mtime_ns = ? AND size = ?',
+            (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns,
+             file_stat.st_size)).fetchone()
+        if row is None:
+            return None
+        self._connection.execute(
+            'UPDATE hashes SET seen = ? WHERE device = ? AND inode = ?',
+            (self._run, file_stat.st_dev, file_stat.st_ino))
+        return row[0]
+
+    def set(self, file_stat, digest):
+        self._connection.execute(
+            'INSERT OR REPLACE INTO hashes '
+            '(device, inode, mtime_ns, size, digest, seen) VALUES (?, ?, ?, ?, ?, ?)',
+            (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size,
+             digest, self._run))
+
+    def commit(self, prune=False):
+        '''
+        Save changes. With prune=True forget files not seen in this run.
+        '''
+        if prune:
+            self._connection.execute('DELETE FROM hashes WHERE seen != ?', (self._run,))
+        self._connection.commit()
+
+
+class DedupeResult(object):
+    '''
+    What a dedupe pass did
+    '''
+    def __init__(self):
+        self.scanned = 0
+        self.hashed = 0
+        self.linked = 0
+        self.bytes_saved = 0
+        self.objects_removed = 0
+
+    def __repr__(self):
+        return (
+            '{self.__class__.__name__}(scanned={self.scanned!r}, hashed={self.hashed!r}, '
+            'linked={self.linked!r}, bytes_saved={self.bytes_saved!r}, '
+            'objects_removed={self.objects_removed!r})'.format(self=self))
+
+
+def _copy_owner(source_stat, destination):
+    try:
+        os.chown(destination, source_stat.st_uid, source_stat.st_gid)
+    except PermissionError:
+        pass
+
+
+def reflink(source, destination):
+    '''
+    Create destination sharing the data blocks of source. Only some filesystems support it.
+    '''
+    with open(source, 'rb') as source_file:
+        with open(destination, 'xb') as destination_file:
+            try:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+            except BaseException:
+                os.unlink(destination)
+                raise
+
+
+class Deduplicator(object):
+    '''
+    Link identical files in read only layers of a tree to a shared object store in the root.
+
+    Hard linked duplicates take on the timestamps of the first copy seen. With use_reflink=True
+    files are reflinked instead, so each keeps its own inode and timestamps.
+    '''
+    def __init__(self, tree, use_reflink=False, min_size=DEFAULT_MIN_SIZE, parallelism=None):
+        self._tree = tree
+        self._use_reflink = use_reflink
+        self._min_size = min_size
+        self._parallelism = DEFAULT_PARALLELISM if parallelism is None else parallelism
+        self._objects_dir = tree.root.path / OBJECTS_SUBDIR
+
+    def _scan(self, directory, node, files):
+        sub_directories = []
+        for entry in naruto.walk.scan_directory(directory):
+            if entry.is_dir(follow_symlinks=False):
+                sub_directories.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                file_stat = entry.stat(follow_symlinks=False)
+                if file_stat.st_size >= self._min_size:
+                    files.append((node, entry.path, file_stat))
+        return sub_directories
+
+    def _iter_files(self):
+        '''
+        Iterate over (node, path, stat) of files worth deduplicating in read only layers
+        '''
+        for node in self._tree:
+            if not node.read_only:
+                continue
+            files = []
+            naruto.walk.walk_parallel(
+                node.contents_path,
+                lambda directory: self._scan(directory, node, files),
+                parallelism=self._parallelism)
+            yield from files
+
+    def _object_path(self, digest, file_stat):
+        # Hard links share permissions and owner too so they have to match as well
+        name = '{}.{:o}.{}.{}'.format(
+            digest, stat.S_IMODE(file_stat.st_mode), file_stat.st_uid, file_stat.st_gid)
+        return self._objects_dir / digest[:2] / name
+
+    def _store(self, path, object_path):
+        '''
+        Make path the object. Returns False if something else got there first.
+        '''
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            if self._use_reflink:
+                reflink(path, str(object_path))
+            else:
+                os.link(path, str(object_path))
+        except FileExistsError:
+            return False
+        return True
+
+    def _replace(self, path, file_stat, object_path):
+        '''
+        Atomically replace path with a link to object_path
+        '''
+        directory, name = os.path.split(path)
+        temp_path = os.path.join(directory, '.{}.{}'.format(name, uuid.uuid4().hex))
+        if self._use_reflink:
+            import shutil
+            reflink(str(object_path), temp_path)
+            shutil.copystat(path, temp_path)
+            _copy_owner(file_stat, temp_path)
+        else:
+            os.link(str(object_path), temp_path)
+        try:
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def _prune_objects(self, result, used_objects):
+        '''
+        Remove objects no file uses any more
+        '''
+        for object_path in self._objects_dir.glob('*/*'):
+            if self._use_reflink:
+                # Reflinks don't show up in the link count
+                unused = object_path not in used_objects
+            else:
+                unused = object_path.stat().st_nlink == 1
+            if unused:
+                object_path.unlink()
+                result.objects_removed += 1
+
+    def run(self):
+        '''
+        Deduplicate the tree. Returns DedupeResult.
+        '''
+        result = DedupeResult()
+        self._objects_dir.mkdir(exist_ok=True)
+        hash_cache = HashCache(self._tree.root.path / HASH_CACHE_NAME)
+
+        with contextlib.closing(hash_cache), \
+                naruto.metadata.lock_file(self._objects_dir), \
+                concurrent.futures.ThreadPoolExecutor(self._parallelism) as executor:
+            to_hash = []
+            known = []
+            for node, path, file_stat in self._iter_files():
+                result.scanned += 1
+                digest = hash_cache.get(file_stat)
+                if digest is None:
+                    to_hash.append((node, path, file_stat))
+                else:
+                    known.append((node, path, file_stat, digest, True))
+
+            DEV_LOGGER.info('Hashing %d of %d files', len(to_hash), result.scanned)
+            digests = executor.map(lambda item: naruto.diff.hash_file(item[1]), to_hash)
+            for (node, path, file_stat), digest in zip(to_hash, digests):
+                hash_cache.set(file_stat, digest)
+                known.append((node, path, file_stat, digest, False))
+                result.hashed += 1
+
+            used_objects = set()
+            changed_nodes = set()
+            for node, path, file_stat, digest, cached in known:
+                object_path = self._object_path(digest, file_stat)
+                used_objects.add(object_path)
+                if cached and self._use_reflink:
+                    # Already dealt with in an earlier run
+                    continue
+
+                try:
+                    object_stat = object_path.stat()
+                except FileNotFoundError:
+                    if self._store(path, object_path):
+                        continue
+                    object_stat = object_path.stat()
+
+                if (object_stat.st_dev, object_stat.st_ino) == (
+                        file_stat.st_dev, file_stat.st_ino):
+                    continue
+
+                try:
+                    self._replace(path, file_stat, object_path)
+                except OSError as error:
+                    if error.errno not in (errno.EXDEV, errno.EMLINK, errno.EOPNOTSUPP):
+                        raise
+                    DEV_LOGGER.warning('Unable to link %s: %s', path, error)
+                    continue
+                # Path is a new inode now so remember its hash too
+                hash_cache.set(os.stat(path), digest)
+
+                if self._use_reflink or file_stat.st_nlink == 1:
+                    # Otherwise another name still holds the old copy
+                    result.bytes_saved += file_stat.st_size
+                result.linked += 1
+                changed_nodes.add(node)
+
+            for node in changed_nodes:
+                # Cached usage is keyed on the contents directory which may not have changed
+                with naruto.metadata.update_metadata(
+                        node.path / naruto.layer.METADATA_NAME) as metadata:
+                    metadata.pop(naruto.usage.USAGE_KEY, None)
+
+            hash_cache.commit(prune=True)
+            self._prune_objects(result, used_objects)
+
+        DEV_LOGGER.info('Dedupe done: %r', result)
+        return result
+
+
+def dedupe_tree(tree, use_reflink=False, min_size=DEFAULT_MIN_SIZE, parallelism=None):
+    '''
+    Deduplicate files in read only layers of a LayerTree
+    '''
+    return Deduplicator(
+        tree, use_reflink=use_reflink, min_size=min_size, parallelism=parallelism).run()
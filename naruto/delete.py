@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Delete layers quickly.
+
+A layer is first renamed into a trash directory, which removes it from the tree at once, and the
+space is then reclaimed by several threads. Reclaiming can also be left to a background process:
+
+    python -m naruto.delete <trash path>...
+"""
+import logging
+import os
+import pathlib
+import sys
+import threading
+import time
+import uuid
+
+import naruto.walk
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+TRASH_SUBDIR = 'trash'
+ROOT_TRASH_PREFIX = '.naruto-trash-'
+PROGRESS_INTERVAL = 1.0
+
+
+class DeleteProgress(object):
+    '''
+    Counts of what's been removed, safe to update from several threads
+    '''
+    def __init__(self, callback=None, interval=PROGRESS_INTERVAL):
+        self.files = 0
+        self.directories = 0
+        self._callback = callback
+        self._interval = interval
+        self._start = time.monotonic()
+        self._last_report = self._start
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (
+            '{self.__class__.__name__}(files={self.files!r}, '
+            'directories={self.directories!r})'.format(self=self))
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self._start
+
+    @property
+    def rate(self):
+        '''
+        Entries removed per second
+        '''
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0.0
+        return (self.files + self.directories) / elapsed
+
+    def add(self, files=0, directories=0):
+        with self._lock:
+            self.files += files
+            self.directories += directories
+            now = time.monotonic()
+            if self._callback is None or now - self._last_report < self._interval:
+                return
+            self._last_report = now
+        self._callback(self)
+
+    def finish(self):
+        if self._callback is not None:
+            self._callback(self)
+
+
+def get_trash_dir(layer):
+    '''
+    Get directory a layer is moved to when deleted.
+
+    Layers are moved to the trash of their root so the rename never crosses a filesystem.
+    Roots are moved next to themselves.
+    '''
+    if layer.is_root:
+        return layer.path.parent / '{}{}'.format(ROOT_TRASH_PREFIX, layer.layer_id)
+    return _trash_path(layer.get_root().path, layer.layer_id)
+
+
+def _trash_path(root_dir, name):
+    return pathlib.Path(root_dir) / TRASH_SUBDIR / '{}-{}'.format(name, uuid.uuid4().hex)
+
+
+def _move(path, trash_path):
+    trash_path.parent.mkdir(exist_ok=True)
+    path.rename(trash_path)
+    DEV_LOGGER.debug('Moved %s to %s', path, trash_path)
+    return trash_path
+
+
+def move_to_trash(layer):
+    '''
+    Rename layer out of its tree. Returns where it was moved to.
+    '''
+    return _move(layer.path, get_trash_dir(layer))
+
+
+def move_layers_to_trash(root_dir, name, layer_dirs):
+    '''
+    Rename several layer directories into one trash directory of root_dir. Returns the trash
+    directory.
+
+    Used for the flat layout where descendants aren't inside their parent. The first layer
+    is moved first so anything left behind by an interruption is unreachable.
+    '''
+    trash_path = _trash_path(root_dir, name)
+    trash_path.mkdir(parents=True)
+    for layer_dir in layer_dirs:
+        layer_dir = pathlib.Path(layer_dir)
+        _move(layer_dir, trash_path / layer_dir.name)
+    return trash_path
+
+
+def move_path_to_trash(root_dir, path):
+    '''
+    Rename anything inside the tree of root_dir to its trash. Returns where it was moved to.
+    '''
+    path = pathlib.Path(path)
+    return _move(path, _trash_path(root_dir, path.name.lstrip('.')))
+
+
+def _unlink_files(directory, progress):
+    '''
+    Remove everything but sub directories from directory. Returns the sub directories.
+    '''
+    sub_directories = []
+    removed = 0
+    for entry in naruto.walk.scan_directory(directory):
+        if entry.is_dir(follow_symlinks=False):
+            sub_directories.append(entry.path)
+            continue
+        try:
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            continue
+        removed += 1
+    progress.add(files=removed)
+    return sub_directories
+
+
+def reclaim(path, parallelism=None, progress=None):
+    '''
+    Remove path and everything below it using several threads
+    '''
+    if progress is None:
+        progress = DeleteProgress()
+    path = pathlib.Path(path)
+
+    if not os.path.lexists(str(path)):
+        DEV_LOGGER.debug('%s has already gone', path)
+        progress.finish()
+        return progress
+    if path.is_symlink() or not path.is_dir():
+        path.unlink()
+        progress.add(files=1)
+        progress.finish()
+        return progress
+
+    directories = naruto.walk.walk_parallel(
+        path, lambda directory: _unlink_files(directory, progress), parallelism=parallelism)
+
+    # Children always come after their parents so remove in reverse
+    for directory in reversed(directories):
+        try:
+            os.rmdir(directory)
+        except FileNotFoundError:
+            continue
+        progress.add(directories=1)
+
+    progress.finish()
+    DEV_LOGGER.info(
+        'Removed %s: %d files and %d directories in %.1fs',
+        path, progress.files, progress.directories, progress.elapsed)
+    return progress
+
+
+def reclaim_in_background(paths):
+    '''
+    Start a detached process to reclaim paths. Returns the process.
+    '''
+    import subprocess
+    return subprocess.Popen(
+        [sys.executable, '-m', 'naruto.delete'] + [str(path) for path in paths],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True)
+
+
+def iter_trash(root_dir):
+    '''
+    Iterate over leftover trash of a root layer and its tree, and of deleted roots next to it
+    '''
+    root_dir = pathlib.Path(root_dir)
+    trash_dir = root_dir / TRASH_SUBDIR
+    if trash_dir.is_dir():
+        yield from trash_dir.iterdir()
+    for path in root_dir.parent.iterdir():
+        if path.name.startswith(ROOT_TRASH_PREFIX):
+            yield path
+
+
+def main(argv=None):
+    '''
+    Reclaim trash paths given on the command line
+    '''
+    if argv is None:
+        argv = sys.argv[1:]
+    logging.basicConfig(level=logging.WARNING)
+    for path in argv:
+        try:
+            reclaim(path)
+        except FileNotFoundError:
+            DEV_LOGGER.warning('%s already removed', path)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,6 @@ Library for doing quick semi-automated demo's of functionality
 import logging
 import subprocess
 import click
-import ipdb
 
 DEV_LOGGER = logging.getLogger(__name__)
 
@@ -37,7 +36,12 @@ class DemoContext(object):
             if user_input == 'y':
                 return
             elif user_input == 'i':
-                ipdb.set_trace()
+                try:
+                    import ipdb as debugger
+                except ImportError:
+                    # ipdb is only installed with the demo extra
+                    import pdb as debugger
+                debugger.set_trace()
                 return
             else:
                 click.confirm(abort=True)
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the merged view of two branch stacks without mounting either.
+
+Only the branches that aren't shared by both stacks are walked. Shared branches are only
+looked at for specific paths, so a layer's changes can be found without reading its ancestors.
+"""
+import collections
+import logging
+import os
+import stat
+
+import naruto.walk
+from naruto.aufs import OPAQUE_MARKER, WHITEOUT_META_PREFIX, WHITEOUT_PREFIX
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+ADDED = 'A'
+MODIFIED = 'M'
+DELETED = 'D'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+DiffEntry = collections.namedtuple('DiffEntry', ('change', 'path', 'is_dir'))
+DiffEntry.__doc__ = '''
+Single change. path is relative to the top of the branches and uses / as separator.
+'''
+
+_Found = collections.namedtuple('_Found', ('path', 'stat'))
+
+
+def _scan_branches(directories):
+    '''
+    Scan the same directory in several branches, top branch first.
+
+    Returns list of (directory, {name: DirEntry or None for a whiteout}) and whether branches
+    below are still visible. Scanning stops at the first directory marked opaque.
+    '''
+    scans = []
+    for directory in directories:
+        names = {}
+        opaque = False
+        for entry in naruto.walk.scan_directory(directory):
+            if entry.name == OPAQUE_MARKER:
+                opaque = True
+            elif entry.name.startswith(WHITEOUT_META_PREFIX):
+                continue
+            elif entry.name.startswith(WHITEOUT_PREFIX):
+                names[entry.name[len(WHITEOUT_PREFIX):]] = None
+            else:
+                names[entry.name] = entry
+        scans.append((directory, names))
+        if opaque:
+            return scans, False
+    return scans, True
+
+
+def _merge_scans(scans):
+    '''
+    Get {name: DirEntry or None for a whiteout} as seen from the top of scans
+    '''
+    merged = {}
+    for _directory, names in scans:
+        for name, entry in names.items():
+            merged.setdefault(name, entry)
+    return merged
+
+
+def _sub_directories(scans, name):
+    '''
+    Get branch directories that make up sub directory name, and whether branches below scans
+    can add to it
+    '''
+    directories = []
+    for directory, names in scans:
+        entry = names.get(name, False)
+        if entry is False:
+            continue
+        if entry is None or not entry.is_dir(follow_symlinks=False):
+            # Whiteout or file hides everything below
+            return directories, False
+        directories.append(entry.path)
+    return directories, True
+
+
+class _Side(object):
+    '''
+    One directory as seen through the branches not shared with the other stack
+    '''
+    def __init__(self, directories, reaches_shared):
+        self.scans, self.reaches_shared = _scan_branches(directories)
+        self.reaches_shared = reaches_shared and self.reaches_shared
+        self.entries = _merge_scans(self.scans)
+
+    def sub_directory(self, name):
+        directories, reaches_shared = _sub_directories(self.scans, name)
+        return directories, self.reaches_shared and reaches_shared
+
+
+class _Shared(object):
+    '''
+    One directory in the branches shared by both stacks. Only looked up by name, never walked,
+    unless one side can see it and the other can't.
+    '''
+    def __init__(self, directories):
+        self.directories = []
+        for directory in directories:
+            self.directories.append(directory)
+            if os.path.lexists(os.path.join(directory, OPAQUE_MARKER)):
+                break
+
+    def lookup(self, name):
+        for directory in self.directories:
+            path = os.path.join(directory, name)
+            try:
+                return _Found(path, os.lstat(path))
+            except FileNotFoundError:
+                pass
+            if os.path.lexists(os.path.join(directory, WHITEOUT_PREFIX + name)):
+                return None
+        return None
+
+    def names(self):
+        return _merge_scans(_scan_branches(self.directories)[0])
+
+    def sub_directory(self, name):
+        directories = []
+        for directory in self.directories:
+            path = os.path.join(directory, name)
+            try:
+                path_stat = os.lstat(path)
+            except FileNotFoundError:
+                if os.path.lexists(os.path.join(directory, WHITEOUT_PREFIX + name)):
+                    break
+                continue
+            if not stat.S_ISDIR(path_stat.st_mode):
+                break
+            directories.append(path)
+        return directories
+
+
+def _resolve(side, shared, name):
+    if name in side.entries:
+        entry = side.entries[name]
+        if entry is None:
+            return None
+        return _Found(entry.path, entry.stat(follow_symlinks=False))
+    if side.reaches_shared:
+        return shared.lookup(name)
+    return None
+
+
+def hash_file(path):
+    '''
+    Get sha256 hex digest of file contents
+    '''
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, 'rb') as data_file:
+        for chunk in iter(lambda: data_file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _differs(old, new, hash_contents):
+    '''
+    Compare two non directories. Size and mtime are used unless hash_contents is True.
+    '''
+    if old.path == new.path:
+        return False
+    if (old.stat.st_dev, old.stat.st_ino) == (new.stat.st_dev, new.stat.st_ino):
+        # Hard linked, e.g. by squash
+        return False
+    if old.stat.st_mode != new.stat.st_mode:
+        return True
+
+    if stat.S_ISLNK(old.stat.st_mode):
+        return os.readlink(old.path) != os.readlink(new.path)
+    if stat.S_ISREG(old.stat.st_mode):
+        if old.stat.st_size != new.stat.st_size:
+            return True
+        if hash_contents:
+            return hash_file(old.path) != hash_file(new.path)
+        return old.stat.st_mtime_ns != new.stat.st_mtime_ns
+    return old.stat.st_rdev != new.stat.st_rdev
+
+
+def _split_shared(branches, base_branches):
+    '''
+    Split off bottom branches shared by both stacks
+    '''
+    shared = 0
+    while (shared < min(len(branches), len(base_branches)) and
+           branches[-1 - shared] == base_branches[-1 - shared]):
+        shared += 1
+    split = lambda stack: (stack[:len(stack) - shared], stack[len(stack) - shared:])
+    own, shared_branches = split(branches)
+    base_own, _ = split(base_branches)
+    return own, base_own, shared_branches
+
+
+def diff_branches(branches, base_branches, hash_contents=False):
+    '''
+    Yield DiffEntry for each difference going from base_branches to branches.
+
+    Both are lists of branch directories, top first, as they would be mounted. Entries are
+    yielded as they're found, one directory at a time in sorted order. New and removed
+    directories are reported once rather than with all their contents.
+    '''
+    branches = [str(branch) for branch in branches]
+    base_branches = [str(branch) for branch in base_branches]
+    own, base_own, shared_branches = _split_shared(branches, base_branches)
+    DEV_LOGGER.debug(
+        'Comparing %d and %d branches above %d shared branches',
+        len(own), len(base_own), len(shared_branches))
+
+    stack = [('', (own, True), (base_own, True), shared_branches)]
+    while stack:
+        relative_dir, (own_dirs, reaches), (base_dirs, base_reaches), shared_dirs = stack.pop()
+        new = _Side(own_dirs, reaches)
+        old = _Side(base_dirs, base_reaches)
+        shared = _Shared(shared_dirs)
+
+        names = set(new.entries) | set(old.entries)
+        if new.reaches_shared != old.reaches_shared:
+            # One side can see shared names the other can't
+            names.update(shared.names())
+
+        sub_directories = []
+        for name in sorted(names):
+            path = relative_dir + name
+            new_found = _resolve(new, shared, name)
+            old_found = _resolve(old, shared, name)
+            new_is_dir = new_found is not None and stat.S_ISDIR(new_found.stat.st_mode)
+            old_is_dir = old_found is not None and stat.S_ISDIR(old_found.stat.st_mode)
+
+            if new_found is None and old_found is None:
+                continue
+            elif old_found is None:
+                yield DiffEntry(ADDED, path, new_is_dir)
+            elif new_found is None:
+                yield DiffEntry(DELETED, path, old_is_dir)
+            elif new_is_dir and old_is_dir:
+                new_sub = new.sub_directory(name)
+                old_sub = old.sub_directory(name)
+                if new_sub[0] or old_sub[0] or new_sub[1] != old_sub[1]:
+                    sub_directories.append((path + '/', new_sub, old_sub, shared, name))
+            elif new_is_dir or old_is_dir:
+                yield DiffEntry(DELETED, path, old_is_dir)
+                yield DiffEntry(ADDED, path, new_is_dir)
+            elif _differs(old_found, new_found, hash_contents):
+                yield DiffEntry(MODIFIED, path, False)
+
+        for path, new_sub, old_sub, shared, name in reversed(sub_directories):
+            shared_sub = shared.sub_directory(name) if new_sub[1] or old_sub[1] else []
+            stack.append((path, new_sub, old_sub, shared_sub))
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Find and remove garbage in a layer tree
+"""
+import collections
+import fnmatch
+import logging
+import os
+import time
+
+import naruto.aufs
+import naruto.delete
+import naruto.layer
+import naruto.scratch
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+# Creates taking longer than this are assumed to have been interrupted
+INCOMPLETE_GRACE = 60 * 60
+
+MALFORMED = 'malformed'
+INCOMPLETE = 'incomplete'
+ORPHANED = 'orphaned'
+TRASH = 'trash'
+EMPTY_LEAF = 'empty leaf'
+EXPIRED = 'expired'
+
+Garbage = collections.namedtuple('Garbage', ('reason', 'path', 'node'))
+Garbage.__doc__ = '''
+Something to remove. node is the LayerNode for layers and None for anything else.
+'''
+
+
+class ExpiryPolicy(object):
+    '''
+    Expire layers with tags matching tag_pattern.
+
+    For each matching tag only the keep newest layers are kept, and only if they're younger
+    than max_age seconds. A layer is kept if any of its matching tags keeps it.
+    '''
+    def __init__(self, tag_pattern, max_age=None, keep=None):
+        self.tag_pattern = tag_pattern
+        self.max_age = max_age
+        self.keep = keep
+
+    def __repr__(self):
+        return (
+            '{self.__class__.__name__}({self.tag_pattern!r}, max_age={self.max_age!r}, '
+            'keep={self.keep!r})'.format(self=self))
+
+    def find_expired(self, nodes, now=None):
+        '''
+        Get set of nodes that have expired
+        '''
+        if now is None:
+            now = time.time()
+
+        by_tag = collections.defaultdict(list)
+        for node in nodes:
+            for tag in node.tags:
+                if fnmatch.fnmatchcase(tag, self.tag_pattern):
+                    by_tag[tag].append(node)
+
+        candidates = set()
+        kept = set()
+        for tag_nodes in by_tag.values():
+            tag_nodes.sort(key=_created, reverse=True)
+            for index, node in enumerate(tag_nodes):
+                candidates.add(node)
+                too_many = self.keep is not None and index >= self.keep
+                too_old = self.max_age is not None and now - _created(node) > self.max_age
+                if not too_many and not too_old:
+                    kept.add(node)
+
+        return candidates - kept
+
+
+def _created(node):
+    created = node.metadata.get('created')
+    if created is None:
+        created = os.stat(str(node.path / naruto.layer.METADATA_NAME)).st_mtime
+    return created
+
+
+def _is_mounted(node, mount_table):
+    return bool(mount_table.find_branches(node.branch_path))
+
+
+def _find_mounted_paths(mount_table):
+    '''
+    Get list of (path, AUFSMountBranch) for every mounted branch, with the layer directory of
+    scratch branches too
+    '''
+    mounted_paths = []
+    for aufs_mount in mount_table.aufs_mounts:
+        for branch in aufs_mount.branches:
+            mounted_paths.append((branch.path, branch))
+            layer_dir = naruto.scratch.find_layer_dir(branch.path.parent)
+            if layer_dir != branch.path.parent:
+                mounted_paths.append((layer_dir, branch))
+    return mounted_paths
+
+
+def _find_mount_under(path, mounted_paths):
+    for mounted_path, branch in mounted_paths:
+        if mounted_path == path or path in mounted_path.parents:
+            return branch
+    return None
+
+
+def count_layers(path):
+    '''
+    Count layer directories at or below path, even in a directory that isn't a layer itself
+    '''
+    count = 0
+    for directory, subdirs, files in os.walk(str(path)):
+        if naruto.layer.METADATA_NAME in files:
+            count += 1
+        # Nothing in a layer's own files is another layer
+        subdirs[:] = [
+            subdir for subdir in subdirs
+            if subdir not in (naruto.layer.CONTENTS_SUBDIR, naruto.layer.SQUASHED_SUBDIR)]
+    return count
+
+
+def _is_empty(directory):
+    with os.scandir(str(directory)) as entries:
+        return next(entries, None) is None
+
+
+def find_garbage(tree, empty_leaves=False, policies=(), now=None):
+    '''
+    Iterate over Garbage in a LayerTree.
+
+    Malformed layer directories, interrupted creates, layers whose parent has gone and leftover
+    trash are always found unless something at or below them is mounted, which is logged.
+    Unmounted leaves with no contents are found if empty_leaves is True. Layers expired by any
+    of policies are found too, but only if they are unmounted leaves as removing anything else
+    would take its descendants with it. The root is never garbage.
+    '''
+    if now is None:
+        now = time.time()
+
+    mount_table = naruto.aufs.get_mount_table()
+    mounted_paths = _find_mounted_paths(mount_table)
+
+    def unmounted(reason, paths):
+        for path in paths:
+            branch = _find_mount_under(path, mounted_paths)
+            if branch is None:
+                yield path
+            else:
+                DEV_LOGGER.warning(
+                    'Skipping %s %s as %s is mounted at %s',
+                    reason, path, branch.path, branch.mount_point)
+
+    for path in unmounted(MALFORMED, tree.malformed):
+        yield Garbage(MALFORMED, path, None)
+
+    for path in unmounted(INCOMPLETE, tree.incomplete):
+        try:
+            if now - path.stat().st_mtime > INCOMPLETE_GRACE:
+                yield Garbage(INCOMPLETE, path, None)
+        except FileNotFoundError:
+            continue
+
+    for path in unmounted(ORPHANED, tree.orphaned):
+        yield Garbage(ORPHANED, path, None)
+
+    for path in naruto.delete.iter_trash(tree.root.path):
+        yield Garbage(TRASH, path, None)
+
+    removable = [
+        node for node in tree
+        if not node.is_root and not node.children and not _is_mounted(node, mount_table)]
+
+    expired = set()
+    for policy in policies:
+        expired.update(policy.find_expired(tree, now=now))
+
+    for node in removable:
+        if node in expired:
+            yield Garbage(EXPIRED, node.path, node)
+        elif empty_leaves and _is_empty(node.branch_path):
+            yield Garbage(EMPTY_LEAF, node.path, node)
+
+
+def collect_garbage(tree, garbage, parallelism=None, progress=None):
+    '''
+    Remove garbage found by find_garbage.
+
+    Everything is moved out of the tree first, then the space is reclaimed.
+    '''
+    if progress is None:
+        progress = naruto.delete.DeleteProgress()
+
+    to_reclaim = []
+    for item in garbage:
+        try:
+            if item.node is not None:
+                # Keeps index and catalog up to date
+                to_reclaim.append(item.node.get_layer().move_to_trash())
+            elif item.reason == TRASH:
+                to_reclaim.append(item.path)
+            else:
+                if item.reason == MALFORMED:
+                    DEV_LOGGER.warning(
+                        'Removing malformed %s with %d layers in it',
+                        item.path, count_layers(item.path))
+                to_reclaim.append(naruto.delete.move_path_to_trash(tree.root.path, item.path))
+        except FileNotFoundError:
+            DEV_LOGGER.debug('%s has already gone', item.path)
+
+    for path in to_reclaim:
+        try:
+            naruto.delete.reclaim(path, parallelism=parallelism, progress=progress)
+        except FileNotFoundError:
+            DEV_LOGGER.debug('%s has already gone', path)
+
+    return progress
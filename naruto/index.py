@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent lookup index for finding layers by tag or layer id
+"""
+import contextlib
+import logging
+import pathlib
+
+import naruto.layer
+import naruto.metadata
+import naruto.tree
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+INDEX_NAME = 'naruto_index.json'
+INDEX_VERSION = 1
+
+
+class LayerIndex(object):
+    '''
+    Index of tag -> layer ids and layer id -> path relative to the root layer.
+
+    Stored as INDEX_NAME in the root layer directory. The index is only ever a cache of what
+    is in the layer metadata so it can be thrown away and rebuilt at any point.
+    '''
+    def __init__(self, root_dir):
+        self._root_dir = pathlib.Path(root_dir)
+        self._index_path = self._root_dir / INDEX_NAME
+
+    def __repr__(self):
+        return (
+            '{self.__class__.__module__}.{self.__class__.__name__}'
+            '({self._root_dir!r})'.format(
+                self=self))
+
+    @property
+    def path(self):
+        return self._index_path
+
+    def _read(self):
+        '''
+        Read index. Returns None if it's missing or from another version.
+        '''
+        try:
+            index = naruto.metadata.read_metadata(self._index_path)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if index.get('version') != INDEX_VERSION:
+            return None
+        return index
+
+    def _load(self):
+        '''
+        Load index, building it if it doesn't exist. Only call with the index locked.
+        '''
+        index = self._read()
+        if index is None:
+            index = self._rebuild()
+        return index
+
+    def _save(self, index):
+        naruto.metadata.write_metadata(self._index_path, index)
+
+    @contextlib.contextmanager
+    def _update(self):
+        '''
+        Locked load, modify and save so concurrent changes aren't lost
+        '''
+        with naruto.metadata.lock_file(self._index_path):
+            index = self._load()
+            yield index
+            self._save(index)
+
+    @staticmethod
+    def _add_tags(index, layer_id, tags):
+        for tag in tags:
+            layer_ids = index['tags'].setdefault(tag, [])
+            if layer_id not in layer_ids:
+                layer_ids.append(layer_id)
+
+    @staticmethod
+    def _remove_layer_ids(index, layer_ids):
+        for layer_id in layer_ids:
+            index['layers'].pop(layer_id, None)
+
+        for tag in tuple(index['tags']):
+            remaining = [
+                layer_id for layer_id in index['tags'][tag] if layer_id not in layer_ids]
+            if remaining:
+                index['tags'][tag] = remaining
+            else:
+                del index['tags'][tag]
+
+    def _build(self, tree):
+        index = {'version': INDEX_VERSION, 'layers': {}, 'tags': {}}
+        for node in tree:
+            index['layers'][node.layer_id] = node.path.relative_to(self._root_dir).as_posix()
+            self._add_tags(index, node.layer_id, sorted(node.tags))
+        return index
+
+    def _rebuild(self, tree=None):
+        DEV_LOGGER.info('Rebuilding layer index in %r', self._index_path)
+        if tree is None:
+            tree = naruto.tree.LayerTree(self._root_dir)
+        index = self._build(tree)
+        self._save(index)
+        return index
+
+    def rebuild(self, tree=None):
+        '''
+        Rebuild whole index from the layers on disk
+        '''
+        # Layers added while the tree is read would be lost otherwise
+        with naruto.metadata.lock_file(self._index_path):
+            return self._rebuild(tree)
+
+    def check(self, tree=None):
+        '''
+        Compare index with layers on disk. Return list of problems found.
+        '''
+        if tree is None:
+            tree = naruto.tree.LayerTree(self._root_dir)
+
+        try:
+            index = naruto.metadata.read_metadata(self._index_path)
+        except (FileNotFoundError, ValueError) as error:
+            return ['Unable to read index: {}'.format(error)]
+
+        expected = self._build(tree)
+        problems = []
+
+        if index.get('version') != INDEX_VERSION:
+            problems.append('Unexpected index version {!r}'.format(index.get('version')))
+            return problems
+
+        for key in ('layers', 'tags'):
+            actual = index.get(key, {})
+            for name in sorted(set(actual) | set(expected[key])):
+                actual_value = actual.get(name)
+                expected_value = expected[key].get(name)
+                if key == 'tags':
+                    actual_value = sorted(actual_value or ())
+                    expected_value = sorted(expected_value or ())
+                if actual_value != expected_value:
+                    problems.append('{} entry {!r} is {!r}, expected {!r}'.format(
+                        key, name, actual_value, expected_value))
+
+        return problems
+
+    def _relative_dir(self, layer_dir):
+        return pathlib.Path(layer_dir).relative_to(self._root_dir).as_posix()
+
+    def add_layer(self, layer_dir, tags=()):
+        '''
+        Record new layer
+        '''
+        layer_dir = pathlib.Path(layer_dir)
+        with self._update() as index:
+            index['layers'][layer_dir.name] = self._relative_dir(layer_dir)
+            self._add_tags(index, layer_dir.name, sorted(tags))
+
+    def remove_layer(self, layer_dir):
+        '''
+        Forget layer and all its descendants in the nested layout
+        '''
+        self.remove_layers((layer_dir,))
+
+    def remove_layers(self, layer_dirs):
+        '''
+        Forget layers and everything below their directories
+        '''
+        prefixes = set(
+            pathlib.PurePosixPath(self._relative_dir(layer_dir)) for layer_dir in layer_dirs)
+        with self._update() as index:
+            layer_ids = set(
+                layer_id for layer_id, relative_dir in index['layers'].items()
+                if not prefixes.isdisjoint(
+                    (pathlib.PurePosixPath(relative_dir),) +
+                    tuple(pathlib.PurePosixPath(relative_dir).parents)))
+            self._remove_layer_ids(index, layer_ids)
+
+    def set_tags(self, layer_dir, tags):
+        '''
+        Replace tags recorded for layer
+        '''
+        layer_dir = pathlib.Path(layer_dir)
+        with self._update() as index:
+            self._remove_layer_ids(index, (layer_dir.name,))
+            index['layers'][layer_dir.name] = self._relative_dir(layer_dir)
+            self._add_tags(index, layer_dir.name, sorted(tags))
+
+    def _lookup(self, index, reference):
+        '''
+        Find layer directory in index. Returns None if index doesn't look right and raises
+        KeyError if reference isn't in it.
+        '''
+        layers = index['layers']
+        if reference in layers:
+            layer_dir = self._root_dir / layers[reference]
+            if (layer_dir / naruto.layer.METADATA_NAME).is_file():
+                return layer_dir
+            return None
+
+        layer_ids = index['tags'].get(reference, ())
+        if len(layer_ids) > 1:
+            # Ambiguous tags resolve to the first layer in the tree like they always have
+            return naruto.tree.LayerTree(self._root_dir).find_reference(reference).path
+
+        for layer_id in layer_ids:
+            if layer_id not in layers:
+                return None
+            layer_dir = self._root_dir / layers[layer_id]
+            try:
+                metadata = naruto.metadata.read_metadata(layer_dir / naruto.layer.METADATA_NAME)
+            except (FileNotFoundError, ValueError):
+                return None
+            if reference not in metadata.get('tags', ()):
+                return None
+            return layer_dir
+
+        raise KeyError('Unable to find layer {}'.format(reference))
+
+    def _rebuild_for_lookup(self):
+        '''
+        Rebuild index, only keeping it in memory if the tree can't be written to
+        '''
+        tree = naruto.tree.LayerTree(self._root_dir)
+        try:
+            return self.rebuild(tree)
+        except OSError as error:
+            DEV_LOGGER.debug('Unable to save layer index in %r: %s', self._index_path, error)
+            return self._build(tree)
+
+    def lookup(self, reference):
+        '''
+        Find layer directory for a layer id or tag.
+
+        A missing index, or one pointing at layers that have changed, is rebuilt once before
+        giving up. References that simply aren't in the index aren't looked for on disk.
+        '''
+        index = self._read()
+        layer_dir = None if index is None else self._lookup(index, reference)
+        if layer_dir is None:
+            DEV_LOGGER.debug('Index is missing or stale for %r. Rebuilding.', reference)
+            layer_dir = self._lookup(self._rebuild_for_lookup(), reference)
+
+        if layer_dir is None:
+            raise KeyError('Unable to find layer {}'.format(reference))
+        return layer_dir
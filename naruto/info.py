@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Render a LayerTree for naruto info
+"""
+import json
+import logging
+
+from naruto.traverse import iter_postorder, iter_preorder
+from naruto.usage import format_size
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+HIGHLIGHT = '!!!!'
+
+
+def count_descendants(tree):
+    '''
+    Get dict of node -> number of descendants in one pass over the tree
+    '''
+    counts = {}
+    for node, _ in iter_postorder(tree.root):
+        counts[node] = sum(counts[child] + 1 for child in node)
+    return counts
+
+
+def _format_usage(node, usage):
+    if usage is None:
+        return ''
+    exclusive, total = usage[node]
+    return ', size={}, inodes={}, total_size={}, total_inodes={}'.format(
+        format_size(exclusive.bytes), exclusive.inodes, format_size(total.bytes), total.inodes)
+
+
+def render_text(stream, tree, highlight=(), max_depth=None, usage=None):
+    '''
+    Write tree to stream one line per layer, as it's walked.
+
+    usage is optional output of naruto.usage.get_tree_usage to include sizes.
+    '''
+    counts = count_descendants(tree)
+    highlight = set(highlight)
+
+    for node, depth in iter_preorder(tree.root, max_depth=max_depth):
+        stream.write(
+            '{indent}+-- {highlight}NarutoLayer('
+            'id={node.layer_id}, '
+            'description={node.description}, '
+            'tags={tags}, '
+            'children={children}, descendants={descendants}{usage}){highlight}\n'.format(
+                indent='  ' * depth,
+                highlight=HIGHLIGHT if node in highlight else '',
+                node=node,
+                tags=tuple(node.tags),
+                children=len(node.children),
+                descendants=counts[node],
+                usage=_format_usage(node, usage)))
+
+
+def _node_fields(node, counts, highlight, usage):
+    fields = {
+        'id': node.layer_id,
+        'description': node.description,
+        'tags': sorted(node.tags),
+        'child_count': len(node.children),
+        'descendant_count': counts[node],
+        'highlight': node in highlight,
+    }
+    if usage is not None:
+        exclusive, total = usage[node]
+        fields.update({
+            'bytes': exclusive.bytes,
+            'inodes': exclusive.inodes,
+            'total_bytes': total.bytes,
+            'total_inodes': total.inodes,
+        })
+    return fields
+
+
+def render_json(stream, tree, highlight=(), max_depth=None, usage=None):
+    '''
+    Write tree to stream as a single nested JSON document, as it's walked
+    '''
+    counts = count_descendants(tree)
+    highlight = set(highlight)
+
+    previous_depth = None
+    for node, depth in iter_preorder(tree.root, max_depth=max_depth):
+        if previous_depth is not None and depth <= previous_depth:
+            # Close off previous node and any parents that are finished
+            stream.write(']}' * (previous_depth - depth + 1) + ', ')
+
+        fields = json.dumps(_node_fields(node, counts, highlight, usage), sort_keys=True)
+        # Leave object open so children can be added as they're walked
+        stream.write(fields[:-1] + ', "children": [')
+        previous_depth = depth
+
+    stream.write(']}' * (previous_depth + 1) + '\n')
@@ -11,26 +11,38 @@ import logging
 import os
 import pathlib
 import re
+import time
 import uuid
 
 import naruto.aufs
+import naruto.catalog
+import naruto.delete
+import naruto.diff
+import naruto.index
+import naruto.metadata
 import naruto.mount
+import naruto.parallel
+import naruto.profile
+import naruto.scratch
+import naruto.traverse
+import naruto.tree
 
 DEV_LOGGER = logging.getLogger(__name__)
 
 CHILDREN_SUBDIR = 'children'
 CONTENTS_SUBDIR = 'contents'
+SQUASHED_SUBDIR = 'squashed'
+LAYERS_SUBDIR = 'layers'
 METADATA_NAME = 'naruto_metadata.json'
 
-
-def _get_aufs_mount_info_iter():
-    '''
-    Get all aufs mount info
-    '''
-    for mount in naruto.mount.get_mounts_iter():
-        if mount.vfstype != 'aufs':
-            continue
-        yield naruto.aufs.AUFSMount(mount)
+# Children live inside their parent's children directory
+LAYOUT_NESTED = 1
+# Every layer lives in the root's layers directory and records its parent id
+LAYOUT_FLAT = 2
+LAYOUTS = {
+    'nested': LAYOUT_NESTED,
+    'flat': LAYOUT_FLAT,
+}
 
 
 def create_file(file_path):
@@ -43,6 +55,8 @@ def create_file(file_path):
     >>> file_2 = create_file(test_file) # doctest: +IGNORE_EXCEPTION_DETAIL
     Traceback (most recent call last):
     FileExistsError: [Errno 17] File exists: '/tmp/tmpjjl1ap9q/test'
+    >>> file_1.close()
+    >>> test_dir.cleanup()
     '''
     # If private key doesn't exist
     # This odd method of opening the file should ensure we don't
@@ -57,6 +71,21 @@ class LayerNotFound(Exception):
     pass
 
 
+def iter_flat_layer_dirs(root_dir):
+    '''
+    Iterate over all directories in the layers directory of a root in the flat layout,
+    including hidden ones of layers still being created
+    '''
+    layers_dir = pathlib.Path(root_dir) / LAYERS_SUBDIR
+    try:
+        entries = tuple(os.scandir(str(layers_dir)))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield layers_dir / entry.name
+
+
 class NarutoLayer(collections.abc.Iterable):
     '''
     Naruto Layer
@@ -69,6 +98,12 @@ class NarutoLayer(collections.abc.Iterable):
       +--contents/ -- Directory with file contents of layer
       +--children/ -- Child layers
       +--naruto_metadata.json -- Metadata about layer
+      +--squashed/ -- Optional. Contents of this layer merged with its ancestors
+
+    Ephemeral layers are mounted with a writable branch outside the tree, see naruto.scratch.
+
+    In the flat layout, version 2, there are no children directories. Every layer below the
+    root lives in <root_id>/layers/<layer_id>/ and has parent_id in its metadata.
     '''
     def __init__(self, layer_dir):
         self._layer_dir = pathlib.Path(layer_dir).resolve()
@@ -78,14 +113,20 @@ class NarutoLayer(collections.abc.Iterable):
         self._contents_path = self._layer_dir / CONTENTS_SUBDIR
         self._metadata_path = self._layer_dir / METADATA_NAME
 
-        for path in (self._children_path, self._contents_path):
-            if not path.is_dir():
-                raise ValueError('Expected {} to be directory'.format(path))
-
         for path in (self._metadata_path,):
             if not path.is_file():
                 raise ValueError('Expected {} to be file'.format(path))
 
+        # Nested layers with a parent id were part way through migrating to the flat layout
+        # and may have lost their children directory already
+        if self.layout == LAYOUT_FLAT or 'parent_id' in self.get_metadata():
+            directories = (self._contents_path,)
+        else:
+            directories = (self._children_path, self._contents_path)
+        for path in directories:
+            if not path.is_dir():
+                raise ValueError('Expected {} to be directory'.format(path))
+
     def __eq__(self, other):
         return self._layer_dir == other._layer_dir
 
@@ -99,18 +140,57 @@ class NarutoLayer(collections.abc.Iterable):
         '''
         Iterate over all direct children
         '''
-        for child in self._children_path.iterdir():
-            if child.is_dir():
-                yield self.__class__(child)
+        if self.layout == LAYOUT_FLAT:
+            children = self._iter_flat_children()
+        elif self._children_path.is_dir():
+            children = (
+                child for child in self._children_path.iterdir() if child.is_dir())
+        else:
+            # Part way through migrating to the flat layout
+            children = ()
+
+        for child in children:
+            # Hidden directories are layers still being created
+            if child.name.startswith('.'):
+                continue
+            try:
+                child_layer = self.__class__(child)
+            except ValueError as error:
+                # Left for naruto gc
+                DEV_LOGGER.warning('Skipping malformed layer %s: %s', child, error)
+                continue
+            yield child_layer
 
-    def iter_descendants(self):
+    def _iter_flat_children(self):
         '''
-        Iterate over all descendants recursively
+        Iterate over directories of layers in the flat layout whose parent is this layer
         '''
-        for child in self.iter_children():
-            yield child
-            for descendant in child.iter_descendants():
-                yield descendant
+        for layer_dir in iter_flat_layer_dirs(self._get_root_dir()):
+            if layer_dir.name.startswith('.'):
+                continue
+            try:
+                metadata = naruto.metadata.read_metadata(layer_dir / METADATA_NAME)
+            except (FileNotFoundError, ValueError):
+                continue
+            if metadata.get('parent_id') == self.layer_id:
+                yield layer_dir
+
+    def iter_descendants(self, max_depth=None, prune=None):
+        '''
+        Iterate over all descendants, parents before their children.
+
+        See naruto.traverse.iter_preorder for max_depth and prune.
+        '''
+        walk = naruto.traverse.iter_preorder(self, max_depth=max_depth, prune=prune)
+        next(walk)
+        for descendant, _ in walk:
+            yield descendant
+
+    def iter_ancestors(self, max_depth=None):
+        '''
+        Iterate over parent, grandparent etc. up to the root
+        '''
+        return naruto.traverse.iter_ancestors(self, max_depth=max_depth)
 
     def __repr__(self):
         return (
@@ -134,40 +214,90 @@ class NarutoLayer(collections.abc.Iterable):
         '''
         Get metadata dict
         '''
-        return json.load(self._metadata_path.open('r'))
+        return naruto.metadata.read_metadata(self._metadata_path)
+
+    def _get_catalog_entry(self):
+        '''
+        Get catalog entry for this layer. None if not in catalog mode, not catalogued or the
+        entry is out of date.
+        '''
+        catalog = naruto.catalog.get_catalog()
+        if catalog is None:
+            return None
+        entry = catalog.get_by_path(self._layer_dir)
+        # Runs without the catalog don't update it, which shows as metadata changed since
+        if entry is not None and entry['modified'] != os.stat(str(self._metadata_path)).st_mtime:
+            DEV_LOGGER.debug('Catalog entry for %r is out of date', self)
+            return None
+        return entry
+
+    def _get_metadata_field(self, field, default=None):
+        '''
+        Get single metadata field from catalog if possible
+        '''
+        entry = self._get_catalog_entry()
+        if entry is not None:
+            return entry[field]
+        return self.get_metadata().get(field, default)
 
     @contextlib.contextmanager
     def _get_metadata_context(self):
         '''
-        Conveniant context to update metadata
+        Conveniant context to update metadata.
+
+        The metadata file is locked while in the context and replaced atomically on exit.
         '''
-        metadata = self.get_metadata()
-        yield metadata
-        json.dump(metadata, self._metadata_path.open('w'))
+        with naruto.metadata.update_metadata(self._metadata_path) as metadata:
+            yield metadata
+
+        catalog = naruto.catalog.get_catalog()
+        if catalog is not None:
+            catalog.record_layer(self)
 
     @property
     def description(self):
-        return self.get_metadata()['description']
+        return self._get_metadata_field('description')
 
     @description.setter
     def description(self, value):
-        with self._get_metadata_context() as metadata:
-            metadata['description'] = str(value)
+        self.update(description=value)
 
     @property
     def tags(self):
         '''
         Tags is a set of useful strings used to tag a layer for searching or organisation
         '''
-        return frozenset(self.get_metadata().get('tags', ()))
+        return frozenset(self._get_metadata_field('tags', ()))
 
     @tags.setter
     def tags(self, tags):
         '''
         Tags is a set of useful strings used to tag a layer for searching or organisation
         '''
+        self.update(tags=tags)
+
+    def update(self, description=None, tags=None, add_tags=(), remove_tags=()):
+        '''
+        Change several metadata fields in a single locked write.
+
+        tags replaces all tags. add_tags and remove_tags are applied afterwards against the
+        tags on disk at the time of the write so concurrent updates aren't lost.
+        '''
         with self._get_metadata_context() as metadata:
-            metadata['tags'] = tuple(set(str(value) for value in tags))
+            if description is not None:
+                metadata['description'] = str(description)
+
+            if tags is not None or add_tags or remove_tags:
+                new_tags = set(metadata.get('tags', ()) if tags is None else tags)
+                new_tags.update(add_tags)
+                new_tags.difference_update(remove_tags)
+                new_tags = tuple(set(str(value) for value in new_tags))
+                metadata['tags'] = new_tags
+            else:
+                new_tags = None
+
+        if new_tags is not None:
+            self.get_index().set_tags(self._layer_dir, new_tags)
 
     @property
     def has_children(self):
@@ -183,6 +313,24 @@ class NarutoLayer(collections.abc.Iterable):
         '''
         return self._contents_path
 
+    @property
+    def scratch_path(self):
+        '''
+        Scratch directory of an ephemeral layer, or None
+        '''
+        scratch_path = self.get_metadata().get('ephemeral')
+        return None if scratch_path is None else pathlib.Path(scratch_path)
+
+    @property
+    def branch_path(self):
+        '''
+        Directory this layer is mounted from. The scratch contents for ephemeral layers.
+        '''
+        scratch_path = self.scratch_path
+        if scratch_path is None:
+            return self._contents_path
+        return scratch_path / CONTENTS_SUBDIR
+
     # All lead-nodes should be read only
     read_only = has_children
 
@@ -191,7 +339,20 @@ class NarutoLayer(collections.abc.Iterable):
         '''
         RO property for is_root
         '''
-        return self.get_metadata()['is_root']
+        return self._get_metadata_field('is_root')
+
+    @property
+    def layout(self):
+        '''
+        Layout version of the tree this layer is in, LAYOUT_NESTED or LAYOUT_FLAT
+        '''
+        metadata = self.get_metadata()
+        if metadata['is_root']:
+            return metadata.get('layout', LAYOUT_NESTED)
+        # Nested children always live in a children directory
+        if self._layer_dir.parent.name == LAYERS_SUBDIR:
+            return LAYOUT_FLAT
+        return LAYOUT_NESTED
 
     @property
     def mounted(self):
@@ -225,17 +386,90 @@ class NarutoLayer(collections.abc.Iterable):
         '''
         return tuple(self.iter_descendants())
 
-    def get_layer_permissions(self):
+    def get_tree(self):
+        '''
+        Load the whole tree this layer is part of into memory
+        '''
+        return naruto.tree.LayerTree.from_layer(self)
+
+    def get_index(self):
+        '''
+        Get tag and layer id index for the tree this layer is part of
+        '''
+        return naruto.index.LayerIndex(self.get_root().path)
+
+    def get_layer_permissions(self, tree=None):
         '''
         Get layer permissions for self and parents
         '''
-        my_perms = (self._contents_path, 'ro' if self.read_only else 'rw')
+        if tree is not None:
+            return tree.get_node(self).get_layer_permissions()
 
-        if self.is_root:
-            return [my_perms, ]
+        branches = []
+        skip = 0
+        # Ancestors always have a child, only self needs checking
+        read_only = self.read_only
+        for layer in itertools.chain((self,), self.iter_ancestors()):
+            if skip:
+                skip -= 1
+                continue
+            squashed = layer.get_metadata().get('squashed') if read_only else None
+            if squashed:
+                # This covers the next few ancestors as well
+                branches.append((layer.path / SQUASHED_SUBDIR, 'ro'))
+                skip = squashed['layers'] - 1
+            else:
+                branches.append((layer.contents_path, 'ro' if read_only else 'rw'))
+            read_only = True
+        return branches
+
+    def diff(self, other=None, hash_contents=False):
+        '''
+        Iterate over naruto.diff.DiffEntry for changes going from other to this layer.
+
+        other defaults to the parent, so this shows what this layer changed. Only branches not
+        shared by both layers are walked. Files are compared by size and mtime, or by contents
+        if hash_contents is True.
+        '''
+        if other is None:
+            other = self.parent
+
+        branches = [path for path, _ in self.get_layer_permissions()]
+        if other is None:
+            base_branches = []
         else:
-            parent_branches = self.parent.get_layer_permissions()
-            return [my_perms] + parent_branches
+            base_branches = [path for path, _ in other.get_layer_permissions()]
+
+        return naruto.diff.diff_branches(branches, base_branches, hash_contents=hash_contents)
+
+    def squash(self, depth=None):
+        '''
+        Merge this read only layer and its ancestors into a single branch.
+
+        Later mounts of descendants use the squashed branch in place of the layers it covers.
+        depth limits how many layers, counting this one, are merged. Default is up to the root.
+        '''
+        node = self.get_tree().get_node(self)
+        if not node.read_only:
+            raise ValueError('Only read only layers can be squashed. {} has no children'.format(
+                node))
+
+        chain = [node] + list(node.iter_ancestors())
+        if depth is not None:
+            chain = chain[:depth]
+        if len(chain) < 2:
+            raise ValueError('Need at least two layers to squash')
+
+        DEV_LOGGER.info('Squashing %d layers into %r', len(chain), self)
+        # Imported here as it pulls in shutil, which nothing else on the CLI's path needs
+        import naruto.squash
+        naruto.squash.squash_branches(
+            [chain_node.contents_path for chain_node in reversed(chain)],
+            self._layer_dir / SQUASHED_SUBDIR,
+            keep_whiteouts=not chain[-1].is_root)
+
+        with self._get_metadata_context() as metadata:
+            metadata['squashed'] = {'layers': len(chain)}
 
     def get_root(self):
         '''
@@ -243,70 +477,276 @@ class NarutoLayer(collections.abc.Iterable):
         '''
         if self.is_root:
             return self
-        else:
-            return self.parent.get_root()
+        if self.layout == LAYOUT_FLAT:
+            return self.__class__(self._get_root_dir())
+
+        layer = self
+        while not layer.is_root:
+            layer = layer.parent
+        return layer
+
+    def _get_root_dir(self):
+        if self.is_root:
+            return self._layer_dir
+        if self.layout == LAYOUT_FLAT:
+            return self._layer_dir.parent.parent
+        return self.get_root().path
 
     @classmethod
-    def create(cls, parent_directory, is_root=True, description=''):
+    def create(cls, parent_directory, is_root=True, description='', layout=LAYOUT_NESTED):
         '''
-        Create new NarutoLayer
+        Create new NarutoLayer.
+
+        For a root, parent_directory is where to put it and layout picks the layout of its
+        tree. Otherwise parent_directory is the children directory of a nested layer.
         '''
         parent_directory = pathlib.Path(parent_directory)
 
+        parent = None
         if not is_root:
             # Check that parent is valid
-            cls(parent_directory.parent)
+            parent = cls(parent_directory.parent)
+            layout = LAYOUT_NESTED
 
+        return cls._create(parent_directory, parent, description, layout)
+
+    @classmethod
+    def _create(cls, parent_directory, parent, description, layout):
+        '''
+        Create new layer in parent_directory. parent is None for a root.
+        '''
+        is_root = parent is None
         if not description and is_root:
             description = 'root'
 
         sub_layer_uuid = str(uuid.uuid4()).replace('-', '')
         sub_layer_dir = parent_directory / sub_layer_uuid
-        sub_layer_dir.mkdir()
+        # Build layer under a hidden name so an interrupted create never looks like a layer
+        temp_layer_dir = parent_directory / '.{}.creating'.format(sub_layer_uuid)
+        temp_layer_dir.mkdir()
 
-        for subdir in (CHILDREN_SUBDIR, CONTENTS_SUBDIR):
-            (sub_layer_dir / subdir).mkdir()
+        if layout == LAYOUT_FLAT:
+            subdirs = (LAYERS_SUBDIR, CONTENTS_SUBDIR) if is_root else (CONTENTS_SUBDIR,)
+        else:
+            subdirs = (CHILDREN_SUBDIR, CONTENTS_SUBDIR)
+        for subdir in subdirs:
+            (temp_layer_dir / subdir).mkdir()
 
         initial_metadata = {
             'is_root': is_root,
-            'description': description
+            'description': description,
+            'created': time.time(),
         }
+        if is_root and layout != LAYOUT_NESTED:
+            initial_metadata['layout'] = layout
+        elif layout == LAYOUT_FLAT:
+            initial_metadata['parent_id'] = parent.layer_id
 
-        json.dump(initial_metadata, create_file(sub_layer_dir / METADATA_NAME))
+        with create_file(temp_layer_dir / METADATA_NAME) as metadata_file:
+            json.dump(initial_metadata, metadata_file)
+        temp_layer_dir.rename(sub_layer_dir)
 
         DEV_LOGGER.info('Create empty layer in %r', sub_layer_dir)
 
-        return cls(sub_layer_dir)
+        layer = cls(sub_layer_dir)
+        if is_root:
+            layer.get_index().rebuild()
+        else:
+            parent.get_index().add_layer(sub_layer_dir)
+
+        catalog = naruto.catalog.get_catalog()
+        if catalog is not None:
+            catalog.record_layer(layer)
+
+        return layer
+
+    def move_to_trash(self):
+        '''
+        Remove this layer and all its descendants from the tree without freeing any space.
+
+        Returns where the layer was moved to, ready for naruto.delete.reclaim.
+        '''
+        is_root = self.is_root
+        root = None if is_root else self.get_root()
+
+        if self.layout == LAYOUT_FLAT:
+            # Listing children of a flat layer reads the whole tree so read it just once
+            descendants = self.get_tree().get_node(self).descendants
+        else:
+            descendants = self.descendants
+        # Scratch in /dev/shm doesn't survive a reboot
+        scratch_paths = [
+            layer.scratch_path for layer in (self,) + descendants
+            if layer.scratch_path is not None and layer.scratch_path.exists()]
+
+        if not is_root and self.layout == LAYOUT_FLAT:
+            # Descendants aren't inside this layer's directory so are moved one by one
+            layer_dirs = [self._layer_dir] + [descendant.path for descendant in descendants]
+            trash_path = naruto.delete.move_layers_to_trash(
+                root.path, self.layer_id, layer_dirs)
+        else:
+            layer_dirs = [self._layer_dir]
+            trash_path = naruto.delete.move_to_trash(self)
+
+        if not is_root:
+            root.get_index().remove_layers(layer_dirs)
+
+        catalog = naruto.catalog.get_catalog()
+        if catalog is not None:
+            catalog.remove_layer(self.layer_id)
+
+        # Scratch can't be renamed into the trash and is in memory anyway
+        for scratch_path in scratch_paths:
+            naruto.delete.reclaim(scratch_path)
+
+        return trash_path
+
+    def delete(self, parallelism=None, background=False, progress=None):
+        '''
+        Remove this layer and all its descendants from disk.
+
+        The layer is renamed out of the tree first so it's gone as soon as this returns or, with
+        background=True, as soon as the rename is done. Space is then reclaimed by parallelism
+        threads, or by a detached process if background is True. Returns the DeleteProgress of
+        reclaiming, or None if it was left to the background.
+        '''
+        DEV_LOGGER.info('Deleting %r', self)
+        trash_path = self.move_to_trash()
+
+        if background:
+            naruto.delete.reclaim_in_background((trash_path,))
+            return None
+        return naruto.delete.reclaim(trash_path, parallelism=parallelism, progress=progress)
 
     @classmethod
     def find_layer_mounted_at_dest(cls, destination):
         '''
         Find layer mounted at dest
         '''
-        mount_info = naruto.mount.find_mount_by_dest(destination)
+        mount_table = naruto.aufs.get_mount_table()
+        mount_info = naruto.mount.find_mount_by_dest(destination, mounts=mount_table.mounts)
 
         if mount_info.vfstype != 'aufs':
             raise LayerNotFound(
                 'Destination {!r} is not an aufs mount point'.format(destination))
 
-        aufs_mount = naruto.aufs.AUFSMount(mount_info)
+        aufs_mount = mount_table.get_aufs_mount(mount_info.file)
         leaf_branch = aufs_mount.get_leaf()
 
-        return cls(pathlib.Path(leaf_branch.path).parent)
+        return cls(naruto.scratch.find_layer_dir(pathlib.Path(leaf_branch.path).parent))
 
-    def _create_child(self, description=''):
+    def _create_child(self, description='', scratch_dir=None):
         '''
-        Create new child
+        Create new child, ephemeral with its writable branch in scratch_dir if given
         '''
         DEV_LOGGER.info('Create child of %r', self)
-        return self.__class__.create(self._children_path, is_root=False, description=description)
+        if self.layout == LAYOUT_FLAT:
+            child = self._create(
+                self._get_root_dir() / LAYERS_SUBDIR, self, description, LAYOUT_FLAT)
+        else:
+            child = self._create(self._children_path, self, description, LAYOUT_NESTED)
+
+        if scratch_dir is not None:
+            scratch_path = naruto.scratch.create_scratch(scratch_dir, child)
+            with child._get_metadata_context() as metadata:
+                metadata['ephemeral'] = str(scratch_path)
+        return child
+
+    def create_child(self, description='', parallelism=None, scratch_dir=None):
+        '''
+        Create new child but freeze existing mounts first.
+
+        With scratch_dir the child is ephemeral, see naruto.scratch.
+        '''
+        self.freeze_mounts(parallelism=parallelism).raise_for_failures()
+        return self._create_child(description=description, scratch_dir=scratch_dir)
 
-    def create_child(self, description=''):
+    def _persist(self, parallelism=None):
         '''
-        Create new child but freeze existing mounts first
+        Copy contents of an ephemeral layer out of scratch so it becomes an ordinary layer.
+
+        Mounts of the scratch branch are switched to the copy. It must no longer be writable.
         '''
-        self.freeze_mounts()
-        return self._create_child(description=description)
+        scratch_path = self.scratch_path
+        DEV_LOGGER.info('Persisting %r from %s', self, scratch_path)
+        # Imported here as it pulls in shutil, which nothing else on the CLI's path needs
+        import naruto.squash
+        if (scratch_path / CONTENTS_SUBDIR).is_dir():
+            naruto.squash.squash_branches(
+                [scratch_path / CONTENTS_SUBDIR], self._contents_path, keep_whiteouts=True,
+                link=False)
+        else:
+            # Scratch in /dev/shm doesn't survive a reboot. What was written there is lost but
+            # the layer is still usable
+            DEV_LOGGER.warning(
+                'Scratch %s of %r has gone. Keeping the layer without what was written there',
+                scratch_path, self)
+
+        def switch(aufs_mount_branch):
+            DEV_LOGGER.debug('Switching %r to %s', aufs_mount_branch, self._contents_path)
+            with aufs_mount_branch.mount.transaction():
+                aufs_mount_branch.insert_after(
+                    self._contents_path, aufs_mount_branch.permission)
+                aufs_mount_branch.delete()
+
+        naruto.parallel.run_per_mount(
+            switch, self.find_mounted_branches_iter(), parallelism=parallelism,
+        ).raise_for_failures()
+
+        with self._get_metadata_context() as metadata:
+            del metadata['ephemeral']
+        naruto.delete.reclaim(scratch_path)
+
+    def reparent(self, new_parent, parallelism=None):
+        '''
+        Make this layer and its descendants a child of new_parent, in the same flat tree.
+
+        Only the parent id in metadata changes, nothing is moved. Mounts of new_parent are
+        frozen first as it gets a child. Squashed branches that merged ancestors this layer no
+        longer has are removed.
+        '''
+        if self.layout != LAYOUT_FLAT:
+            raise ValueError(
+                'Only layers in the flat layout can be reparented. Run migrate-layout first')
+        if self.is_root:
+            raise ValueError('The root layer has no parent')
+
+        tree = self.get_tree()
+        node = tree.get_node(self)
+        try:
+            new_parent_node = tree.get_node(new_parent)
+        except KeyError:
+            raise ValueError('{} is not in the same tree as {}'.format(new_parent, self))
+        if new_parent_node is node or node in new_parent_node.iter_ancestors():
+            raise ValueError('{} is {} or one of its descendants'.format(new_parent, self))
+        if new_parent_node is node.parent:
+            return
+
+        mount_table = naruto.aufs.get_mount_table()
+        for descendant, _ in naruto.traverse.iter_preorder(node):
+            if mount_table.find_branches(descendant.branch_path):
+                raise ValueError('{} is mounted'.format(descendant))
+
+        new_parent.freeze_mounts(parallelism=parallelism).raise_for_failures()
+
+        DEV_LOGGER.info('Moving %r from %r to %r', self, self.parent, new_parent)
+        with self._get_metadata_context() as metadata:
+            metadata['parent_id'] = new_parent.layer_id
+
+        # Squashes reaching above this layer merged its old ancestors
+        for descendant, depth in naruto.traverse.iter_preorder(node):
+            squashed = descendant.metadata.get('squashed')
+            if squashed and squashed['layers'] > depth + 1:
+                descendant.get_layer()._drop_squashed()
+
+    def _drop_squashed(self):
+        DEV_LOGGER.info('Removing squashed branch of %r', self)
+        with self._get_metadata_context() as metadata:
+            metadata.pop('squashed', None)
+        squashed_path = self._layer_dir / SQUASHED_SUBDIR
+        if squashed_path.exists():
+            naruto.delete.reclaim(naruto.delete.move_path_to_trash(
+                self._get_root_dir(), squashed_path))
 
     @property
     def parent(self):
@@ -317,76 +757,144 @@ class NarutoLayer(collections.abc.Iterable):
             return None
 
         parent_dir = self._layer_dir.parent.parent
+        if self.layout == LAYOUT_FLAT:
+            parent_id = self.get_metadata()['parent_id']
+            if parent_id != parent_dir.name:
+                parent_dir = parent_dir / LAYERS_SUBDIR / parent_id
 
         DEV_LOGGER.debug('Parent of %r is at %r', self, parent_dir)
         return self.__class__(parent_dir)
 
-    def mount(self, destination):
+    def mount(self, destination, profile=None):
         '''
-        Mount this layer
+        Mount this layer with a naruto.profile.MountProfile. Default is aufs's own defaults.
         '''
         destination = pathlib.Path(destination)
         DEV_LOGGER.info('Mounting layer %r on %r', self, destination)
+        if profile is None:
+            profile = naruto.profile.get_profile(naruto.profile.DEFAULT_PROFILE)
 
         if not destination.is_dir() and next(destination, None) is not None:
             raise Exception('{} must be directory and must be empty'.format(destination))
 
         branches = self.get_layer_permissions()
+        if self.scratch_path is not None:
+            branches[0] = (self.branch_path, branches[0][1])
 
         # There should only be one rw branch
         assert all(permission == 'ro' for _path, permission in branches[1:])
 
         branch_strings = [
-            '{path!s}={permission}'.format(path=path.resolve(), permission=permission)
+            '{path!s}={permission}'.format(
+                path=path.resolve(),
+                permission=profile.ro_permission if permission == 'ro' else permission)
             for path, permission in branches]
-        branch_string = 'br:{}'.format(':'.join(branch_strings))
         mount_point = str(destination.resolve())
 
-        DEV_LOGGER.debug('Using branches %r. Mount point %r', branch_string, mount_point)
-        naruto.mount.mount('none', mount_point, types='aufs', options=branch_string)
+        DEV_LOGGER.debug(
+            'Using branches %r and profile %r. Mount point %r',
+            branch_strings, profile, mount_point)
+        naruto.aufs.mount_branches(mount_point, branch_strings, options=profile.options)
+
+        # Read only permission isn't an aufs option so remounts can't tell it from the mount
+        with self._get_metadata_context() as metadata:
+            metadata.setdefault('mount_profiles', {})[mount_point] = {
+                'name': profile.name, 'ro_permission': profile.ro_permission}
+
+    def _move_mount_profiles(self, mount_points, child=None):
+        '''
+        Forget profiles recorded for mount_points, giving them to child if it replaces this
+        layer as their leaf
+        '''
+        moved = {}
+        with self._get_metadata_context() as metadata:
+            mount_profiles = metadata.get('mount_profiles', {})
+            for mount_point in mount_points:
+                if str(mount_point) in mount_profiles:
+                    moved[str(mount_point)] = mount_profiles.pop(str(mount_point))
+            if not mount_profiles:
+                metadata.pop('mount_profiles', None)
+
+        if child is not None and moved:
+            with child._get_metadata_context() as metadata:
+                metadata.setdefault('mount_profiles', {}).update(moved)
 
     def find_mounted_branches_iter(self):
         '''
         Find if this is mounted
         '''
-        for aufs_mount in _get_aufs_mount_info_iter():
-            try:
-                yield aufs_mount.get_branch_by_path(self._contents_path)
-            except KeyError:
-                continue
+        for aufs_mount_branch in naruto.aufs.get_mount_table().find_branches(self.branch_path):
+            yield aufs_mount_branch
 
-    def unmount_all(self):
+    def unmount_all(self, parallelism=None):
         '''
-        Unmount all locations this is mounted
+        Unmount all locations this is mounted.
+
+        Returns MountOperationResult saying which mount points succeeded.
         '''
         DEV_LOGGER.info('Attempting to umount all uses of %r', self)
-        for aufs_mount_branch in self.find_mounted_branches_iter():
+
+        def unmount(aufs_mount_branch):
             DEV_LOGGER.info('Unmounting %s', aufs_mount_branch)
             aufs_mount_branch.mount.unmount()
 
-    def freeze_mounts(self, preserve_rw=True):
+        result = naruto.parallel.run_per_mount(
+            unmount, self.find_mounted_branches_iter(), parallelism=parallelism)
+        if 'mount_profiles' in self.get_metadata():
+            self._move_mount_profiles(result.succeeded)
+        return result
+
+    def freeze_mounts(self, preserve_rw=True, parallelism=None):
         '''
-        All mounts currently using this layer rw should be moved to new child layer
+        All mounts currently using this layer rw should be moved to new child layer.
+
+        Returns MountOperationResult saying which mount points succeeded.
         '''
         DEV_LOGGER.info('Freezing mounts for %r', self)
-        child = None
+        scratch_path = self.scratch_path
 
+        rw_branches = []
         for aufs_mount_branch in self.find_mounted_branches_iter():
-            if aufs_mount_branch.permission == 'ro':
-                DEV_LOGGER.debug('Branch %r is already ro', aufs_mount_branch)
-                continue
+            if aufs_mount_branch.read_only:
+                DEV_LOGGER.debug('Branch %r is already read only', aufs_mount_branch)
+            else:
+                rw_branches.append(aufs_mount_branch)
 
-            DEV_LOGGER.debug('Branch %r is rw. Remounting.', aufs_mount_branch)
-            aufs_mount_branch.permission = 'ro'
+        child = None
+        if preserve_rw and rw_branches:
+            # Writes carry on going to scratch
+            child = self._create_child(
+                scratch_dir=None if scratch_path is None else scratch_path.parent)
 
-            if preserve_rw:
-                if child is None:
-                    child = self._create_child()
-                DEV_LOGGER.debug(
-                    'Preserving rw for branch %r. Using new child %r', aufs_mount_branch, child)
-                aufs_mount_branch.insert_after(child.contents_path, 'rw')
+        mount_profiles = self.get_metadata().get('mount_profiles', {})
+
+        def freeze(aufs_mount_branch):
+            DEV_LOGGER.debug('Branch %r is rw. Remounting.', aufs_mount_branch)
 
-        self._validate()
+            # Do both in one remount so there's no moment without a rw branch
+            with aufs_mount_branch.mount.transaction():
+                # Keep to the mount's profile, or failing that match its read only branches
+                profile = mount_profiles.get(str(aufs_mount_branch.mount_point))
+                if profile is None:
+                    aufs_mount_branch.permission = aufs_mount_branch.mount.ro_permission
+                else:
+                    aufs_mount_branch.permission = profile['ro_permission']
+
+                if child is not None:
+                    DEV_LOGGER.debug(
+                        'Preserving rw for branch %r. Using new child %r',
+                        aufs_mount_branch, child)
+                    aufs_mount_branch.insert_after(child.branch_path, 'rw')
+
+        result = naruto.parallel.run_per_mount(freeze, rw_branches, parallelism=parallelism)
+        if mount_profiles:
+            self._move_mount_profiles(result.succeeded, child=child)
+
+        if result.ok:
+            if scratch_path is not None:
+                self._persist(parallelism=parallelism)
+            self._validate()
+        return result
 
     def _validate(self):
         '''
@@ -394,7 +902,7 @@ class NarutoLayer(collections.abc.Iterable):
         '''
         if self.read_only:
             for aufs_mount_branch in self.find_mounted_branches_iter():
-                if aufs_mount_branch.permission != 'ro':
+                if not aufs_mount_branch.read_only:
                     raise Exception(
                         'All mounts should be ro. Got {!r}'.format(aufs_mount_branch))
 
@@ -417,20 +925,13 @@ class NarutoLayer(collections.abc.Iterable):
         DEV_LOGGER.debug(
             'Finding layer. layer_reference=%r rel_spec=%r', layer_reference, rel_spec)
 
-        root_layer = self.get_root()
         if layer_reference == 'root':
-            layer = root_layer
+            layer = self.get_root()
         elif layer_reference == '':
             layer = self
         else:
             DEV_LOGGER.debug('Trying to find layer with tag or reference: %r', layer_reference)
-            for layer in itertools.chain((root_layer, ), root_layer.iter_descendants()):
-                DEV_LOGGER.debug('Considering %s', layer)
-                if layer_reference == layer.layer_id or layer_reference in layer.tags:
-                    DEV_LOGGER.debug('Found reference in %s', layer)
-                    break
-            else:
-                raise KeyError('Unable to find layer {}'.format(layer_reference))
+            layer = self.__class__(self._lookup_reference(layer_reference))
 
         for match in self.LAYER_REL_RE.finditer(rel_spec):
             command = match.group('command')
@@ -446,6 +947,24 @@ class NarutoLayer(collections.abc.Iterable):
 
         return layer
 
+    def _lookup_reference(self, reference):
+        '''
+        Find directory of layer in same tree with reference as layer id or tag
+        '''
+        catalog = naruto.catalog.get_catalog()
+        if catalog is not None:
+            layer_dirs = catalog.find_by_tag(reference, root_id=self.get_root().layer_id)
+            if len(layer_dirs) == 1:
+                try:
+                    metadata = naruto.metadata.read_metadata(layer_dirs[0] / METADATA_NAME)
+                except (FileNotFoundError, ValueError):
+                    metadata = {}
+                # Runs without the catalog don't update it, so it may be out of date
+                if reference in metadata.get('tags', ()):
+                    return layer_dirs[0]
+
+        return self.get_index().lookup(reference)
+
     def _resolve_single_rel_spec(self, command, depth):
         '''
         Resolve single rel spec relative to this layer
@@ -460,10 +979,14 @@ class NarutoLayer(collections.abc.Iterable):
         elif command == '~':
             current_layer = self
             for _ in range(depth):
-                current_layer = next(iter(current_layer))
+                current_layer = next(iter(current_layer), None)
+                if current_layer is None:
+                    raise KeyError('Couldn\'t find {} generations below {}'.format(depth, self))
             return current_layer
         elif command == '@':
             current_layer = self
             for _ in range(depth):
                 current_layer = current_layer.parent
+                if current_layer is None:
+                    raise KeyError('Couldn\'t find {} generations above {}'.format(depth, self))
             return current_layer
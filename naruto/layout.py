@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Move a layer tree from the nested layout to the flat layout.
+
+Layers are moved children first, each recording its parent id before it's renamed and losing its
+empty children directory after, and the root is marked flat last. LayerTree reads both layouts at
+once, so an interrupted migration leaves a working tree and running it again carries on where it
+stopped.
+"""
+import logging
+
+import naruto.aufs
+import naruto.catalog
+import naruto.index
+import naruto.layer
+import naruto.metadata
+import naruto.scratch
+import naruto.traverse
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+
+def _find_mounted(tree):
+    mount_table = naruto.aufs.get_mount_table()
+    for node in tree:
+        for path in (node.branch_path, node.path / naruto.layer.SQUASHED_SUBDIR):
+            if mount_table.find_branches(path):
+                return node
+    return None
+
+
+def migrate_to_flat(root):
+    '''
+    Move every layer of the tree of root, a NarutoLayer, into the root's layers directory.
+
+    Branch paths change so nothing in the tree may be mounted, and leftovers gc would remove
+    must be gone so children directories can be removed. Returns number of layers moved.
+    '''
+    if not root.is_root:
+        raise ValueError('Only a whole tree can be migrated. {} is not a root'.format(root))
+    if root.layout == naruto.layer.LAYOUT_FLAT:
+        DEV_LOGGER.info('%r already uses the flat layout', root)
+        return 0
+
+    tree = root.get_tree()
+    mounted = _find_mounted(tree)
+    if mounted is not None:
+        raise ValueError('Unmount the tree first. {} is mounted'.format(mounted))
+    if tree.malformed or tree.incomplete:
+        raise ValueError('Run gc first. {} is not a layer'.format(
+            (tree.malformed + tree.incomplete)[0]))
+
+    layers_dir = root.path / naruto.layer.LAYERS_SUBDIR
+    layers_dir.mkdir(exist_ok=True)
+
+    moved = 0
+    for node, _ in naruto.traverse.iter_postorder(tree.root):
+        if node.is_root:
+            continue
+
+        layer_dir = layers_dir / node.layer_id
+        if node.path.parent != layers_dir:
+            with naruto.metadata.update_metadata(
+                    node.path / naruto.layer.METADATA_NAME) as metadata:
+                metadata['parent_id'] = node.parent.layer_id
+            node.path.rename(layer_dir)
+            if node.scratch_path is not None:
+                naruto.scratch.link_layer(node.scratch_path, layer_dir)
+            DEV_LOGGER.debug('Moved %s to %s', node.path, layers_dir)
+            moved += 1
+
+        # Children have all been moved out already. Removed only once the layer is in place so
+        # that, if interrupted, it's never a nested layer without a children directory
+        try:
+            (layer_dir / naruto.layer.CHILDREN_SUBDIR).rmdir()
+        except FileNotFoundError:
+            pass
+
+    children_dir = root.path / naruto.layer.CHILDREN_SUBDIR
+    if children_dir.is_dir():
+        children_dir.rmdir()
+    with naruto.metadata.update_metadata(root.path / naruto.layer.METADATA_NAME) as metadata:
+        metadata['layout'] = naruto.layer.LAYOUT_FLAT
+
+    naruto.index.LayerIndex(root.path).rebuild()
+    catalog = naruto.catalog.get_catalog()
+    if catalog is not None:
+        for layer in naruto.layer.NarutoLayer(root.path).iter_descendants():
+            catalog.record_layer(layer)
+
+    DEV_LOGGER.info('Moved %d layers of %r to the flat layout', moved, root)
+    return moved
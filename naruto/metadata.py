@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Reading and writing of layer metadata
+"""
+import collections
+import contextlib
+import copy
+import fcntl
+import json
+import logging
+import os
+import threading
+
+DEV_LOGGER = logging.getLogger(__name__)
+DEFAULT_CACHE_SIZE = 4096
+LOCK_SUFFIX = '.lock'
+
+
+@contextlib.contextmanager
+def lock_file(path):
+    '''
+    Hold an exclusive advisory lock for path.
+
+    The lock is taken on a separate <path>.lock file as path itself is replaced on every write.
+    flock locks belong to the open file so this also serialises threads in one process.
+    '''
+    filedesc = os.open(str(path) + LOCK_SUFFIX, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(filedesc, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(filedesc)
+
+
+def _atomic_write(path, metadata):
+    '''
+    Write metadata as JSON to a temporary file and rename it over path.
+
+    Readers see either the old or the new file, never a partial one. Returns stat of the new file.
+    '''
+    # tempfile is slow to import and only needed for writes
+    import tempfile
+    directory, name = os.path.split(path)
+    filedesc, temp_path = tempfile.mkstemp(prefix='.{}.'.format(name), dir=directory or '.')
+    try:
+        try:
+            os.fchmod(filedesc, os.stat(path).st_mode & 0o777)
+        except FileNotFoundError:
+            pass
+        with os.fdopen(filedesc, 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+            metadata_file.flush()
+            # Data must be on disk before the rename or a crash can leave an empty file
+            os.fsync(metadata_file.fileno())
+            stat_result = os.fstat(metadata_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temp_path)
+        raise
+    return stat_result
+
+
+def _stat_key(stat_result):
+    '''
+    Key used to decide if a cached file is still valid
+    '''
+    return (stat_result.st_mtime_ns, stat_result.st_size, stat_result.st_ino)
+
+
+class MetadataCache(object):
+    '''
+    Per process cache of parsed metadata files.
+
+    Entries are keyed by path and checked against os.stat on every read so changes by other
+    processes are noticed. Least recently used entries are dropped once max_size is reached.
+    '''
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _store(self, path, key, metadata):
+        with self._lock:
+            self._entries[path] = (key, metadata)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def read(self, path):
+        '''
+        Get metadata at path. The returned dict is a copy and safe to modify.
+        '''
+        path = str(path)
+        key = _stat_key(os.stat(path))
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == key:
+                self._entries.move_to_end(path)
+                return copy.deepcopy(entry[1])
+
+        DEV_LOGGER.debug('Metadata cache miss for %r', path)
+        with open(path, 'r') as metadata_file:
+            key = _stat_key(os.fstat(metadata_file.fileno()))
+            metadata = json.load(metadata_file)
+
+        self._store(path, key, metadata)
+        return copy.deepcopy(metadata)
+
+    def write(self, path, metadata):
+        '''
+        Atomically replace metadata at path and keep the cache up to date
+        '''
+        path = str(path)
+        metadata = copy.deepcopy(metadata)
+        key = _stat_key(_atomic_write(path, metadata))
+        self._store(path, key, metadata)
+
+    @contextlib.contextmanager
+    def update(self, path):
+        '''
+        Context giving metadata at path to modify, written back in one go on exit.
+
+        Other updates of the same file, from this or any other process, wait until this one
+        is finished so none are lost.
+        '''
+        with lock_file(path):
+            metadata = self.read(path)
+            yield metadata
+            self.write(path, metadata)
+
+    def invalidate(self, path=None):
+        '''
+        Drop a single entry or the whole cache
+        '''
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(str(path), None)
+
+
+METADATA_CACHE = MetadataCache()
+
+
+def read_metadata(path):
+    '''
+    Read metadata through the process wide cache
+    '''
+    return METADATA_CACHE.read(path)
+
+
+def write_metadata(path, metadata):
+    '''
+    Write metadata through the process wide cache
+    '''
+    METADATA_CACHE.write(path, metadata)
+
+
+def update_metadata(path):
+    '''
+    Locked read, modify, write of metadata through the process wide cache
+    '''
+    return METADATA_CACHE.update(path)
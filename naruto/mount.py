@@ -3,13 +3,45 @@
 Code to parse mount information
 """
 import collections
+import errno
+import functools
 import logging
+import os
 import pathlib
-import sh
-import functools
+import re
 
 DEV_LOGGER = logging.getLogger(__name__)
 
+MOUNT_BACKEND_ENV = 'NARUTO_MOUNT_BACKEND'
+CAP_SYS_ADMIN = 21
+
+# From linux/fs.h
+MS_RDONLY = 1
+MS_NOSUID = 2
+MS_NODEV = 4
+MS_NOEXEC = 8
+MS_SYNCHRONOUS = 16
+MS_REMOUNT = 32
+MS_NOATIME = 1024
+MS_NODIRATIME = 2048
+MS_RELATIME = 1 << 21
+
+MOUNT_FLAGS = {
+    'ro': MS_RDONLY,
+    'rw': 0,
+    'remount': MS_REMOUNT,
+    'nosuid': MS_NOSUID,
+    'nodev': MS_NODEV,
+    'noexec': MS_NOEXEC,
+    'sync': MS_SYNCHRONOUS,
+    'noatime': MS_NOATIME,
+    'nodiratime': MS_NODIRATIME,
+    'relatime': MS_RELATIME,
+}
+# Options that replace each other rather than add up
+_READ_WRITE_OPTIONS = frozenset(('ro', 'rw'))
+_ATIME_OPTIONS = frozenset(('noatime', 'relatime'))
+
 
 class NoMountPermissions(Exception):
     '''
@@ -19,6 +51,7 @@ class NoMountPermissions(Exception):
 
 def _wrap_permissions(command):
     ''' Wrap mount calls with error handler for permissions'''
+    import sh
 
     @functools.wraps(command)
     def wrapped(*args, **kwargs):
@@ -30,12 +63,257 @@ def _wrap_permissions(command):
             raise
     return wrapped
 
-sudo = sh.sudo.bake(non_interactive=True)
-mount = _wrap_permissions(sudo.mount)
-umount = _wrap_permissions(sudo.umount)
+
+def split_mount_options(options):
+    '''
+    Split mount(8) style options into mount(2) flags and filesystem data
+
+    >>> flags, data = split_mount_options('remount,mod:/some/path=ro,ro')
+    >>> flags == MS_REMOUNT | MS_RDONLY
+    True
+    >>> data
+    'mod:/some/path=ro'
+    '''
+    flags = 0
+    data = []
+    for option in (options or '').split(','):
+        if not option:
+            continue
+        if option in MOUNT_FLAGS:
+            flags |= MOUNT_FLAGS[option]
+        else:
+            data.append(option)
+    return flags, ','.join(data)
+
+
+def get_remount_flags(options, mntops):
+    '''
+    Get mount(2) flags to remount, with mount(8) style options, a mount that currently has
+    mntops.
+
+    mount(8) keeps the flags a mount already has but mount(2) clears those it isn't given, so
+    they're carried over unless options set them differently.
+
+    >>> mntops = {'rw': None, 'nosuid': None, 'nodev': None, 'relatime': None, 'si': '1a'}
+    >>> flags = get_remount_flags('remount,mod:/some/path=ro', mntops)
+    >>> flags == MS_REMOUNT | MS_NOSUID | MS_NODEV | MS_RELATIME
+    True
+    >>> flags = get_remount_flags('remount,noatime', mntops)
+    >>> flags == MS_REMOUNT | MS_NOSUID | MS_NODEV | MS_NOATIME
+    True
+    >>> get_remount_flags('remount', {'ro': None}) == MS_REMOUNT | MS_RDONLY
+    True
+    >>> get_remount_flags('remount,rw', {'ro': None, 'noexec': None}) == MS_REMOUNT | MS_NOEXEC
+    True
+    '''
+    flags, _ = split_mount_options(options)
+    given = set((options or '').split(','))
+    for option in mntops:
+        if option not in MOUNT_FLAGS or option == 'remount':
+            continue
+        if option in _READ_WRITE_OPTIONS and not given.isdisjoint(_READ_WRITE_OPTIONS):
+            continue
+        if option in _ATIME_OPTIONS and not given.isdisjoint(_ATIME_OPTIONS):
+            continue
+        flags |= MOUNT_FLAGS[option]
+    return flags
+
+
+def has_cap_sys_admin(status_contents=None):
+    '''
+    Check if this process has CAP_SYS_ADMIN in its effective capabilities
+
+    >>> has_cap_sys_admin('Name:\\tpython\\nCapEff:\\t000001ffffffffff\\n')
+    True
+    >>> has_cap_sys_admin('Name:\\tpython\\nCapEff:\\t0000000000000000\\n')
+    False
+    '''
+    if status_contents is None:
+        with open('/proc/self/status') as status_file:
+            status_contents = status_file.read()
+
+    for line in status_contents.splitlines():
+        key, _, value = line.partition(':')
+        if key == 'CapEff':
+            return bool(int(value.strip(), 16) & (1 << CAP_SYS_ADMIN))
+    return False
+
+
+class MountBackend(object):
+    '''
+    Way of calling mount and umount.
+
+    For remounts mntops, if known, are the mount's current options as in MountEntry.mntops.
+    '''
+    def mount(self, spec, file, types=None, options=None, mntops=None):
+        raise NotImplementedError()
+
+    def umount(self, file):
+        raise NotImplementedError()
+
+
+class SudoMountBackend(MountBackend):
+    '''
+    Run mount(8) and umount(8) through sudo
+    '''
+    def __init__(self):
+        import sh
+        sudo = sh.sudo.bake(non_interactive=True)
+        self._mount = _wrap_permissions(sudo.mount)
+        self._umount = _wrap_permissions(sudo.umount)
+
+    def mount(self, spec, file, types=None, options=None, mntops=None):
+        kwargs = {}
+        if types is not None:
+            kwargs['types'] = types
+        if options is not None:
+            kwargs['options'] = options
+        self._mount(spec, file, **kwargs)
+
+    def umount(self, file):
+        self._umount(file)
+
+
+class SyscallMountBackend(MountBackend):
+    '''
+    Call mount(2) and umount2(2) directly. Needs CAP_SYS_ADMIN.
+    '''
+    def __init__(self):
+        # ctypes is slow to import and only needed to mount
+        import ctypes
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._libc.mount.argtypes = (
+            ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p)
+        self._libc.umount2.argtypes = (ctypes.c_char_p, ctypes.c_int)
+
+    @staticmethod
+    def _check(result, file):
+        if result == 0:
+            return
+        import ctypes
+        error_number = ctypes.get_errno()
+        error = OSError(error_number, os.strerror(error_number), file)
+        if error_number in (errno.EPERM, errno.EACCES):
+            raise NoMountPermissions(error)
+        raise error
+
+    def mount(self, spec, file, types=None, options=None, mntops=None):
+        flags, data = split_mount_options(options)
+        if flags & MS_REMOUNT:
+            if mntops is None:
+                # The shared mount table snapshot may predate the mount, and reading it reads
+                # every aufs mount's branches too
+                mntops = find_mount_by_dest(file, mounts=get_mountinfo_iter()).mntops
+            flags = get_remount_flags(options, mntops)
+        self._check(
+            self._libc.mount(
+                os.fsencode(spec),
+                os.fsencode(file),
+                None if types is None else types.encode(),
+                flags,
+                data.encode() if data else None),
+            file)
+
+    def umount(self, file):
+        self._check(self._libc.umount2(os.fsencode(file), 0), file)
+
+
+class RecordingMountBackend(MountBackend):
+    '''
+    Fake backend that just records what it was asked to do. Useful for tests.
+    '''
+    def __init__(self):
+        self.calls = []
+
+    def mount(self, spec, file, types=None, options=None, mntops=None):
+        self.calls.append(('mount', spec, file, types, options))
+
+    def umount(self, file):
+        self.calls.append(('umount', file))
+
+
+MOUNT_BACKENDS = {
+    'sudo': SudoMountBackend,
+    'syscall': SyscallMountBackend,
+}
+
+_BACKEND = None
+
+
+def get_backend():
+    '''
+    Get mount backend in use.
+
+    Defaults to calling mount(2) directly if we have CAP_SYS_ADMIN, and sudo otherwise. Can be
+    forced by setting NARUTO_MOUNT_BACKEND to one of MOUNT_BACKENDS.
+    '''
+    global _BACKEND
+    if _BACKEND is None:
+        backend_name = os.environ.get(MOUNT_BACKEND_ENV)
+        if not backend_name:
+            backend_name = 'syscall' if has_cap_sys_admin() else 'sudo'
+        DEV_LOGGER.debug('Using %r mount backend', backend_name)
+        _BACKEND = MOUNT_BACKENDS[backend_name]()
+    return _BACKEND
+
+
+def set_backend(backend):
+    '''
+    Replace mount backend. Returns previous backend.
+    '''
+    global _BACKEND
+    previous, _BACKEND = _BACKEND, backend
+    return previous
+
+
+def mount(spec, file, types=None, options=None, mntops=None):
+    '''
+    Mount using current backend. For remounts mntops can give the mount's current options.
+    '''
+    DEV_LOGGER.debug('mount %r %r types=%r options=%r', spec, file, types, options)
+    get_backend().mount(spec, file, types=types, options=options, mntops=mntops)
+
+
+def umount(file):
+    '''
+    Unmount using current backend
+    '''
+    DEV_LOGGER.debug('umount %r', file)
+    get_backend().umount(file)
 
 MountEntry = collections.namedtuple('MountEntry', 'spec file vfstype mntops freq passno')
 
+MOUNTINFO_PATH = '/proc/self/mountinfo'
+_MOUNT_ESCAPE_RE = re.compile(r'\\([0-7]{3})')
+
+
+def _unescape_mount_field(field):
+    '''
+    Undo the octal escaping the kernel uses for spaces etc. in mount fields
+
+    >>> _unescape_mount_field('/mnt/with\\040space')
+    '/mnt/with space'
+    '''
+    return _MOUNT_ESCAPE_RE.sub(lambda match: chr(int(match.group(1), 8)), field)
+
+
+def _parse_mount_options(options):
+    '''
+    Convert comma separated mount options to dict
+
+    >>> sorted(_parse_mount_options('rw,size=10k').items())
+    [('rw', None), ('size', '10k')]
+    '''
+    mntopts_dict = {}
+    for opt in options.split(','):
+        key, sep, value = opt.partition('=')
+        if not sep:
+            mntopts_dict[key] = None
+        else:
+            mntopts_dict[key] = value
+    return mntopts_dict
+
 
 def _parse_mount_line(line):
     '''
@@ -62,18 +340,42 @@ def _parse_mount_line(line):
     cols = line.split(' ')
 
     # Now split opts
-    mntopts = cols[3].split(',')
-    mntopts_dict = {}
-    for opt in mntopts:
-        key, sep, value = opt.partition('=')
-        if not sep:
-            mntopts_dict[key] = None
-        else:
-            mntopts_dict[key] = value
-    cols[3] = mntopts_dict
+    cols[3] = _parse_mount_options(cols[3])
 
     return MountEntry(*cols)
 
+
+def _parse_mountinfo_line(line):
+    '''
+    Convert line from /proc/self/mountinfo to MountEntry
+
+    Per mount and per superblock options are merged into mntops.
+
+    >>> entry = _parse_mountinfo_line(
+    ...     '37 25 0:32 / /mnt/layer rw,relatime shared:20 - aufs none rw,si=9c1cf4fa1e2b4b12')
+    >>> entry.spec
+    'none'
+    >>> entry.file
+    '/mnt/layer'
+    >>> entry.vfstype
+    'aufs'
+    >>> entry.mntops['si']
+    '9c1cf4fa1e2b4b12'
+    '''
+    cols = line.split(' ')
+    separator = cols.index('-', 6)
+
+    mntopts_dict = _parse_mount_options(cols[5])
+    mntopts_dict.update(_parse_mount_options(cols[separator + 3]))
+
+    return MountEntry(
+        spec=_unescape_mount_field(cols[separator + 2]),
+        file=_unescape_mount_field(cols[4]),
+        vfstype=cols[separator + 1],
+        mntops=mntopts_dict,
+        freq='0',
+        passno='0')
+
 MOCK_PROC_MOUNTS = '''
     rootfs / rootfs rw 0 0
     sysfs /sys sysfs rw,nosuid,nodev,noexec,relatime 0 0
@@ -112,10 +414,37 @@ def get_mounts_iter(mount_file_contents=None):
         _parse_mount_line(line.strip()) for line in _mount_file_contents.splitlines() if line)
 
 
-def find_mount_by_dest(dest, mount_file_contents=None):
+MOCK_MOUNTINFO = '''
+    22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw,errors=remount-ro
+    23 22 0:21 / /proc rw,nosuid,nodev,noexec,relatime shared:2 - proc proc rw
+    37 22 0:32 / /mnt/my\\040layer rw,relatime shared:20 - aufs none rw,si=9c1cf4fa1e2b4b12'''
+
+
+def get_mountinfo_iter(mountinfo_contents=None):
+    '''
+    Parse /proc/self/mountinfo and return iterator of mounts
+
+    >>> entries = list(get_mountinfo_iter(MOCK_MOUNTINFO))
+    >>> [entry.file for entry in entries]
+    ['/', '/proc', '/mnt/my layer']
+    >>> entries[2].vfstype
+    'aufs'
+    '''
+    if mountinfo_contents is None:
+        with open(MOUNTINFO_PATH) as mountinfo_file:
+            mountinfo_contents = mountinfo_file.read()
+
+    return (
+        _parse_mountinfo_line(line.strip()) for line in mountinfo_contents.splitlines()
+        if line.strip())
+
+
+def find_mount_by_dest(dest, mount_file_contents=None, mounts=None):
     '''
     Find a mounted path by destination.
 
+    If mounts is given it is used instead of parsing mount_file_contents.
+
     >>> find_mount_by_dest('/geoff', MOCK_PROC_MOUNTS).file
     '/'
     >>> find_mount_by_dest('/proc', MOCK_PROC_MOUNTS).file
@@ -143,7 +472,10 @@ def find_mount_by_dest(dest, mount_file_contents=None):
 
     matches = []
 
-    for mount in get_mounts_iter(mount_file_contents=mount_file_contents):
+    if mounts is None:
+        mounts = get_mounts_iter(mount_file_contents=mount_file_contents)
+
+    for mount in mounts:
         mount_file = pathlib.Path(mount.file)
         try:
             relative_path = dest.relative_to(mount_file)
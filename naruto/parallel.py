@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Run operations on many aufs mounts at once
+"""
+import collections
+import concurrent.futures
+import logging
+
+DEV_LOGGER = logging.getLogger(__name__)
+DEFAULT_PARALLELISM = 8
+
+
+class MountOperationError(Exception):
+    '''
+    Operation failed on at least one mount
+    '''
+    def __init__(self, result):
+        super().__init__('Failed on {} of {} mounts: {}'.format(
+            len(result.failed),
+            len(result.failed) + len(result.succeeded),
+            ', '.join(
+                '{!s} ({})'.format(mount_point, error)
+                for mount_point, error in sorted(result.failed.items()))))
+        self.result = result
+
+
+class MountOperationResult(object):
+    '''
+    Which mounts an operation succeeded and failed on
+    '''
+    def __init__(self):
+        self.succeeded = []
+        self.failed = {}
+
+    def __repr__(self):
+        return '{self.__class__.__name__}(succeeded={self.succeeded!r}, failed={self.failed!r})'.format(
+            self=self)
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    def raise_for_failures(self):
+        '''
+        Raise MountOperationError if anything failed
+        '''
+        if self.failed:
+            raise MountOperationError(self)
+
+
+def run_per_mount(operation, aufs_mount_branches, parallelism=None):
+    '''
+    Call operation on each branch, working on different mount points in parallel.
+
+    Branches on the same mount are always handled one after the other by one thread. Errors are
+    collected per mount point rather than stopping the other mounts.
+    '''
+    if parallelism is None:
+        parallelism = DEFAULT_PARALLELISM
+
+    branches_by_mount_point = collections.OrderedDict()
+    for aufs_mount_branch in aufs_mount_branches:
+        branches_by_mount_point.setdefault(aufs_mount_branch.mount_point, []).append(
+            aufs_mount_branch)
+
+    def run_mount(branches):
+        for aufs_mount_branch in branches:
+            operation(aufs_mount_branch)
+
+    result = MountOperationResult()
+
+    if parallelism <= 1 or len(branches_by_mount_point) <= 1:
+        for mount_point, branches in branches_by_mount_point.items():
+            try:
+                run_mount(branches)
+            except Exception as error:
+                DEV_LOGGER.error('Failed on %s: %s', mount_point, error)
+                result.failed[mount_point] = error
+            else:
+                result.succeeded.append(mount_point)
+        return result
+
+    workers = min(parallelism, len(branches_by_mount_point))
+    DEV_LOGGER.debug(
+        'Running on %d mount points with %d threads', len(branches_by_mount_point), workers)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(run_mount, branches): mount_point
+            for mount_point, branches in branches_by_mount_point.items()}
+
+        for future in concurrent.futures.as_completed(futures):
+            mount_point = futures[future]
+            error = future.exception()
+            if error is not None:
+                DEV_LOGGER.error('Failed on %s: %s', mount_point, error)
+                result.failed[mount_point] = error
+            else:
+                result.succeeded.append(mount_point)
+
+    return result
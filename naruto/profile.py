@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Named sets of aufs mount options.
+
+aufs defaults to udba=reval, which checks branches for outside changes on every lookup, and a
+xino file in /tmp. Profiles trade that for speed where layers aren't changed behind aufs's back.
+Beside the built in profiles more can be defined, and the default picked, in
+<naruto home>/naruto_profiles.json:
+
+    {
+        "default": "build",
+        "profiles": {
+            "build": {"udba": "none", "xino": "/dev/shm/.aufs.xino", "dirperm1": true}
+        }
+    }
+"""
+import json
+import logging
+import pathlib
+
+import naruto.aufs
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+PROFILES_NAME = 'naruto_profiles.json'
+DEFAULT_PROFILE = 'default'
+UDBA_LEVELS = ('none', 'reval', 'notify')
+
+
+class MountProfile(object):
+    '''
+    aufs options for a mount.
+
+    udba, xino and plink are left to aufs if None. Ancestors are mounted with ro_permission.
+    '''
+    def __init__(self, name, udba=None, xino=None, dirperm1=False, plink=None, ro_permission='ro'):
+        if udba is not None and udba not in UDBA_LEVELS:
+            raise ValueError('udba must be one of {}. Got {!r}'.format(UDBA_LEVELS, udba))
+        if ro_permission not in naruto.aufs.RO_PERMISSIONS:
+            raise ValueError('ro_permission must be one of {}. Got {!r}'.format(
+                naruto.aufs.RO_PERMISSIONS, ro_permission))
+        self.name = name
+        self.udba = udba
+        self.xino = xino
+        self.dirperm1 = dirperm1
+        self.plink = plink
+        self.ro_permission = ro_permission
+
+    def __repr__(self):
+        return (
+            '{self.__class__.__name__}({self.name!r}, udba={self.udba!r}, xino={self.xino!r}, '
+            'dirperm1={self.dirperm1!r}, plink={self.plink!r}, '
+            'ro_permission={self.ro_permission!r})'.format(self=self))
+
+    @classmethod
+    def from_dict(cls, name, config):
+        '''
+        Make profile from its entry in the profiles file
+        '''
+        try:
+            return cls(name, **config)
+        except TypeError as error:
+            raise ValueError('Bad mount profile {!r}: {}'.format(name, error))
+
+    @property
+    def options(self):
+        '''
+        mount(8) style options, other than branches, to mount with
+        '''
+        options = []
+        if self.udba is not None:
+            options.append('udba={}'.format(self.udba))
+        if self.xino is not None:
+            options.append('xino={}'.format(self.xino))
+        if self.dirperm1:
+            options.append('dirperm1')
+        if self.plink is not None:
+            options.append('plink' if self.plink else 'noplink')
+        return options
+
+
+BUILTIN_PROFILES = {
+    DEFAULT_PROFILE: MountProfile(DEFAULT_PROFILE),
+    # Ancestors are only changed by naruto, which remounts when it matters
+    'fast': MountProfile(
+        'fast',
+        udba='none',
+        xino='/dev/shm/.aufs.xino',
+        dirperm1=True,
+        plink=False,
+        ro_permission='rr'),
+}
+
+
+def _read_profiles_file(naruto_home):
+    path = pathlib.Path(naruto_home) / PROFILES_NAME
+    try:
+        with path.open() as profiles_file:
+            return json.load(profiles_file)
+    except FileNotFoundError:
+        return {}
+
+
+def load_profiles(naruto_home=None):
+    '''
+    Get (dict of name -> MountProfile, name of default profile) from built in profiles and
+    those in naruto_home
+    '''
+    profiles = dict(BUILTIN_PROFILES)
+    config = {} if naruto_home is None else _read_profiles_file(naruto_home)
+    for name, profile_config in config.get('profiles', {}).items():
+        profiles[name] = MountProfile.from_dict(name, profile_config)
+    return profiles, config.get('default', DEFAULT_PROFILE)
+
+
+def get_profile(name=None, naruto_home=None):
+    '''
+    Get profile by name, or the configured default if name is None
+    '''
+    profiles, default = load_profiles(naruto_home)
+    if name is None:
+        name = default
+    try:
+        return profiles[name]
+    except KeyError:
+        raise ValueError('Unknown mount profile {!r}. Choose from {}'.format(
+            name, ', '.join(sorted(profiles))))
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Writable branches kept outside the layer tree, on tmpfs or another fast scratch directory.
+
+An ephemeral layer is an ordinary layer except that, as the leaf of a mount, its writes go to
+<scratch dir>/<layer id>/contents rather than its own contents directory. The layer's metadata
+records where and a layer symlink in the scratch directory points back to the layer, so a mount
+can be traced to its layer. Freezing or committing the layer copies the scratch contents into
+the layer, after which it's an ordinary layer again.
+"""
+import logging
+import os
+import pathlib
+import stat
+
+import naruto.layer
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+SCRATCH_ENV = 'NARUTO_SCRATCH_DIR'
+DEFAULT_SCRATCH_DIR = pathlib.Path('/dev/shm') / 'naruto-{}'.format(os.getuid())
+LAYER_LINK = 'layer'
+
+
+def link_layer(scratch_path, layer_dir):
+    '''
+    Point the layer link of scratch_path at layer_dir, replacing any existing link atomically
+    '''
+    link_path = pathlib.Path(scratch_path) / LAYER_LINK
+    temp_link_path = link_path.with_name('.{}.new'.format(LAYER_LINK))
+    if os.path.lexists(str(temp_link_path)):
+        temp_link_path.unlink()
+    temp_link_path.symlink_to(layer_dir)
+    temp_link_path.rename(link_path)
+
+
+def create_scratch(scratch_dir, layer):
+    '''
+    Make a scratch directory in scratch_dir for layer, a NarutoLayer. Returns its path.
+    '''
+    scratch_dir = pathlib.Path(scratch_dir)
+    # Only the owner may see what's written to the sandboxes
+    scratch_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+    scratch_path = scratch_dir / layer.layer_id
+    scratch_path.mkdir()
+    contents_path = scratch_path / naruto.layer.CONTENTS_SUBDIR
+    contents_path.mkdir()
+    os.chmod(str(contents_path), stat.S_IMODE(os.stat(str(layer.contents_path)).st_mode))
+    link_layer(scratch_path, layer.path)
+
+    DEV_LOGGER.debug('Created scratch %s for %r', scratch_path, layer)
+    return scratch_path
+
+
+def find_layer_dir(branch_dir):
+    '''
+    Get layer directory for the directory holding a mounted branch, following the layer link
+    of scratch directories
+    '''
+    branch_dir = pathlib.Path(branch_dir)
+    link_path = branch_dir / LAYER_LINK
+    if link_path.is_symlink():
+        return link_path.resolve()
+    return branch_dir
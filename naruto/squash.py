@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Merge a stack of aufs branches into a single branch
+"""
+import errno
+import logging
+import os
+import pathlib
+import shutil
+import uuid
+
+from naruto.aufs import OPAQUE_MARKER, WHITEOUT_META_PREFIX, WHITEOUT_PREFIX
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+
+def _remove(path):
+    '''
+    Remove whatever is at path
+    '''
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(str(path))
+    elif os.path.lexists(str(path)):
+        path.unlink()
+
+
+def _copy_owner(source_stat, destination):
+    '''
+    Copy ownership if we're allowed to
+    '''
+    try:
+        os.lchown(str(destination), source_stat.st_uid, source_stat.st_gid)
+    except PermissionError:
+        pass
+
+
+def _touch(path):
+    path.open('w').close()
+
+
+class BranchMerger(object):
+    '''
+    Apply branches one at a time, lowest first, to build up a single merged branch.
+
+    If keep_whiteouts is False the result is assumed to be the bottom of the stack so whiteouts
+    and opaque markers are applied but not kept.
+
+    With link=True files are hard linked rather than copied where possible. This is safe because
+    only read only branches are merged and those never change.
+    '''
+    def __init__(self, destination, keep_whiteouts=False, link=True):
+        self._destination = pathlib.Path(destination)
+        self._keep_whiteouts = keep_whiteouts
+        self._link = link
+
+    def _add_file(self, entry, destination):
+        source_stat = entry.stat(follow_symlinks=False)
+
+        if entry.is_symlink():
+            os.symlink(os.readlink(entry.path), str(destination))
+            _copy_owner(source_stat, destination)
+            return
+
+        if self._link and entry.is_file(follow_symlinks=False):
+            try:
+                os.link(entry.path, str(destination))
+                return
+            except OSError as error:
+                if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                DEV_LOGGER.debug('Unable to link %s. Copying instead: %s', entry.path, error)
+
+        if entry.is_file(follow_symlinks=False):
+            shutil.copy2(entry.path, str(destination), follow_symlinks=False)
+        else:
+            os.mknod(str(destination), source_stat.st_mode, source_stat.st_rdev)
+            shutil.copystat(entry.path, str(destination), follow_symlinks=False)
+        _copy_owner(source_stat, destination)
+
+    def _apply_directory(self, source_dir, destination_dir):
+        '''
+        Apply a single directory of a branch. Returns sub directories to apply.
+        '''
+        with os.scandir(str(source_dir)) as scanner:
+            entries = sorted(scanner, key=lambda entry: entry.name)
+
+        if any(entry.name == OPAQUE_MARKER for entry in entries):
+            for existing in destination_dir.iterdir():
+                _remove(existing)
+            if self._keep_whiteouts:
+                _touch(destination_dir / OPAQUE_MARKER)
+
+        sub_directories = []
+        for entry in entries:
+            if entry.name.startswith(WHITEOUT_META_PREFIX):
+                continue
+
+            if entry.name.startswith(WHITEOUT_PREFIX):
+                _remove(destination_dir / entry.name[len(WHITEOUT_PREFIX):])
+                if self._keep_whiteouts:
+                    _touch(destination_dir / entry.name)
+                continue
+
+            destination = destination_dir / entry.name
+            _remove(destination_dir / (WHITEOUT_PREFIX + entry.name))
+
+            if entry.is_dir(follow_symlinks=False):
+                if not destination.is_dir() or destination.is_symlink():
+                    _remove(destination)
+                    destination.mkdir()
+                _copy_owner(entry.stat(follow_symlinks=False), destination)
+                sub_directories.append((pathlib.Path(entry.path), destination))
+            else:
+                _remove(destination)
+                self._add_file(entry, destination)
+
+        return sub_directories
+
+    def apply(self, branch_path):
+        '''
+        Apply a whole branch on top of what's been merged so far
+        '''
+        branch_path = pathlib.Path(branch_path)
+        DEV_LOGGER.debug('Merging %s into %s', branch_path, self._destination)
+        self._destination.mkdir(exist_ok=True)
+
+        directories = [(branch_path, self._destination)]
+        stack = list(directories)
+        while stack:
+            source_dir, destination_dir = stack.pop()
+            sub_directories = self._apply_directory(source_dir, destination_dir)
+            directories.extend(sub_directories)
+            stack.extend(sub_directories)
+
+        # Directory times change as we add entries so copy them once everything is in place
+        for source_dir, destination_dir in reversed(directories):
+            shutil.copystat(str(source_dir), str(destination_dir))
+
+
+def squash_branches(branch_paths, destination, keep_whiteouts=False, link=True):
+    '''
+    Merge branch_paths, lowest branch first, into destination.
+
+    The merge is done in a temporary directory next to destination and renamed into place so
+    destination is never seen half written. Any existing destination is replaced.
+    '''
+    destination = pathlib.Path(destination)
+    temp_destination = destination.with_name(
+        '.{}.{}'.format(destination.name, uuid.uuid4().hex))
+
+    merger = BranchMerger(temp_destination, keep_whiteouts=keep_whiteouts, link=link)
+    try:
+        for branch_path in branch_paths:
+            merger.apply(branch_path)
+
+        if destination.exists():
+            old_destination = destination.with_name(
+                '.{}.{}'.format(destination.name, uuid.uuid4().hex))
+            destination.rename(old_destination)
+            temp_destination.rename(destination)
+            shutil.rmtree(str(old_destination))
+        else:
+            temp_destination.rename(destination)
+    except BaseException:
+        if temp_destination.exists():
+            shutil.rmtree(str(temp_destination))
+        raise
+
+    return destination
@@ -2,11 +2,48 @@
 """
 Simpler tests
 """
+import concurrent.futures
+import io
+import json
 import logging
+import os
+import pathlib
+import socket
+import subprocess
+import sys
+import tarfile
 import tempfile
+import threading
 import unittest
 
+import click.testing
+
+import naruto.aufs
+import naruto.client
+import naruto.delete
+import naruto.metadata
+import naruto.mount
 from naruto import NarutoLayer, LayerNotFound
+from naruto.aufs import MountTableSnapshot, mount_branches, refresh_mount_table
+from naruto.bench import run_benchmarks
+from naruto.catalog import CATALOG_NAME, LayerCatalog, set_catalog
+from naruto.cli import naruto_cli
+from naruto.client import DaemonBusy, connect, run_remote
+from naruto.daemon import NarutoDaemon
+from naruto.dedupe import dedupe_tree
+from naruto.delete import iter_trash
+from naruto.gc import ExpiryPolicy, collect_garbage, count_layers, find_garbage
+from naruto.info import render_json, render_text
+from naruto.layer import LAYOUT_FLAT
+from naruto.layout import migrate_to_flat
+from naruto.metadata import LOCK_SUFFIX, MetadataCache
+from naruto.mount import RecordingMountBackend, SyscallMountBackend, set_backend
+from naruto.parallel import MountOperationError, run_per_mount
+from naruto.profile import PROFILES_NAME, get_profile
+from naruto.scratch import find_layer_dir
+from naruto.transfer import ArchiveError, export_layers, import_layers
+from naruto.traverse import iter_ancestors, iter_postorder, iter_preorder
+from naruto.usage import get_tree_usage
 
 DEV_LOGGER = logging.getLogger(__name__)
 
@@ -114,6 +151,16 @@ class TestNaruto(unittest.TestCase):
             self.inst.find_layer('root^^').description,
             description)
 
+    def test_update(self):
+        '''
+        Test changing several metadata fields at once
+        '''
+        self.inst.update(description='first', tags=('a', 'b'))
+        self.inst.update(add_tags=('c',), remove_tags=('a',))
+        self.assertEqual(self.inst.description, 'first')
+        self.assertEqual(self.inst.tags, frozenset(('b', 'c')))
+        self.assertEqual(self.inst, self.inst.find_layer('c'))
+
     def test_tilde_query(self):
         '''
         Test a query with a tilde
@@ -124,3 +171,1403 @@ class TestNaruto(unittest.TestCase):
         self.assertEqual(
             self.inst.find_layer('root~2'),
             grandchild)
+
+    def test_layer_tree(self):
+        '''
+        Test loading the whole tree into memory
+        '''
+        child = self.inst.create_child()
+        grandchild = child.create_child()
+
+        tree = self.inst.get_tree()
+        self.assertEqual(len(tree), 3)
+
+        node = tree.get_node(grandchild)
+        self.assertEqual(node.parent.get_layer(), child)
+        self.assertEqual(
+            node.get_layer_permissions(),
+            [(grandchild.contents_path, 'rw'),
+             (child.contents_path, 'ro'),
+             (self.inst.contents_path, 'ro')])
+
+    def test_iter_descendants(self):
+        '''
+        Test limiting how far down descendants are found
+        '''
+        child = self.inst.create_child()
+        grandchild = child.create_child()
+
+        self.assertEqual(self.inst.descendants, (child, grandchild))
+        self.assertEqual(tuple(self.inst.iter_descendants(max_depth=1)), (child,))
+        self.assertEqual(tuple(grandchild.iter_ancestors()), (child, self.inst))
+        self.assertEqual(grandchild.get_root(), self.inst)
+
+        node = self.inst.get_tree().get_node(self.inst)
+        self.assertEqual(
+            tuple(descendant.get_layer() for descendant in node.iter_descendants(
+                prune=lambda descendant: descendant.path == child.path)),
+            (child,))
+
+    def test_layer_tree_malformed(self):
+        '''
+        Test malformed layer directories are skipped by the tree
+        '''
+        child = self.inst.create_child()
+        broken_dir = self.inst.path / 'children' / 'broken'
+        broken_dir.mkdir()
+
+        tree = self.inst.get_tree()
+        self.assertEqual(tree.root.children, (tree.get_node(child),))
+        self.assertEqual(tree.malformed, [broken_dir])
+
+
+    def test_index(self):
+        '''
+        Test tag index is kept up to date and can be rebuilt
+        '''
+        child = self.inst.create_child()
+        grandchild = child.create_child()
+        grandchild.tags = ('release',)
+
+        index = self.inst.get_index()
+        self.assertEqual(index.check(), [])
+        self.assertEqual(self.inst.find_layer('release@'), child)
+
+        child.delete()
+        self.assertEqual(index.check(), [])
+        self.assertRaises(KeyError, self.inst.find_layer, 'release')
+
+        index.path.unlink()
+        self.assertNotEqual(index.check(), [])
+        self.assertEqual(self.inst.find_layer('root'), self.inst)
+        self.assertEqual(self.inst.find_layer(self.inst.layer_id), self.inst)
+        self.assertEqual(index.check(), [])
+
+    def test_index_read_only(self):
+        '''
+        Test lookups only write the index when it's missing or stale, and work without it
+        '''
+        child = self.inst.create_child()
+        index = self.inst.get_index()
+        inode = index.path.stat().st_ino
+        self.assertRaises(KeyError, self.inst.find_layer, 'missing')
+        self.assertEqual(index.path.stat().st_ino, inode)
+
+        def unwritable(path):
+            raise PermissionError(13, 'Permission denied', str(path))
+        self.addCleanup(setattr, naruto.metadata, 'lock_file', naruto.metadata.lock_file)
+        naruto.metadata.lock_file = unwritable
+
+        index.path.unlink()
+        self.assertEqual(self.inst.find_layer(child.layer_id), child)
+        self.assertRaises(KeyError, self.inst.find_layer, 'missing')
+        self.assertFalse(index.path.exists())
+
+    def test_mount_backend(self):
+        '''
+        Test mount goes through the configured backend
+        '''
+        backend = RecordingMountBackend()
+        self.addCleanup(set_backend, set_backend(backend))
+
+        mount_path = tempfile.TemporaryDirectory()
+        self.addCleanup(mount_path.cleanup)
+
+        child = self.inst.create_child()
+        child.mount(mount_path.name)
+
+        self.assertEqual(
+            backend.calls,
+            [('mount', 'none', str(pathlib.Path(mount_path.name).resolve()), 'aufs',
+              'br:{}=rw:{}=ro'.format(child.contents_path, self.inst.contents_path))])
+
+    def test_mount_profile(self):
+        '''
+        Test mounting with aufs options from a profile
+        '''
+        backend = RecordingMountBackend()
+        self.addCleanup(set_backend, set_backend(backend))
+        mount_path = tempfile.TemporaryDirectory()
+        self.addCleanup(mount_path.cleanup)
+        home_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(home_dir.cleanup)
+
+        (pathlib.Path(home_dir.name) / PROFILES_NAME).write_text(json.dumps({
+            'default': 'build',
+            'profiles': {'build': {'udba': 'none', 'dirperm1': True, 'ro_permission': 'rr'}},
+        }))
+        profile = get_profile(naruto_home=home_dir.name)
+        self.assertEqual(profile.name, 'build')
+        self.assertEqual(get_profile('fast', naruto_home=home_dir.name).udba, 'none')
+        self.assertRaises(ValueError, get_profile, 'missing', naruto_home=home_dir.name)
+
+        child = self.inst.create_child()
+        child.mount(mount_path.name, profile=profile)
+        self.assertEqual(
+            backend.calls[0][4],
+            'br:{}=rw:{}=rr,udba=none,dirperm1'.format(
+                child.contents_path, self.inst.contents_path))
+
+    def _set_mount_table(self, mount_point, branches):
+        '''
+        Make the mount table show an aufs mount of branches, like path=permission, on mount_point
+        '''
+        self.addCleanup(refresh_mount_table)
+        sys_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(sys_dir.cleanup)
+        si_dir = pathlib.Path(sys_dir.name) / 'si_1a'
+        si_dir.mkdir()
+        for index, branch in enumerate(branches):
+            (si_dir / 'br{}'.format(index)).write_text(branch)
+            (si_dir / 'brid{}'.format(index)).write_text(str(index))
+        naruto.aufs._MOUNT_TABLE = MountTableSnapshot(
+            '37 22 0:32 / {} rw,relatime shared:20 - aufs none rw,si=1a\n'.format(mount_point),
+            aufs_sys_folder=sys_dir.name)
+
+    def test_mount_profile_freeze(self):
+        '''
+        Test freezing keeps to the profile a layer was mounted with
+        '''
+        backend = RecordingMountBackend()
+        self.addCleanup(set_backend, set_backend(backend))
+        mount_path = tempfile.TemporaryDirectory()
+        self.addCleanup(mount_path.cleanup)
+        mount_point = str(pathlib.Path(mount_path.name).resolve())
+
+        # With no read only branches the mount can't show which permission they use
+        self.inst.mount(mount_path.name, profile=get_profile('fast'))
+        self._set_mount_table(mount_point, ['{}=rw'.format(self.inst.contents_path)])
+
+        self.inst.freeze_mounts().raise_for_failures()
+        child, = self.inst.children
+        self.assertEqual(
+            backend.calls[-1][4],
+            'remount,mod:{}=rr,add:0:{}=rw'.format(self.inst.contents_path, child.contents_path))
+        self.assertNotIn('mount_profiles', self.inst.get_metadata())
+        self.assertEqual(
+            child.get_metadata()['mount_profiles'],
+            {mount_point: {'name': 'fast', 'ro_permission': 'rr'}})
+
+    def test_ephemeral(self):
+        '''
+        Test ephemeral layers write to scratch until frozen
+        '''
+        backend = RecordingMountBackend()
+        self.addCleanup(set_backend, set_backend(backend))
+        self.addCleanup(refresh_mount_table)
+        scratch_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(scratch_dir.cleanup)
+        mount_path = tempfile.TemporaryDirectory()
+        self.addCleanup(mount_path.cleanup)
+
+        child = self.inst.create_child(scratch_dir=scratch_dir.name)
+        scratch_path = pathlib.Path(scratch_dir.name) / child.layer_id
+        self.assertEqual(child.branch_path, scratch_path / 'contents')
+        self.assertEqual(find_layer_dir(scratch_path), child.path)
+
+        child.mount(mount_path.name)
+        self.assertEqual(
+            backend.calls[0][4],
+            'br:{}=rw:{}=ro'.format(child.branch_path, self.inst.contents_path))
+        (child.branch_path / 'file').write_text('data')
+        (child.branch_path / '.wh.removed').write_text('')
+
+        # As if mounted on /mnt/a
+        sys_dir = pathlib.Path(scratch_dir.name) / 'sys'
+        (sys_dir / 'si_1a').mkdir(parents=True)
+        for index, branch in enumerate(
+                ('{}=rw'.format(child.branch_path), '{}=ro'.format(self.inst.contents_path))):
+            (sys_dir / 'si_1a' / 'br{}'.format(index)).write_text(branch)
+            (sys_dir / 'si_1a' / 'brid{}'.format(index)).write_text(str(index))
+        naruto.aufs._MOUNT_TABLE = MountTableSnapshot(
+            '37 22 0:32 / /mnt/a rw,relatime shared:20 - aufs none rw,si=1a\n',
+            aufs_sys_folder=str(sys_dir))
+
+        child.freeze_mounts().raise_for_failures()
+        grandchild, = child.children
+        self.assertEqual(
+            backend.calls[-1][4],
+            'remount,mod:{}=ro,add:0:{}=rw'.format(
+                scratch_path / 'contents', grandchild.branch_path))
+        self.assertEqual(grandchild.scratch_path.parent, scratch_path.parent)
+
+        self.assertIsNone(child.scratch_path)
+        self.assertFalse(scratch_path.exists())
+        self.assertEqual((child.contents_path / 'file').read_text(), 'data')
+        self.assertTrue((child.contents_path / '.wh.removed').exists())
+
+        child.delete()
+        self.assertEqual(sorted(path.name for path in scratch_path.parent.iterdir()), ['sys'])
+
+    def test_ephemeral_scratch_gone(self):
+        '''
+        Test ephemeral layers whose scratch has gone, as after a reboot, can be used and deleted
+        '''
+        scratch_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(scratch_dir.cleanup)
+        child = self.inst.create_child(scratch_dir=scratch_dir.name)
+        other = self.inst.create_child(scratch_dir=scratch_dir.name)
+        for layer in (child, other):
+            naruto.delete.reclaim(layer.scratch_path)
+
+        with self.assertLogs('naruto.layer', logging.WARNING):
+            grandchild = child.create_child()
+        self.assertIsNone(child.scratch_path)
+        self.assertEqual(grandchild.parent, child)
+        self.assertEqual(list(child.contents_path.iterdir()), [])
+
+        other.delete()
+        self.assertEqual(tuple(self.inst.children), (child,))
+        self.assertEqual(tuple(iter_trash(self.inst.path)), ())
+
+    def test_mount_incremental(self):
+        '''
+        Test branches that don't fit in one mount call are appended by remounts
+        '''
+        backend = RecordingMountBackend()
+        self.addCleanup(set_backend, set_backend(backend))
+
+        branches = ['/layer/{:03d}/contents=ro'.format(index) for index in range(100)]
+        mount_branches('/mnt', branches, limit=256)
+
+        options = [call[4] for call in backend.calls]
+        self.assertTrue(options[0].startswith('br:/layer/000/contents=ro:'))
+        self.assertTrue(all(option.startswith('remount,append:') for option in options[1:]))
+        self.assertTrue(all(len(option) <= len('remount,') + 256 for option in options))
+        self.assertEqual(
+            [branch for option in options
+             for branch in option.split(':', 1)[1].replace(',append:', ':').split(':')],
+            branches)
+        # 11 branches fit in the mount and 8 in each remount
+        self.assertEqual(len(options), 13)
+
+        # A failed remount doesn't leave a partial mount
+        class FailingBackend(RecordingMountBackend):
+            def mount(self, spec, file, types=None, options=None, mntops=None):
+                super().mount(spec, file, types=types, options=options, mntops=mntops)
+                if options.startswith('remount'):
+                    raise OSError('Failed')
+
+        backend = FailingBackend()
+        set_backend(backend)
+        self.assertRaises(OSError, mount_branches, '/mnt', branches, limit=256)
+        self.assertEqual(backend.calls[-1], ('umount', '/mnt'))
+
+    def test_squash(self):
+        '''
+        Test squashing ancestors applies whiteouts
+        '''
+        (self.inst.contents_path / 'a.txt').write_text('root')
+        (self.inst.contents_path / 'gone.txt').write_text('root')
+        (self.inst.contents_path / 'dir').mkdir()
+        (self.inst.contents_path / 'dir' / 'b.txt').write_text('root')
+
+        child = self.inst.create_child()
+        (child.contents_path / 'a.txt').write_text('child')
+        (child.contents_path / '.wh.gone.txt').write_text('')
+        (child.contents_path / 'dir').mkdir()
+        (child.contents_path / 'dir' / '.wh..wh..opq').write_text('')
+        (child.contents_path / 'dir' / 'c.txt').write_text('child')
+
+        grandchild = child.create_child()
+        child.squash()
+
+        squashed_path = child.path / 'squashed'
+        self.assertEqual(
+            sorted(str(path.relative_to(squashed_path)) for path in squashed_path.rglob('*')),
+            ['a.txt', 'dir', 'dir/c.txt'])
+        self.assertEqual((squashed_path / 'a.txt').read_text(), 'child')
+        self.assertEqual(
+            grandchild.get_layer_permissions(),
+            [(grandchild.contents_path, 'rw'), (squashed_path, 'ro')])
+
+    def test_squash_partial(self):
+        '''
+        Test squashing only part of the chain keeps whiteouts
+        '''
+        (self.inst.contents_path / 'gone.txt').write_text('root')
+        child = self.inst.create_child()
+        grandchild = child.create_child()
+        (grandchild.contents_path / '.wh.gone.txt').write_text('')
+        great_grandchild = grandchild.create_child()
+
+        grandchild.squash(depth=2)
+
+        squashed_path = grandchild.path / 'squashed'
+        self.assertTrue((squashed_path / '.wh.gone.txt').exists())
+        self.assertEqual(
+            great_grandchild.get_layer_permissions(),
+            [(great_grandchild.contents_path, 'rw'),
+             (squashed_path, 'ro'),
+             (self.inst.contents_path, 'ro')])
+        self.assertEqual(
+            great_grandchild.get_layer_permissions(),
+            great_grandchild.get_layer_permissions(self.inst.get_tree()))
+        self.assertRaises(ValueError, great_grandchild.squash)
+
+    def test_info_render(self):
+        '''
+        Test rendering tree as text and JSON
+        '''
+        child = self.inst.create_child()
+        child.create_child()
+        child.create_child()
+        tree = self.inst.get_tree()
+
+        text_stream = io.StringIO()
+        render_text(text_stream, tree, highlight=(tree.get_node(child),), max_depth=1)
+        lines = text_stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('children=1, descendants=3', lines[0])
+        self.assertTrue(lines[1].startswith('  +-- !!!!NarutoLayer(id={}'.format(child.layer_id)))
+
+        json_stream = io.StringIO()
+        render_json(json_stream, tree)
+        output = json.loads(json_stream.getvalue())
+        self.assertEqual(output['descendant_count'], 3)
+        self.assertEqual(len(output['children'][0]['children']), 2)
+
+    def test_delete(self):
+        '''
+        Test deleting layers via the trash
+        '''
+        child = self.inst.create_child()
+        child.tags = ('doomed',)
+        grandchild = child.create_child()
+        for index in range(20):
+            sub_dir = grandchild.contents_path / str(index)
+            sub_dir.mkdir()
+            (sub_dir / 'file').write_text('content')
+            (sub_dir / 'link').symlink_to('file')
+
+        progress = child.delete(parallelism=4)
+        self.assertFalse(child.path.exists())
+        # Plus metadata files
+        self.assertGreater(progress.files, 40)
+        # Plus layer, children and contents directories for two layers
+        self.assertEqual(progress.directories, 20 + 6)
+        self.assertEqual(tuple(iter_trash(self.inst.path)), ())
+        self.assertRaises(KeyError, self.inst.find_layer, 'doomed')
+        self.assertEqual(tuple(self.inst), ())
+
+        root_dir = self.inst.path
+        self.inst.delete(parallelism=1)
+        self.assertEqual(tuple(root_dir.parent.iterdir()), ())
+        self.inst = NarutoLayer.create(self.root_naruto_dir.name)
+
+    def test_diff(self):
+        '''
+        Test diffing layers including whiteouts and opaque directories
+        '''
+        root_contents = self.inst.contents_path
+        (root_contents / 'a').write_text('old')
+        (root_contents / 'keep').write_text('')
+        (root_contents / 'same').write_text('aaaa')
+        (root_contents / 'd').mkdir()
+        (root_contents / 'd' / 'x').write_text('')
+        (root_contents / 'e').mkdir()
+        (root_contents / 'e' / 'old').write_text('')
+
+        child = self.inst.create_child()
+        child_contents = child.contents_path
+        (child_contents / 'a').write_text('newer')
+        (child_contents / '.wh.keep').write_text('')
+        (child_contents / 'same').write_text('bbbb')
+        os.utime(
+            str(child_contents / 'same'), ns=(0, (root_contents / 'same').stat().st_mtime_ns))
+        (child_contents / 'd').mkdir()
+        (child_contents / 'd' / 'z').write_text('')
+        (child_contents / 'e').mkdir()
+        (child_contents / 'e' / '.wh..wh..opq').write_text('')
+        (child_contents / 'e' / 'new').write_text('')
+
+        grandchild = child.create_child()
+        (grandchild.contents_path / 'b').write_text('')
+
+        as_tuples = lambda entries: [(entry.change, entry.path) for entry in entries]
+        child_changes = [
+            ('M', 'a'), ('D', 'keep'), ('A', 'd/z'), ('A', 'e/new'), ('D', 'e/old')]
+        self.assertEqual(as_tuples(child.diff()), child_changes)
+        self.assertEqual(as_tuples(grandchild.diff()), [('A', 'b')])
+        self.assertEqual(
+            as_tuples(grandchild.diff(self.inst)), [('M', 'a'), ('A', 'b')] + child_changes[1:])
+        self.assertEqual(
+            as_tuples(self.inst.diff(child)),
+            [('M', 'a'), ('A', 'keep'), ('D', 'd/z'), ('D', 'e/new'), ('A', 'e/old')])
+        self.assertIn(('M', 'same'), as_tuples(child.diff(hash_contents=True)))
+
+    def test_export_import(self):
+        '''
+        Test exporting layers and importing them somewhere else
+        '''
+        child = self.inst.create_child()
+        (child.contents_path / 'dir').mkdir()
+        (child.contents_path / 'dir' / 'file').write_text('content')
+        (child.contents_path / '.wh.gone').write_text('')
+        grandchild = child.create_child()
+        grandchild.tags = ('exported',)
+
+        target_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(target_dir.cleanup)
+
+        partial = io.BytesIO()
+        export_layers(grandchild, partial)
+        partial.seek(0)
+        self.assertRaises(ArchiveError, import_layers, partial, target_dir.name)
+
+        archive = io.BytesIO()
+        export_layers(grandchild, archive, chain=True, compression='gzip')
+        archive.seek(0)
+        imported, skipped = import_layers(archive, target_dir.name)
+        self.assertEqual(len(imported), 3)
+        self.assertEqual(skipped, [])
+
+        imported_root = NarutoLayer(pathlib.Path(target_dir.name) / self.inst.layer_id)
+        imported_grandchild = imported_root.find_layer('exported')
+        self.assertEqual(imported_grandchild.layer_id, grandchild.layer_id)
+        imported_contents = imported_grandchild.parent.contents_path
+        self.assertEqual((imported_contents / 'dir' / 'file').read_text(), 'content')
+        self.assertTrue((imported_contents / '.wh.gone').exists())
+
+        archive.seek(0)
+        imported, skipped = import_layers(archive, target_dir.name)
+        self.assertEqual((len(imported), len(skipped)), (0, 3))
+
+    def test_export_ephemeral(self):
+        '''
+        Test ephemeral layers are exported with what's in scratch, as ordinary layers
+        '''
+        scratch_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(scratch_dir.cleanup)
+        child = self.inst.create_child(scratch_dir=scratch_dir.name)
+        (child.branch_path / 'dir').mkdir()
+        (child.branch_path / 'dir' / 'file').write_text('data')
+        with child._get_metadata_context() as metadata:
+            metadata['mount_profiles'] = {'/mnt/a': {'name': 'fast', 'ro_permission': 'rr'}}
+
+        archive = io.BytesIO()
+        export_layers(child, archive, chain=True)
+        archive.seek(0)
+        target_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(target_dir.cleanup)
+        imported, _ = import_layers(archive, target_dir.name)
+
+        imported_child = NarutoLayer(imported[-1])
+        self.assertEqual(imported_child.layer_id, child.layer_id)
+        self.assertIsNone(imported_child.scratch_path)
+        self.assertNotIn('mount_profiles', imported_child.get_metadata())
+        self.assertEqual((imported_child.contents_path / 'dir' / 'file').read_text(), 'data')
+
+    def test_import_symlink_traversal(self):
+        '''
+        Test archives can't write outside the import directory through links
+        '''
+        outside_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(outside_dir.cleanup)
+
+        def make_archive(*members):
+            archive = io.BytesIO()
+            with tarfile.open(fileobj=archive, mode='w') as tar:
+                for name, kind, link_name in (
+                        ('root', tarfile.DIRTYPE, ''),
+                        ('root/contents', tarfile.DIRTYPE, '')) + members:
+                    member = tarfile.TarInfo(name)
+                    member.type = kind
+                    member.linkname = link_name
+                    data = b'owned' if kind == tarfile.REGTYPE else b''
+                    member.size = len(data)
+                    tar.addfile(member, io.BytesIO(data))
+            archive.seek(0)
+            return archive
+
+        archives = {
+            'file through symlink': make_archive(
+                ('root/contents/x', tarfile.SYMTYPE, outside_dir.name),
+                ('root/contents/x/passwd', tarfile.REGTYPE, '')),
+            'directory through symlink': make_archive(
+                ('root/contents/x', tarfile.SYMTYPE, outside_dir.name),
+                ('root/contents/x/dir', tarfile.DIRTYPE, '')),
+            'file over symlink': make_archive(
+                ('root/contents/x', tarfile.SYMTYPE, outside_dir.name + '/passwd'),
+                ('root/contents/x', tarfile.REGTYPE, '')),
+            'hard link through symlink': make_archive(
+                ('root/contents/x', tarfile.SYMTYPE, outside_dir.name),
+                ('root/contents/h', tarfile.LNKTYPE, 'root/contents/x/passwd')),
+            'relative symlink escaping': make_archive(
+                ('root/contents/x', tarfile.SYMTYPE, '../../..' + outside_dir.name)),
+        }
+        for description, archive in archives.items():
+            with self.subTest(description):
+                target_dir = tempfile.TemporaryDirectory()
+                self.addCleanup(target_dir.cleanup)
+                self.assertRaises(ArchiveError, import_layers, archive, target_dir.name)
+                self.assertEqual(list(pathlib.Path(outside_dir.name).iterdir()), [])
+
+        # Absolute symlinks are normal in layers and only followed once mounted
+        (self.inst.contents_path / 'python').symlink_to('/usr/bin/python3')
+        archive = io.BytesIO()
+        export_layers(self.inst, archive)
+        archive.seek(0)
+        target_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(target_dir.cleanup)
+        import_layers(archive, target_dir.name)
+        self.assertEqual(
+            os.readlink(os.path.join(
+                target_dir.name, self.inst.path.name, 'contents', 'python')),
+            '/usr/bin/python3')
+
+    def test_dedupe(self):
+        '''
+        Test identical files in read only layers are linked together
+        '''
+        data = 'x' * 8192
+        children = [self.inst.create_child() for _ in range(2)]
+        leaves = [child.create_child() for child in children]
+        for layer in [self.inst] + children + leaves:
+            (layer.contents_path / 'big').write_text(data)
+        (children[0].contents_path / 'small').write_text('x')
+
+        result = dedupe_tree(self.inst.get_tree(), min_size=4096)
+        self.assertEqual((result.scanned, result.hashed, result.linked), (3, 3, 2))
+        self.assertEqual(result.bytes_saved, 2 * 8192)
+
+        inodes = set(
+            (layer.contents_path / 'big').stat().st_ino for layer in [self.inst] + children)
+        self.assertEqual(len(inodes), 1)
+        self.assertEqual((self.inst.contents_path / 'big').stat().st_nlink, 4)
+        self.assertEqual((leaves[0].contents_path / 'big').stat().st_nlink, 1)
+        self.assertEqual((children[0].contents_path / 'big').read_text(), data)
+
+        result = dedupe_tree(self.inst.get_tree(), min_size=4096)
+        self.assertEqual((result.scanned, result.hashed, result.linked), (3, 0, 0))
+
+        for layer in [self.inst] + children:
+            (layer.contents_path / 'big').unlink()
+        result = dedupe_tree(self.inst.get_tree(), min_size=4096)
+        self.assertEqual(result.objects_removed, 1)
+
+    def test_usage(self):
+        '''
+        Test disk usage is added up and cached for read only layers
+        '''
+        child = self.inst.create_child()
+        leaf = child.create_child()
+        (child.contents_path / 'file').write_text('x' * 10000)
+        (child.contents_path / 'dir').mkdir()
+        (leaf.contents_path / 'dir').mkdir()
+        (leaf.contents_path / 'dir' / 'file').write_text('x')
+
+        tree = self.inst.get_tree()
+        usage = get_tree_usage(tree)
+        child_exclusive, child_total = usage[tree.get_node(child)]
+        leaf_exclusive, leaf_total = usage[tree.get_node(leaf)]
+        root_exclusive, root_total = usage[tree.root]
+        self.assertEqual(child_exclusive.inodes, 3)
+        self.assertEqual(leaf_exclusive.inodes, 3)
+        self.assertEqual(leaf_exclusive, leaf_total)
+        self.assertEqual(child_total.inodes, 6)
+        self.assertEqual(root_total.inodes, 7)
+        self.assertEqual(
+            root_total.bytes, root_exclusive.bytes + child_exclusive.bytes + leaf_exclusive.bytes)
+        self.assertIn('usage', child.get_metadata())
+        self.assertNotIn('usage', leaf.get_metadata())
+
+        # Cached usage is used while no directory in the contents has changed
+        with child._get_metadata_context() as metadata:
+            metadata['usage']['inodes'] = 99
+        tree = self.inst.get_tree()
+        self.assertEqual(get_tree_usage(tree)[tree.get_node(child)][0].inodes, 99)
+
+        # Even changes deep down where the top directory's mtime stays the same are noticed
+        (child.contents_path / 'dir' / 'file').write_text('x')
+        tree = self.inst.get_tree()
+        self.assertEqual(get_tree_usage(tree)[tree.get_node(child)][0].inodes, 4)
+        self.assertEqual(
+            get_tree_usage(tree, refresh=True)[tree.get_node(child)][0].inodes, 4)
+
+        # Usage is still given if it can't be cached
+        def unwritable(path):
+            raise PermissionError(13, 'Permission denied', str(path))
+        self.addCleanup(
+            setattr, naruto.metadata, 'update_metadata', naruto.metadata.update_metadata)
+        naruto.metadata.update_metadata = unwritable
+        self.assertEqual(
+            get_tree_usage(tree, refresh=True)[tree.get_node(child)][0].inodes, 4)
+
+    def test_gc(self):
+        '''
+        Test finding and removing garbage
+        '''
+        children_dir = self.inst.path / 'children'
+        malformed = children_dir / 'malformed'
+        malformed.mkdir()
+        incomplete = children_dir / '.interrupted.creating'
+        incomplete.mkdir()
+        os.utime(str(incomplete), (0, 0))
+
+        empty_leaf = self.inst.create_child()
+        parent = self.inst.create_child()
+        (parent.contents_path / 'file').write_text('')
+        nightlies = []
+        for created in (100, 200, 300):
+            nightly = parent.create_child()
+            (nightly.contents_path / 'file').write_text('')
+            with nightly._get_metadata_context() as metadata:
+                metadata['created'] = created
+            nightly.tags = ('nightly-{}'.format(created), 'nightly')
+            nightlies.append(nightly)
+
+        tree = self.inst.get_tree()
+        self.assertEqual(
+            sorted((item.reason, item.path) for item in find_garbage(tree)),
+            [('incomplete', incomplete), ('malformed', malformed)])
+
+        policies = [ExpiryPolicy('nightly', keep=1)]
+        garbage = list(find_garbage(tree, empty_leaves=True, policies=policies))
+        self.assertEqual(
+            sorted((item.reason, item.path) for item in garbage),
+            sorted([('empty leaf', empty_leaf.path),
+                    ('expired', nightlies[0].path),
+                    ('expired', nightlies[1].path),
+                    ('incomplete', incomplete),
+                    ('malformed', malformed)]))
+
+        # Newest is kept by age too
+        policies = [ExpiryPolicy('nightly', max_age=100)]
+        self.assertEqual(
+            set(node.path for node in policies[0].find_expired(tree, now=350)),
+            set((nightlies[0].path, nightlies[1].path)))
+
+        collect_garbage(tree, garbage)
+        self.assertEqual(
+            sorted(path.name for path in children_dir.iterdir()), [parent.layer_id])
+        self.assertEqual(tuple(parent), (nightlies[2],))
+        self.assertEqual(tuple(iter_trash(self.inst.path)), ())
+        self.assertRaises(KeyError, self.inst.find_layer, 'nightly-100')
+
+    def test_gc_mounted(self):
+        '''
+        Test gc leaves alone directories with mounted branches in them
+        '''
+        self.addCleanup(refresh_mount_table)
+        child = self.inst.create_child()
+        grandchild = child.create_child()
+        # As if child's metadata was lost, leaving grandchild inside a malformed directory
+        (child.path / 'naruto_metadata.json').unlink()
+
+        # As if grandchild was mounted on /mnt/a
+        sys_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(sys_dir.cleanup)
+        si_dir = pathlib.Path(sys_dir.name) / 'si_1a'
+        si_dir.mkdir()
+        (si_dir / 'br0').write_text('{}=rw'.format(grandchild.contents_path))
+        (si_dir / 'brid0').write_text('0')
+        naruto.aufs._MOUNT_TABLE = MountTableSnapshot(
+            '37 22 0:32 / /mnt/a rw,relatime shared:20 - aufs none rw,si=1a\n',
+            aufs_sys_folder=sys_dir.name)
+
+        tree = self.inst.get_tree()
+        self.assertEqual(tree.malformed, [child.path])
+        with self.assertLogs('naruto.gc', logging.WARNING):
+            self.assertEqual(list(find_garbage(tree)), [])
+
+        naruto.aufs._MOUNT_TABLE = MountTableSnapshot('', aufs_sys_folder=sys_dir.name)
+        garbage = list(find_garbage(tree))
+        self.assertEqual(
+            [(item.reason, item.path) for item in garbage], [('malformed', child.path)])
+        self.assertEqual(count_layers(child.path), 1)
+        with self.assertLogs('naruto.gc', logging.WARNING) as logs:
+            collect_garbage(tree, garbage)
+        self.assertIn('with 1 layers', logs.output[0])
+        self.assertFalse(child.path.exists())
+
+    def test_catalog(self):
+        '''
+        Test catalog follows layer changes and can be rebuilt
+        '''
+        catalog = LayerCatalog(pathlib.Path(self.root_naruto_dir.name) / CATALOG_NAME)
+        self.addCleanup(catalog.close)
+        self.addCleanup(set_catalog, set_catalog(catalog))
+        # Root was created before catalog was enabled
+        catalog.record_layer(self.inst)
+
+        child = self.inst.create_child()
+        grandchild = child.create_child()
+        grandchild.tags = ('mytag',)
+        root_id = self.inst.layer_id
+
+        self.assertEqual(catalog.find_by_tag('mytag'), [grandchild.path])
+        self.assertEqual(catalog.find_leaves(root_id=root_id), [grandchild.path])
+        self.assertEqual(grandchild, self.inst.find_layer('mytag'))
+        self.assertEqual(catalog.get_by_path(grandchild.path)['tags'], frozenset(('mytag',)))
+
+        child.delete()
+        self.assertEqual(catalog.find_all(), [self.inst.path])
+
+        # Catalog rebuild expects <home>/<name>/<root>
+        home_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(home_dir.cleanup)
+        tree_dir = pathlib.Path(home_dir.name) / 'tree'
+        tree_dir.mkdir()
+        other_root = NarutoLayer.create(tree_dir)
+        other_child = other_root.create_child()
+        catalog.remove_layer(other_root.layer_id)
+        self.assertEqual(catalog.find_all(root_id=other_root.layer_id), [])
+
+        self.assertEqual(catalog.rebuild(home_dir.name), 2)
+        self.assertEqual(
+            catalog.find_all(root_id=other_root.layer_id), [other_root.path, other_child.path])
+        self.assertEqual(catalog.find_all(root_id=root_id), [])
+
+
+    def test_catalog_out_of_date(self):
+        '''
+        Test changes made without the catalog aren't hidden by it
+        '''
+        catalog = LayerCatalog(pathlib.Path(self.root_naruto_dir.name) / CATALOG_NAME)
+        self.addCleanup(catalog.close)
+        previous = set_catalog(catalog)
+        self.addCleanup(set_catalog, previous)
+        child = self.inst.create_child()
+        grandchild = child.create_child()
+        child.tags = ('mytag',)
+        self.assertEqual(self.inst.find_layer('mytag'), child)
+
+        set_catalog(previous)
+        child.update(description='changed', tags=())
+        grandchild.tags = ('mytag',)
+        set_catalog(catalog)
+
+        self.assertEqual(catalog.find_by_tag('mytag'), [child.path])
+        self.assertEqual(self.inst.find_layer('mytag'), grandchild)
+        self.assertEqual(child.tags, frozenset())
+        self.assertEqual(child.description, 'changed')
+
+    def test_query_mounted(self):
+        '''
+        Test finding mounted layers, ephemeral ones included, in the catalog
+        '''
+        catalog = LayerCatalog(pathlib.Path(self.root_naruto_dir.name) / CATALOG_NAME)
+        self.addCleanup(catalog.close)
+        self.addCleanup(set_catalog, set_catalog(catalog))
+        catalog.record_layer(self.inst)
+        scratch_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(scratch_dir.cleanup)
+
+        ephemeral = self.inst.create_child(scratch_dir=scratch_dir.name)
+        self.inst.create_child()
+        self._set_mount_table(
+            '/mnt/a',
+            ['{}=rw'.format(ephemeral.branch_path), '{}=ro'.format(self.inst.contents_path)])
+
+        result = click.testing.CliRunner().invoke(
+            naruto_cli, ['--naruto-home', self.root_naruto_dir.name, 'query', '--mounted'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(
+            sorted(result.output.splitlines()), sorted((str(self.inst.path), str(ephemeral.path))))
+
+class TestFlatLayout(unittest.TestCase):
+    '''
+    Tests for trees with every layer in the root's layers directory
+    '''
+    def setUp(self):
+        self.root_naruto_dir = tempfile.TemporaryDirectory()
+        self.inst = NarutoLayer.create(self.root_naruto_dir.name, layout=LAYOUT_FLAT)
+        self.layers_dir = self.inst.path / 'layers'
+
+    def tearDown(self):
+        self.root_naruto_dir.cleanup()
+
+    def test_layers(self):
+        '''
+        Test layers live side by side but still form a tree
+        '''
+        child = self.inst.create_child()
+        grandchild = child.create_child()
+        grandchild.tags = ('mytag',)
+
+        self.assertEqual(grandchild.path.parent, self.layers_dir)
+        self.assertFalse((grandchild.path / 'children').exists())
+        self.assertEqual(grandchild.layout, LAYOUT_FLAT)
+        self.assertEqual(grandchild.parent, child)
+        self.assertEqual(child.parent, self.inst)
+        self.assertEqual(grandchild.get_root(), self.inst)
+        self.assertEqual(tuple(self.inst), (child,))
+        self.assertEqual(self.inst.find_layer('mytag@2'), self.inst)
+        self.assertEqual(self.inst.find_layer('~2'), grandchild)
+
+        tree = self.inst.get_tree()
+        self.assertEqual(len(tree), 3)
+        self.assertEqual(tree.get_node(grandchild).parent, tree.get_node(child))
+
+        child.delete()
+        self.assertEqual(list(self.layers_dir.iterdir()), [])
+        self.assertEqual(tuple(iter_trash(self.inst.path)), ())
+        self.assertRaises(KeyError, self.inst.find_layer, 'mytag')
+
+    def test_reparent(self):
+        '''
+        Test moving a layer to another parent
+        '''
+        child_1 = self.inst.create_child()
+        child_2 = self.inst.create_child()
+        (child_1.contents_path / 'file').write_text('')
+        grandchild = child_1.create_child()
+        great_grandchild = grandchild.create_child()
+        grandchild.squash(depth=2)
+        great_grandchild.create_child()
+        great_grandchild.squash(depth=2)
+
+        self.assertRaises(ValueError, child_1.reparent, great_grandchild)
+        self.assertRaises(ValueError, self.inst.reparent, child_2)
+
+        grandchild.reparent(child_2)
+        self.assertEqual(grandchild.parent, child_2)
+        self.assertEqual(tuple(child_1), ())
+        self.assertEqual(
+            self.inst.get_tree().get_node(great_grandchild).parent.layer_id, grandchild.layer_id)
+        # Squash of child_1 is stale, squash of just grandchild and its child isn't
+        self.assertNotIn('squashed', grandchild.get_metadata())
+        self.assertFalse((grandchild.path / 'squashed').exists())
+        self.assertIn('squashed', great_grandchild.get_metadata())
+        self.assertEqual(
+            [path for path, _ in great_grandchild.get_layer_permissions()][-2:],
+            [child_2.contents_path, self.inst.contents_path])
+
+    def test_orphaned(self):
+        '''
+        Test layers whose parent has gone are found by gc
+        '''
+        child = self.inst.create_child()
+        grandchild = child.create_child()
+        # As if deleting child was interrupted
+        child.path.rename(self.inst.path / 'gone')
+
+        tree = self.inst.get_tree()
+        self.assertEqual(tree.orphaned, [grandchild.path])
+        garbage = list(find_garbage(tree))
+        self.assertEqual(
+            [(item.reason, item.path) for item in garbage], [('orphaned', grandchild.path)])
+        collect_garbage(tree, garbage)
+        self.assertEqual(list(self.layers_dir.iterdir()), [])
+
+    def test_export_import(self):
+        '''
+        Test flat chains can be exported and imported
+        '''
+        child = self.inst.create_child()
+        grandchild = child.create_child()
+        (grandchild.contents_path / 'file').write_text('data')
+
+        archive = io.BytesIO()
+        export_layers(grandchild, archive, chain=True)
+        archive.seek(0)
+        import_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(import_dir.cleanup)
+        imported, _ = import_layers(archive, import_dir.name)
+
+        imported_root = NarutoLayer(pathlib.Path(import_dir.name) / self.inst.layer_id)
+        self.assertEqual(imported_root.layout, LAYOUT_FLAT)
+        imported_grandchild = imported_root.find_layer('~2')
+        self.assertEqual(imported_grandchild.layer_id, grandchild.layer_id)
+        self.assertEqual((imported_grandchild.contents_path / 'file').read_text(), 'data')
+
+    def test_migrate(self):
+        '''
+        Test nested trees can be moved to the flat layout
+        '''
+        root = NarutoLayer.create(self.root_naruto_dir.name)
+        child = root.create_child()
+        grandchild = child.create_child()
+        grandchild.tags = ('mytag',)
+
+        self.assertRaises(ValueError, grandchild.reparent, root)
+        self.assertEqual(migrate_to_flat(root), 2)
+        self.assertEqual(migrate_to_flat(root), 0)
+
+        self.assertEqual(root.layout, LAYOUT_FLAT)
+        self.assertFalse((root.path / 'children').exists())
+        migrated = root.find_layer('mytag')
+        self.assertEqual(migrated.path, root.path / 'layers' / grandchild.layer_id)
+        self.assertEqual(migrated.parent.layer_id, child.layer_id)
+        self.assertEqual(
+            [node.layer_id for node in root.get_tree()],
+            [root.layer_id, child.layer_id, grandchild.layer_id])
+
+
+    def test_migrate_interrupted(self):
+        '''
+        Test trees interrupted part way through migrating are complete and can be finished
+        '''
+        root = NarutoLayer.create(self.root_naruto_dir.name)
+        child = root.create_child()
+        grandchild = child.create_child()
+        leaf = grandchild.create_child()
+
+        # Interrupted after leaf was moved but before its children directory was removed
+        rmdir = pathlib.Path.rmdir
+        def interrupted_rmdir(path):
+            raise KeyboardInterrupt()
+        pathlib.Path.rmdir = interrupted_rmdir
+        try:
+            self.assertRaises(KeyboardInterrupt, migrate_to_flat, root)
+        finally:
+            pathlib.Path.rmdir = rmdir
+        moved = root.path / 'layers' / leaf.layer_id
+        self.assertTrue((moved / 'children').is_dir())
+
+        # As if interrupted between the steps in the other order
+        with grandchild._get_metadata_context() as metadata:
+            metadata['parent_id'] = child.layer_id
+        (grandchild.path / 'children').rmdir()
+        self.assertEqual(NarutoLayer(grandchild.path), grandchild)
+
+        tree = root.get_tree()
+        self.assertEqual((tree.malformed, tree.incomplete, tree.orphaned), ([], [], []))
+        self.assertEqual(
+            [node.layer_id for node in tree],
+            [root.layer_id, child.layer_id, grandchild.layer_id, leaf.layer_id])
+        self.assertEqual(list(find_garbage(tree)), [])
+
+        self.assertEqual(migrate_to_flat(root), 2)
+        self.assertEqual(root.layout, LAYOUT_FLAT)
+        self.assertFalse((moved / 'children').exists())
+        self.assertEqual(
+            [node.layer_id for node in root.get_tree()],
+            [root.layer_id, child.layer_id, grandchild.layer_id, leaf.layer_id])
+        self.assertEqual(root.find_layer(leaf.layer_id).parent.layer_id, grandchild.layer_id)
+
+class _Node(object):
+    '''
+    Minimal node for traversal tests
+    '''
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.children = []
+        if parent is not None:
+            parent.children.append(self)
+
+    def __iter__(self):
+        return iter(self.children)
+
+
+class TestTraverse(unittest.TestCase):
+    '''
+    Tests for non recursive traversal
+    '''
+    def setUp(self):
+        #      a
+        #    b   e
+        #   c d
+        self.nodes = {'a': _Node('a')}
+        for name, parent in (('b', 'a'), ('c', 'b'), ('d', 'b'), ('e', 'a')):
+            self.nodes[name] = _Node(name, self.nodes[parent])
+
+    def names(self, walk):
+        return [(node.name, depth) for node, depth in walk]
+
+    def test_preorder(self):
+        '''
+        Test parents come before children
+        '''
+        root = self.nodes['a']
+        self.assertEqual(
+            self.names(iter_preorder(root)),
+            [('a', 0), ('b', 1), ('c', 2), ('d', 2), ('e', 1)])
+        self.assertEqual(
+            self.names(iter_preorder(root, max_depth=1)), [('a', 0), ('b', 1), ('e', 1)])
+        self.assertEqual(
+            self.names(iter_preorder(root, prune=lambda node: node.name == 'b')),
+            [('a', 0), ('b', 1), ('e', 1)])
+        self.assertEqual(self.names(iter_preorder(root, max_depth=0)), [('a', 0)])
+
+    def test_postorder(self):
+        '''
+        Test children come before parents
+        '''
+        root = self.nodes['a']
+        self.assertEqual(
+            self.names(iter_postorder(root)),
+            [('c', 2), ('d', 2), ('b', 1), ('e', 1), ('a', 0)])
+        self.assertEqual(
+            self.names(iter_postorder(root, max_depth=1)), [('b', 1), ('e', 1), ('a', 0)])
+        self.assertEqual(self.names(iter_postorder(root, max_depth=0)), [('a', 0)])
+
+    def test_ancestors(self):
+        '''
+        Test walking up to the root
+        '''
+        node = self.nodes['d']
+        self.assertEqual([ancestor.name for ancestor in iter_ancestors(node)], ['b', 'a'])
+        self.assertEqual(
+            [ancestor.name for ancestor in iter_ancestors(node, max_depth=1)], ['b'])
+
+    def test_deep_chain(self):
+        '''
+        Test chains far deeper than the recursion limit
+        '''
+        depth = sys.getrecursionlimit() * 10
+        root = leaf = _Node(0)
+        for name in range(1, depth + 1):
+            leaf = _Node(name, leaf)
+
+        self.assertEqual(sum(1 for _ in iter_preorder(root)), depth + 1)
+        self.assertEqual(next(iter_postorder(root)), (leaf, depth))
+        self.assertEqual(sum(1 for _ in iter_ancestors(leaf)), depth)
+
+
+class TestMetadataCache(unittest.TestCase):
+    '''
+    Tests for metadata cache
+    '''
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.cache = MetadataCache(max_size=2)
+
+    def _write_file(self, name, metadata):
+        path = pathlib.Path(self.temp_dir.name) / name
+        with path.open('w') as metadata_file:
+            json.dump(metadata, metadata_file)
+        return path
+
+    def test_external_change(self):
+        '''
+        Test changes made outside the cache are noticed
+        '''
+        path = self._write_file('a.json', {'description': 'old'})
+        self.assertEqual(self.cache.read(path), {'description': 'old'})
+
+        self._write_file('a.json', {'description': 'newer'})
+        self.assertEqual(self.cache.read(path), {'description': 'newer'})
+
+    def test_write_through(self):
+        '''
+        Test writes update the cache and the file
+        '''
+        path = self._write_file('a.json', {})
+        self.cache.write(path, {'tags': ['a']})
+        self.assertEqual(self.cache.read(path), {'tags': ['a']})
+        with path.open() as metadata_file:
+            self.assertEqual(json.load(metadata_file), {'tags': ['a']})
+
+    def test_lru(self):
+        '''
+        Test cache doesn't grow past its limit
+        '''
+        for name in ('a.json', 'b.json', 'c.json'):
+            self.cache.read(self._write_file(name, {}))
+        self.assertEqual(len(self.cache), 2)
+
+    def test_concurrent_update(self):
+        '''
+        Test concurrent locked updates don't lose changes
+        '''
+        path = self._write_file('a.json', {'tags': []})
+
+        def add_tag(tag):
+            with self.cache.update(path) as metadata:
+                metadata['tags'].append(tag)
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            tuple(executor.map(add_tag, range(50)))
+
+        with path.open() as metadata_file:
+            self.assertEqual(sorted(json.load(metadata_file)['tags']), list(range(50)))
+        self.assertEqual(
+            sorted(path.parent.iterdir()), [path, path.with_name('a.json' + LOCK_SUFFIX)])
+
+
+class TestMountTableSnapshot(unittest.TestCase):
+    '''
+    Tests for reading mount table with a fake /sys/fs/aufs
+    '''
+    MOUNTINFO = (
+        '22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n'
+        '37 22 0:32 / /mnt/a rw,relatime shared:20 - aufs none rw,si=1a\n'
+        '38 22 0:33 / /mnt/b rw,relatime shared:21 - aufs none rw,si=1b\n')
+
+    def setUp(self):
+        self.sys_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.sys_dir.cleanup)
+        self._add_si('1a', ('/layers/leaf_a=rw', '/layers/root=ro'))
+        self._add_si('1b', ('/layers/leaf_b=rw', '/layers/root=ro'))
+
+    def _add_si(self, si_code, branches):
+        si_dir = pathlib.Path(self.sys_dir.name) / ('si_' + si_code)
+        si_dir.mkdir()
+        for index, branch in enumerate(branches):
+            (si_dir / 'br{}'.format(index)).write_text(branch + '\n')
+            (si_dir / 'brid{}'.format(index)).write_text('{}\n'.format(index + 10))
+
+    def test_find_branches(self):
+        '''
+        Test reverse lookup of branches by path
+        '''
+        snapshot = MountTableSnapshot(self.MOUNTINFO, aufs_sys_folder=self.sys_dir.name)
+
+        self.assertEqual(len(snapshot.mounts), 3)
+        self.assertEqual(len(snapshot.aufs_mounts), 2)
+
+        root_branches = snapshot.find_branches('/layers/root')
+        self.assertEqual(
+            sorted(str(branch.mount_point) for branch in root_branches), ['/mnt/a', '/mnt/b'])
+        self.assertTrue(all(branch.permission == 'ro' for branch in root_branches))
+
+        leaf_branch, = snapshot.find_branches('/layers/leaf_b')
+        self.assertEqual(leaf_branch.mount.get_leaf(), leaf_branch)
+        self.assertEqual(snapshot.find_branches('/layers/unused'), ())
+
+    def test_transaction(self):
+        '''
+        Test queued branch changes are applied in a single remount
+        '''
+        backend = RecordingMountBackend()
+        self.addCleanup(set_backend, set_backend(backend))
+        snapshot = MountTableSnapshot(self.MOUNTINFO, aufs_sys_folder=self.sys_dir.name)
+        leaf_branch, = snapshot.find_branches('/layers/leaf_a')
+
+        with leaf_branch.mount.transaction():
+            leaf_branch.permission = 'ro'
+            leaf_branch.insert_after('/layers/new_leaf', 'rw')
+            self.assertEqual(backend.calls, [])
+
+        self.assertEqual(
+            backend.calls,
+            [('mount', 'none', '/mnt/a', 'aufs',
+              'remount,mod:/layers/leaf_a=ro,add:0:/layers/new_leaf=rw')])
+
+    def test_ro_permission(self):
+        '''
+        Test freezing a branch keeps read only branches of a mount alike
+        '''
+        backend = RecordingMountBackend()
+        self.addCleanup(set_backend, set_backend(backend))
+        self._add_si('1c', ('/layers/leaf_c=rw', '/layers/root=rr'))
+        snapshot = MountTableSnapshot(
+            self.MOUNTINFO + '39 22 0:34 / /mnt/c rw,relatime shared:22 - aufs none rw,si=1c\n',
+            aufs_sys_folder=self.sys_dir.name)
+
+        self.assertEqual(snapshot.get_aufs_mount('/mnt/a').ro_permission, 'ro')
+        leaf_branch, = snapshot.find_branches('/layers/leaf_c')
+        self.assertFalse(leaf_branch.read_only)
+        self.assertEqual(leaf_branch.mount.ro_permission, 'rr')
+
+        leaf_branch.permission = leaf_branch.mount.ro_permission
+        self.assertEqual(
+            backend.calls, [('mount', 'none', '/mnt/c', 'aufs', 'remount,mod:/layers/leaf_c=rr')])
+
+    def _syscall_backend(self):
+        '''
+        Get SyscallMountBackend that records mount(2) calls instead of making them
+        '''
+        calls = []
+
+        class FakeLibc(object):
+            def mount(self, *args):
+                calls.append(args)
+                return 0
+
+        backend = SyscallMountBackend()
+        backend._libc = FakeLibc()
+        self.addCleanup(set_backend, set_backend(backend))
+        return calls
+
+    def test_syscall_remount_flags(self):
+        '''
+        Test remounting through mount(2) keeps the mount's flags
+        '''
+        calls = self._syscall_backend()
+        snapshot = MountTableSnapshot(
+            '37 22 0:32 / /mnt/a rw,nosuid,nodev,relatime shared:20 - aufs none rw,si=1a\n',
+            aufs_sys_folder=self.sys_dir.name)
+
+        leaf_branch, = snapshot.find_branches('/layers/leaf_a')
+        leaf_branch.permission = 'ro'
+        self.assertEqual(
+            calls,
+            [(b'none', b'/mnt/a', b'aufs',
+              naruto.mount.MS_REMOUNT | naruto.mount.MS_NOSUID | naruto.mount.MS_NODEV |
+              naruto.mount.MS_RELATIME,
+              b'mod:/layers/leaf_a=ro')])
+
+    def test_syscall_mount_incremental(self):
+        '''
+        Test appending branches through mount(2) keeps the flags of the new mount, not those of
+        whatever the mount table last showed there
+        '''
+        calls = self._syscall_backend()
+        self.addCleanup(refresh_mount_table)
+        naruto.aufs._MOUNT_TABLE = MountTableSnapshot(
+            '22 1 8:1 / / rw,nosuid,noexec,relatime shared:1 - ext4 /dev/sda1 rw\n',
+            aufs_sys_folder=self.sys_dir.name)
+
+        branches = ['/layer/{:03d}/contents=ro'.format(index) for index in range(100)]
+        mount_branches('/mnt', branches, limit=256)
+        self.assertEqual(len(calls), 13)
+        self.assertEqual(
+            [flags for _, _, _, flags, _ in calls],
+            [0] + [naruto.mount.MS_REMOUNT] * 12)
+
+    def test_run_per_mount(self):
+        '''
+        Test errors are collected per mount point
+        '''
+        snapshot = MountTableSnapshot(self.MOUNTINFO, aufs_sys_folder=self.sys_dir.name)
+
+        def operation(aufs_mount_branch):
+            if str(aufs_mount_branch.mount_point) == '/mnt/b':
+                raise OSError('Mount busy')
+
+        result = run_per_mount(
+            operation, snapshot.find_branches('/layers/root'), parallelism=2)
+
+        self.assertEqual([str(mount_point) for mount_point in result.succeeded], ['/mnt/a'])
+        self.assertEqual([str(mount_point) for mount_point in result.failed], ['/mnt/b'])
+        self.assertRaises(MountOperationError, result.raise_for_failures)
+
+
+class TestDaemon(unittest.TestCase):
+    '''
+    Test running commands through the daemon
+    '''
+    def setUp(self):
+        self.naruto_home = tempfile.TemporaryDirectory()
+        self.addCleanup(self.naruto_home.cleanup)
+        self.socket_path = os.path.join(self.naruto_home.name, 'naruto.sock')
+
+        self.daemon = NarutoDaemon(self.socket_path, naruto_cli)
+        thread = threading.Thread(target=self.daemon.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.daemon.stop)
+        while not os.path.exists(self.socket_path):
+            thread.join(0.01)
+
+    def run_command(self, *args, stdin=b''):
+        stdout = io.BytesIO()
+        stderr = io.BytesIO()
+        with connect(self.socket_path) as sock:
+            exit_code = run_remote(
+                sock,
+                ('--naruto-home', self.naruto_home.name) + args,
+                stdin=io.BytesIO(stdin),
+                stdout=stdout,
+                stderr=stderr)
+        return exit_code, stdout.getvalue().decode(), stderr.getvalue().decode()
+
+    def test_commands(self):
+        '''
+        Test output, exit codes and prompts are passed back to the client
+        '''
+        self.assertEqual(self.run_command('create', 'tree')[0], 0)
+        self.assertEqual(
+            self.run_command('list-home-layers'),
+            (0, os.path.join(self.naruto_home.name, 'tree') + '\n', ''))
+
+        exit_code, _, stderr = self.run_command('info', '--layer', 'missing')
+        self.assertEqual(exit_code, 2)
+        self.assertIn('does not exist', stderr)
+
+        exit_code, stdout, _ = self.run_command('delete', '--layer', 'tree', stdin=b'n\n')
+        self.assertEqual(exit_code, 1)
+        self.assertIn('Continue?', stdout)
+        self.assertEqual(self.run_command('info', '--layer', 'tree')[0], 0)
+
+    def test_other_user(self):
+        '''
+        Test daemons run by other users aren't used
+        '''
+        self.addCleanup(setattr, naruto.client, 'get_peer_uid', naruto.client.get_peer_uid)
+        naruto.client.get_peer_uid = lambda sock: os.geteuid() + 1
+        self.assertIsNone(connect(self.socket_path))
+
+    def test_busy(self):
+        '''
+        Test clients give up on a daemon that doesn't answer without anything being run
+        '''
+        socket_path = os.path.join(self.naruto_home.name, 'stuck.sock')
+        stuck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(stuck.close)
+        stuck.bind(socket_path)
+        stuck.listen(1)
+        self.addCleanup(
+            setattr, naruto.client, 'HANDSHAKE_TIMEOUT', naruto.client.HANDSHAKE_TIMEOUT)
+        naruto.client.HANDSHAKE_TIMEOUT = 0.01
+
+        with connect(socket_path) as sock:
+            self.assertRaises(DaemonBusy, run_remote, sock, ('create', 'tree'))
+        # The request is never sent so the daemon can't run it when it catches up
+        connection, _ = stuck.accept()
+        with connection:
+            self.assertEqual(connection.recv(1), b'')
+
+    def test_no_daemon(self):
+        '''
+        Test connecting without a daemon
+        '''
+        self.assertIsNone(connect(os.path.join(self.naruto_home.name, 'missing.sock')))
+
+
+class TestImports(unittest.TestCase):
+    '''
+    Test modules only some commands need aren't imported by everything else
+    '''
+    SLOW_MODULES = (
+        'ctypes', 'hashlib', 'ipdb', 'sh', 'shutil', 'socket', 'sqlite3', 'subprocess',
+        'tarfile', 'tempfile')
+
+    def get_imported(self, code):
+        result = subprocess.run(
+            [sys.executable, '-c', code + '\nimport sys; print(" ".join(sys.modules))'],
+            cwd=str(pathlib.Path(__file__).parent.parent),
+            env=dict(os.environ, NARUTO_NO_DAEMON='1'),
+            check=True,
+            stdout=subprocess.PIPE,
+            universal_newlines=True)
+        # Modules are on the last line, after any command output
+        return set(result.stdout.splitlines()[-1].split())
+
+    def test_client(self):
+        '''
+        Test client only imports the standard library
+        '''
+        imported = self.get_imported('import naruto.client')
+        self.assertEqual(sorted(name for name in imported if name.startswith('naruto')),
+                         ['naruto', 'naruto.client'])
+        self.assertNotIn('click', imported)
+
+    def test_tags(self):
+        '''
+        Test running a read only command
+        '''
+        naruto_home = tempfile.TemporaryDirectory()
+        self.addCleanup(naruto_home.cleanup)
+        tree_dir = pathlib.Path(naruto_home.name) / 'tree'
+        tree_dir.mkdir()
+        NarutoLayer.create(tree_dir).tags = ('tag',)
+
+        imported = self.get_imported(
+            'from naruto.cli import naruto_cli\n'
+            'naruto_cli([{!r}, {!r}, "tags", "--layer", "tree"], standalone_mode=False)'.format(
+                '--naruto-home', naruto_home.name))
+        self.assertIn('naruto.layer', imported)
+        self.assertEqual(sorted(imported.intersection(self.SLOW_MODULES)), [])
+
+
+class TestBench(unittest.TestCase):
+    '''
+    Tests for benchmarks
+    '''
+    def test_run_benchmarks(self):
+        '''
+        Test benchmarks run against simulated aufs
+        '''
+        results = run_benchmarks(width=2, depth=2, mounts=2, repeat=1)
+
+        self.assertEqual(results['parameters']['layers'], 7)
+        self.assertEqual(
+            sorted(results['results']),
+            ['cli_startup', 'delete', 'find_layer', 'find_mounted_branches', 'freeze_mounts',
+             'info'])
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Export and import layers as tar streams.
+
+Member names are relative to the directory holding the root layer, so an archive unpacks into
+the same tree shape on another host. Each layer's metadata is written after its contents and
+doubles as the marker that a layer was imported completely.
+"""
+import io
+import json
+import logging
+import os
+import pathlib
+
+import naruto.catalog
+import naruto.index
+import naruto.layer
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+BUFFER_SIZE = 1024 * 1024
+COMPRESSIONS = ('none', 'gzip', 'zstd')
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+class ArchiveError(Exception):
+    '''
+    Archive can't be imported
+    '''
+
+
+def _tarfile():
+    # Only export and import need tarfile, so don't slow down every other command
+    import tarfile
+    return tarfile
+
+
+def _extract_kwargs():
+    # Layers hold whole filesystems so keep devices, owners and permissions as they are
+    tarfile = _tarfile()
+    return {'filter': 'fully_trusted'} if hasattr(tarfile, 'fully_trusted_filter') else {}
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError('zstd compression needs the zstandard module installed')
+    return zstandard
+
+
+def _iter_tree(top):
+    '''
+    Iterate over paths below top, directories before their contents, without following
+    symlinks
+    '''
+    stack = [str(top)]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as scanner:
+            entries = sorted(scanner, key=lambda entry: entry.name, reverse=True)
+        for entry in reversed(entries):
+            yield entry.path
+        stack.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+
+
+class _LayerWriter(object):
+    '''
+    Write layers to a tar stream without keeping every member in memory
+    '''
+    def __init__(self, tar, base_dir):
+        self._tar = tar
+        self._base_dir = pathlib.Path(base_dir)
+
+    def _arcname(self, path):
+        return pathlib.Path(path).relative_to(self._base_dir).as_posix()
+
+    def _add_path(self, path, arcname=None):
+        if arcname is None:
+            arcname = self._arcname(path)
+        tarinfo = self._tar.gettarinfo(str(path), arcname=arcname)
+        if tarinfo is None:
+            # Sockets can't be archived
+            DEV_LOGGER.warning('Skipping %s', path)
+            return
+        if tarinfo.isreg():
+            with open(str(path), 'rb', buffering=BUFFER_SIZE) as member_file:
+                self._tar.addfile(tarinfo, member_file)
+        else:
+            self._tar.addfile(tarinfo)
+        # Only needed for random access, which a stream doesn't have
+        self._tar.members = []
+
+    def add_layer(self, node):
+        '''
+        Add layer directory, its contents and finally its metadata. Children aren't included.
+        '''
+        DEV_LOGGER.debug('Exporting %s', node.path)
+        self._add_path(node.path)
+        # Nested layers hold their children, a flat root holds every other layer
+        for subdir in (naruto.layer.CHILDREN_SUBDIR, naruto.layer.LAYERS_SUBDIR):
+            if (node.path / subdir).is_dir():
+                self._add_path(node.path / subdir)
+
+        # Writes to an ephemeral layer are still in scratch, unless that has gone
+        source_path = node.branch_path
+        if not source_path.is_dir():
+            source_path = node.contents_path
+        contents_arcname = pathlib.PurePosixPath(self._arcname(node.contents_path))
+        self._add_path(source_path, arcname=contents_arcname.as_posix())
+        for path in _iter_tree(source_path):
+            relative_path = pathlib.Path(path).relative_to(source_path)
+            self._add_path(path, arcname=(contents_arcname / relative_path).as_posix())
+
+        # Squashed branches aren't exported so can't be referred to, and scratch and mounts
+        # are particular to this host
+        metadata = dict(node.metadata)
+        for key in ('squashed', 'ephemeral', 'mount_profiles'):
+            metadata.pop(key, None)
+        metadata_bytes = json.dumps(metadata).encode('utf-8')
+        metadata_path = node.path / naruto.layer.METADATA_NAME
+        tarinfo = self._tar.gettarinfo(str(metadata_path), arcname=self._arcname(metadata_path))
+        tarinfo.size = len(metadata_bytes)
+        self._tar.addfile(tarinfo, io.BytesIO(metadata_bytes))
+        self._tar.members = []
+
+
+def export_layers(layer, stream, chain=False, compression=None):
+    '''
+    Write layer as a tar to binary stream. With chain=True all its ancestors are written too,
+    root first.
+
+    compression is one of COMPRESSIONS.
+    '''
+    tree = layer.get_tree()
+    node = tree.get_node(layer)
+    nodes = [node]
+    if chain:
+        nodes.extend(node.iter_ancestors())
+
+    zstd_writer = None
+    if compression == 'zstd':
+        zstd_writer = _zstandard().ZstdCompressor().stream_writer(stream, closefd=False)
+        stream = zstd_writer
+    mode = 'w|gz' if compression == 'gzip' else 'w|'
+
+    tarfile = _tarfile()
+    with tarfile.open(
+            fileobj=stream,
+            mode=mode,
+            bufsize=BUFFER_SIZE,
+            format=tarfile.PAX_FORMAT,
+            copybufsize=BUFFER_SIZE) as tar:
+        writer = _LayerWriter(tar, tree.root.path.parent)
+        for export_node in reversed(nodes):
+            writer.add_layer(export_node)
+
+    if zstd_writer is not None:
+        zstd_writer.close()
+    DEV_LOGGER.info('Exported %d layers', len(nodes))
+
+
+def _open_input(stream):
+    '''
+    Wrap stream so compression is detected. gzip is handled by tarfile itself. stream must
+    support peek.
+    '''
+    if stream.peek(len(ZSTD_MAGIC))[:len(ZSTD_MAGIC)] == ZSTD_MAGIC:
+        return _zstandard().ZstdDecompressor().stream_reader(stream, read_size=BUFFER_SIZE)
+    return stream
+
+
+def _layer_parts(parts):
+    '''
+    Get number of leading parts of a member name that make up its layer directory
+    '''
+    if len(parts) > 2 and parts[1] == naruto.layer.LAYERS_SUBDIR:
+        # Flat layout
+        return 3
+    length = 1
+    while (length + 1 < len(parts) and
+           parts[length] == naruto.layer.CHILDREN_SUBDIR):
+        length += 2
+    return length
+
+
+class _LayerReader(object):
+    '''
+    Extract layers from a tar stream, skipping layers that already exist
+    '''
+    def __init__(self, tar, parent_directory):
+        self._tar = tar
+        self._parent_directory = pathlib.Path(parent_directory).resolve()
+        self._skipping = {}
+        self._directories = []
+        self._extract_kwargs = _extract_kwargs()
+        self.imported = []
+        self.skipped = []
+
+    def _check_name(self, member):
+        name = pathlib.PurePosixPath(member.name)
+        if name.is_absolute() or '..' in name.parts or not name.parts:
+            raise ArchiveError('Unsafe member name {!r}'.format(member.name))
+        if member.islnk():
+            link = pathlib.PurePosixPath(member.linkname)
+            if link.is_absolute() or '..' in link.parts:
+                raise ArchiveError('Unsafe hard link {!r}'.format(member.linkname))
+        return name.parts
+
+    def _is_inside(self, path):
+        return os.path.commonpath(
+            [os.path.realpath(str(path)), str(self._parent_directory)]) == \
+            str(self._parent_directory)
+
+    def _check_parent(self, member, path):
+        '''
+        Check the directory path is in was reached without following a symlink
+        '''
+        # realpath follows symlinks already extracted, so differing means going through one
+        if os.path.realpath(str(path.parent)) != str(path.parent):
+            raise ArchiveError('{!r} goes through a symlink'.format(member.name))
+
+    def _check_links(self, member):
+        '''
+        Check member, before extracting, can't be used to write outside the extraction
+        directory
+        '''
+        path = self._parent_directory / member.name
+        self._check_parent(member, path)
+        # Symlinks and hard links replace what's there, anything else is written through it
+        if path.is_symlink() and not (member.issym() or member.islnk()):
+            raise ArchiveError('{!r} goes through a symlink'.format(member.name))
+
+        if member.islnk():
+            target = self._parent_directory / member.linkname
+            self._check_parent(member, target)
+            if not self._is_inside(target):
+                raise ArchiveError('Hard link {!r} points outside {}'.format(
+                    member.name, self._parent_directory))
+        elif member.issym() and not os.path.isabs(member.linkname):
+            # Absolute targets are only followed inside the layer once it's mounted, but
+            # relative ones are followed on this host too
+            if not self._is_inside(path.parent / member.linkname):
+                raise ArchiveError('Symlink {!r} points outside {}'.format(
+                    member.name, self._parent_directory))
+
+    def _skip_layer(self, layer_parts):
+        '''
+        Decide once per layer whether it's already here
+        '''
+        if layer_parts not in self._skipping:
+            layer_dir = self._parent_directory.joinpath(*layer_parts)
+            exists = (layer_dir / naruto.layer.METADATA_NAME).exists()
+            if not exists and len(layer_parts) == 1:
+                other_roots = [
+                    path for path in self._parent_directory.iterdir()
+                    if path.is_dir() and not path.name.startswith('.') and path != layer_dir]
+                if other_roots:
+                    raise ArchiveError('{} already holds a different root layer {}'.format(
+                        self._parent_directory, other_roots[0].name))
+            elif not exists:
+                # For the flat layout this is the root, as the parent id is only known once
+                # the metadata is read. Layers whose parent never arrives are left orphaned.
+                parent_dir = layer_dir.parent.parent
+                parent_known = self._skipping.get(layer_parts[:-2]) is not None
+                if not parent_known and not (parent_dir / naruto.layer.METADATA_NAME).exists():
+                    raise ArchiveError(
+                        'Parent of {} is missing. Export with the full chain.'.format(
+                            '/'.join(layer_parts)))
+            self._skipping[layer_parts] = exists
+            (self.skipped if exists else self.imported).append(layer_dir)
+        return self._skipping[layer_parts]
+
+    def extract(self, member):
+        parts = self._check_name(member)
+        layer_parts = parts[:_layer_parts(parts)]
+        if self._skip_layer(layer_parts):
+            return
+
+        self._check_links(member)
+        if member.isdir():
+            # Attributes are set at the end as extracting contents changes directory times
+            (self._parent_directory / member.name).mkdir(exist_ok=True)
+            self._directories.append(member)
+        else:
+            self._tar.extract(member, str(self._parent_directory), **self._extract_kwargs)
+
+    def finish(self):
+        for member in reversed(self._directories):
+            if (self._parent_directory / member.name).is_symlink():
+                raise ArchiveError('Directory {!r} was replaced by a symlink'.format(member.name))
+            path = str(self._parent_directory / member.name)
+            self._tar.chown(member, path, numeric_owner=False)
+            self._tar.chmod(member, path)
+            self._tar.utime(member, path)
+
+
+def import_layers(stream, parent_directory):
+    '''
+    Read layers written by export_layers from binary stream into parent_directory, the
+    directory that holds the root layer.
+
+    Layers that already exist are skipped. Returns (imported, skipped) lists of layer
+    directories.
+    '''
+    parent_directory = pathlib.Path(parent_directory)
+    buffered = stream if hasattr(stream, 'peek') else io.BufferedReader(stream, BUFFER_SIZE)
+    try:
+        with _tarfile().open(
+                fileobj=_open_input(buffered),
+                mode='r|*',
+                bufsize=BUFFER_SIZE,
+                copybufsize=BUFFER_SIZE) as tar:
+            reader = _LayerReader(tar, parent_directory)
+            for member in tar:
+                reader.extract(member)
+                tar.members = []
+            reader.finish()
+    finally:
+        if buffered is not stream:
+            # Don't close the caller's stream
+            buffered.detach()
+
+    roots = set(layer_dir.relative_to(parent_directory).parts[0]
+                for layer_dir in reader.imported)
+    for root_name in roots:
+        naruto.index.LayerIndex(parent_directory / root_name).rebuild()
+
+    catalog = naruto.catalog.get_catalog()
+    if catalog is not None:
+        for layer_dir in reader.imported:
+            catalog.record_layer(naruto.layer.NarutoLayer(layer_dir))
+
+    DEV_LOGGER.info(
+        'Imported %d layers and skipped %d existing layers',
+        len(reader.imported), len(reader.skipped))
+    return reader.imported, reader.skipped
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Walk layer hierarchies without recursion.
+
+These work on anything that iterates over its children and has a parent attribute, so on both
+NarutoLayer and LayerNode. An explicit stack of child iterators is kept, so chains can be far
+deeper than Python's recursion limit, every node is visited once and children are only listed
+when they're reached. Stop iterating to stop the walk early.
+"""
+import logging
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+
+def iter_preorder(node, max_depth=None, prune=None):
+    '''
+    Iterate over (node, depth) of node and its descendants, parents before their children.
+
+    node has depth 0. Nothing below max_depth is visited. If prune(node) is true the node is
+    still yielded but its descendants aren't visited.
+    '''
+    yield node, 0
+    if max_depth == 0 or (prune is not None and prune(node)):
+        return
+
+    stack = [iter(node)]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+            continue
+
+        depth = len(stack)
+        yield child, depth
+        if (max_depth is None or depth < max_depth) and (prune is None or not prune(child)):
+            stack.append(iter(child))
+
+
+def iter_postorder(node, max_depth=None):
+    '''
+    Iterate over (node, depth) of node and its descendants, children before their parent.
+
+    node has depth 0 and comes last. Nothing below max_depth is visited.
+    '''
+    stack = [(node, iter(node) if max_depth != 0 else iter(()))]
+    while stack:
+        parent, children = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            yield parent, len(stack)
+        elif max_depth is None or len(stack) < max_depth:
+            stack.append((child, iter(child)))
+        else:
+            yield child, len(stack)
+
+
+def iter_ancestors(node, max_depth=None):
+    '''
+    Iterate over parent, grandparent and so on up to the root, at most max_depth of them
+    '''
+    depth = 0
+    node = node.parent
+    while node is not None and (max_depth is None or depth < max_depth):
+        yield node
+        depth += 1
+        node = node.parent
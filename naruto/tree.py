@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+In memory index of a whole naruto layer tree
+"""
+import itertools
+import logging
+import os
+import pathlib
+
+import naruto.layer
+import naruto.metadata
+import naruto.traverse
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+
+class LayerNode(object):
+    '''
+    Lightweight handle on a single layer held in a LayerTree.
+
+    Everything is answered from memory. Use get_layer to get a full NarutoLayer.
+    '''
+    __slots__ = ('_tree', '_path', '_metadata', '_parent', '_children')
+
+    def __init__(self, tree, path, metadata, parent=None):
+        self._tree = tree
+        self._path = path
+        self._metadata = metadata
+        self._parent = parent
+        self._children = []
+
+    def __repr__(self):
+        return (
+            '{self.__class__.__module__}.{self.__class__.__name__}'
+            '({self._path!r})'.format(
+                self=self))
+
+    def __str__(self):
+        return (
+            'NarutoLayer('
+            'id={self.layer_id}, '
+            'description={self.description}, '
+            'tags={tags}, '
+            'children={children}, descendants={descendants})').format(
+                self=self,
+                children=len(self._children),
+                descendants=len(self.descendants),
+                tags=tuple(self.tags))
+
+    def __iter__(self):
+        '''
+        Iterator over children
+        '''
+        return iter(self._children)
+
+    @property
+    def tree(self):
+        return self._tree
+
+    @property
+    def layer_id(self):
+        return self._path.name
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def contents_path(self):
+        return self._path / naruto.layer.CONTENTS_SUBDIR
+
+    @property
+    def scratch_path(self):
+        '''
+        Scratch directory of an ephemeral layer, or None
+        '''
+        scratch_path = self._metadata.get('ephemeral')
+        return None if scratch_path is None else pathlib.Path(scratch_path)
+
+    @property
+    def branch_path(self):
+        '''
+        Directory the layer is mounted from
+        '''
+        scratch_path = self.scratch_path
+        if scratch_path is None:
+            return self.contents_path
+        return scratch_path / naruto.layer.CONTENTS_SUBDIR
+
+    @property
+    def metadata(self):
+        '''
+        Metadata as read during the walk. Treat as read only.
+        '''
+        return self._metadata
+
+    @property
+    def description(self):
+        return self._metadata['description']
+
+    @property
+    def tags(self):
+        return frozenset(self._metadata.get('tags', ()))
+
+    @property
+    def is_root(self):
+        return self._metadata['is_root']
+
+    @property
+    def parent(self):
+        return self._parent
+
+    @property
+    def children(self):
+        return tuple(self._children)
+
+    @property
+    def has_children(self):
+        return bool(self._children)
+
+    # All lead-nodes should be read only
+    read_only = has_children
+
+    def iter_descendants(self, max_depth=None, prune=None):
+        '''
+        Iterate over all descendants in the same order as NarutoLayer.iter_descendants.
+
+        See naruto.traverse.iter_preorder for max_depth and prune.
+        '''
+        walk = naruto.traverse.iter_preorder(self, max_depth=max_depth, prune=prune)
+        next(walk)
+        for node, _ in walk:
+            yield node
+
+    @property
+    def descendants(self):
+        return tuple(self.iter_descendants())
+
+    def iter_ancestors(self, max_depth=None):
+        '''
+        Iterate over parent, grandparent etc. up to the root
+        '''
+        return naruto.traverse.iter_ancestors(self, max_depth=max_depth)
+
+    def get_layer_permissions(self):
+        '''
+        Get layer permissions for self and parents
+        '''
+        branches = []
+        skip = 0
+        for node in itertools.chain((self,), self.iter_ancestors()):
+            if skip:
+                skip -= 1
+                continue
+
+            squashed = node.metadata.get('squashed') if node.read_only else None
+            if squashed:
+                # This covers the next few ancestors as well
+                branches.append((node.path / naruto.layer.SQUASHED_SUBDIR, 'ro'))
+                skip = squashed['layers'] - 1
+            else:
+                branches.append((node.contents_path, 'ro' if node.read_only else 'rw'))
+
+        return branches
+
+    def get_layer(self):
+        '''
+        Get full NarutoLayer for this node
+        '''
+        return naruto.layer.NarutoLayer(self._path)
+
+
+class LayerTree(object):
+    '''
+    All layers below a root layer, loaded with a single walk of the filesystem.
+
+    Layer directories that don't look like a layer are skipped and recorded in malformed.
+    Hidden directories of layers still being created are recorded in incomplete. Layers in
+    the flat layout whose parent is missing are recorded in orphaned.
+
+    Both layouts are read at once so a tree part way through migrating is still complete.
+    '''
+    def __init__(self, root_dir):
+        self._root_dir = pathlib.Path(root_dir).resolve()
+        self._nodes_by_path = {}
+        self.malformed = []
+        self.incomplete = []
+        self.orphaned = []
+        self._root = self._walk()
+
+    @classmethod
+    def from_layer(cls, layer):
+        '''
+        Load tree that the given layer is part of
+        '''
+        return cls(layer.get_root().path)
+
+    def __iter__(self):
+        '''
+        Iterate over all nodes. Root first.
+        '''
+        for node, _ in naruto.traverse.iter_preorder(self._root):
+            yield node
+
+    def __len__(self):
+        return len(self._nodes_by_path)
+
+    @property
+    def root(self):
+        return self._root
+
+    def get_node_by_path(self, layer_dir):
+        '''
+        Get node for a layer directory
+        '''
+        layer_dir = pathlib.Path(layer_dir)
+        try:
+            return self._nodes_by_path[layer_dir]
+        except KeyError:
+            pass
+
+        try:
+            return self._nodes_by_path[layer_dir.resolve()]
+        except KeyError:
+            raise KeyError('{} is not a layer in {!r}'.format(layer_dir, self))
+
+    def get_node(self, layer):
+        '''
+        Get node for a NarutoLayer
+        '''
+        return self.get_node_by_path(layer.path)
+
+    def find_reference(self, reference):
+        '''
+        Find first node in tree that has reference as layer id or tag
+        '''
+        for node in self:
+            if reference == node.layer_id or reference in node.tags:
+                DEV_LOGGER.debug('Found reference %r in %s', reference, node)
+                return node
+        raise KeyError('Unable to find layer {}'.format(reference))
+
+    def __repr__(self):
+        return (
+            '{self.__class__.__module__}.{self.__class__.__name__}'
+            '({self._root_dir!r})'.format(
+                self=self))
+
+    @staticmethod
+    def _scan_layer_dir(layer_dir, flat=False):
+        '''
+        Check layer_dir has the layout of a layer and return its metadata.
+
+        Layers in the flat layout have no children directory, nor do nested layers with a
+        parent_id, which were part way through migrating to it.
+        '''
+        found = {}
+        with os.scandir(str(layer_dir)) as entries:
+            for entry in entries:
+                if entry.name == naruto.layer.METADATA_NAME:
+                    found[entry.name] = entry.is_file()
+                elif entry.name in (naruto.layer.CHILDREN_SUBDIR, naruto.layer.CONTENTS_SUBDIR):
+                    found[entry.name] = entry.is_dir()
+
+        for name in (naruto.layer.CONTENTS_SUBDIR, naruto.layer.METADATA_NAME):
+            if not found.get(name, False):
+                raise ValueError('Expected {} in {}'.format(name, layer_dir))
+
+        metadata = naruto.metadata.read_metadata(layer_dir / naruto.layer.METADATA_NAME)
+        if not (flat or found.get(naruto.layer.CHILDREN_SUBDIR, False) or 'parent_id' in metadata):
+            raise ValueError('Expected {} in {}'.format(naruto.layer.CHILDREN_SUBDIR, layer_dir))
+        return metadata
+
+    def _scan_flat_layers(self):
+        '''
+        Read every layer in the flat layout. Returns dict of parent id -> [(path, metadata)].
+        '''
+        by_parent = {}
+        for layer_dir in naruto.layer.iter_flat_layer_dirs(self._root_dir):
+            if layer_dir.name.startswith('.'):
+                self.incomplete.append(layer_dir)
+                continue
+
+            try:
+                metadata = self._scan_layer_dir(layer_dir, flat=True)
+                parent_id = metadata['parent_id']
+            except (ValueError, OSError, KeyError) as error:
+                DEV_LOGGER.warning('Skipping malformed layer %s: %s', layer_dir, error)
+                self.malformed.append(layer_dir)
+                continue
+            by_parent.setdefault(parent_id, []).append((layer_dir, metadata))
+        return by_parent
+
+    def _scan_nested_children(self, node):
+        '''
+        Read children in the children directory of node. Returns [(path, metadata)].
+        '''
+        children_dir = node.path / naruto.layer.CHILDREN_SUBDIR
+        try:
+            with os.scandir(str(children_dir)) as entries:
+                child_dirs = [
+                    children_dir / entry.name for entry in entries if entry.is_dir()]
+        except FileNotFoundError:
+            # Flat layout, or moved part way through migrating to it
+            return []
+
+        children = []
+        for child_dir in child_dirs:
+            if child_dir.name.startswith('.'):
+                self.incomplete.append(child_dir)
+                continue
+
+            try:
+                children.append((child_dir, self._scan_layer_dir(child_dir)))
+            except (ValueError, OSError) as error:
+                DEV_LOGGER.warning('Skipping malformed layer %s: %s', child_dir, error)
+                self.malformed.append(child_dir)
+        return children
+
+    def _walk(self):
+        '''
+        Walk whole tree and build nodes
+        '''
+        DEV_LOGGER.debug('Walking layer tree in %r', self._root_dir)
+        root_metadata = self._scan_layer_dir(
+            self._root_dir,
+            flat=not (self._root_dir / naruto.layer.CHILDREN_SUBDIR).is_dir())
+        root = LayerNode(self, self._root_dir, root_metadata)
+        self._nodes_by_path[root.path] = root
+        flat_by_parent = self._scan_flat_layers()
+
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            children = self._scan_nested_children(node)
+            children.extend(flat_by_parent.pop(node.layer_id, ()))
+
+            for child_dir, metadata in children:
+                child = LayerNode(self, child_dir, metadata, parent=node)
+                node._children.append(child)
+                self._nodes_by_path[child_dir] = child
+                stack.append(child)
+
+        # Whatever wasn't reached has lost its parent
+        for flat_children in flat_by_parent.values():
+            for layer_dir, _ in flat_children:
+                DEV_LOGGER.warning('Skipping orphaned layer %s', layer_dir)
+                self.orphaned.append(layer_dir)
+
+        return root
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Disk usage of layers.
+
+Usage of a read only layer can't change so it's cached in the layer metadata, keyed by a digest
+of the mtime of every directory in its contents. Checking the key only needs the directories
+listed, not every file stat'd. Writable layers are always scanned.
+"""
+import collections
+import logging
+import os
+
+import naruto.layer
+import naruto.metadata
+import naruto.walk
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+USAGE_KEY = 'usage'
+BLOCK_SIZE = 512
+
+LayerUsage = collections.namedtuple('LayerUsage', ('bytes', 'inodes'))
+LayerUsage.__doc__ = '''
+Bytes allocated on disk and number of inodes. Files hard linked within a layer count once.
+'''
+
+
+def format_size(size):
+    '''
+    Format number of bytes like du -h
+
+    >>> format_size(1000)
+    '1000'
+    >>> format_size(1536)
+    '1.5K'
+    >>> format_size(20 * 1024 ** 3)
+    '20G'
+    '''
+    for unit in ('', 'K', 'M', 'G', 'T'):
+        if size < 1024 or unit == 'T':
+            break
+        size /= 1024
+    if unit and size < 10:
+        return '{:.1f}{}'.format(size, unit).replace('.0', '')
+    return '{:.0f}{}'.format(size, unit)
+
+
+def _scan_directory(directory, totals, linked, mtimes):
+    '''
+    Add up usage of entries in one directory. Returns sub directories.
+    '''
+    sub_directories = []
+    size = 0
+    inodes = 0
+    for entry in naruto.walk.scan_directory(directory):
+        entry_stat = entry.stat(follow_symlinks=False)
+        if entry.is_dir(follow_symlinks=False):
+            sub_directories.append(entry.path)
+            mtimes.append((entry.path, entry_stat.st_mtime_ns))
+        elif entry_stat.st_nlink > 1:
+            linked.append((entry_stat.st_dev, entry_stat.st_ino, entry_stat.st_blocks))
+            continue
+        size += entry_stat.st_blocks * BLOCK_SIZE
+        inodes += 1
+    # list.append is atomic so no lock is needed
+    totals.append((size, inodes))
+    return sub_directories
+
+
+def _digest_mtimes(directory, mtimes):
+    '''
+    Digest list of (path, mtime) of directories in directory. Adding, removing or renaming
+    anything anywhere below directory changes it.
+    '''
+    # hashlib is slow to import and only needed here
+    import hashlib
+    digest = hashlib.sha1()
+    for path, mtime in sorted(mtimes):
+        digest.update('{}\0{}\n'.format(os.path.relpath(path, str(directory)), mtime).encode(
+            'utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+
+def _scan_usage(directory, parallelism=None):
+    '''
+    Get (LayerUsage, cache key) of everything in directory
+    '''
+    totals = []
+    linked = []
+    top_stat = os.lstat(str(directory))
+    mtimes = [(str(directory), top_stat.st_mtime_ns)]
+    naruto.walk.walk_parallel(
+        directory,
+        lambda sub_directory: _scan_directory(sub_directory, totals, linked, mtimes),
+        parallelism=parallelism)
+
+    size = top_stat.st_blocks * BLOCK_SIZE + sum(size for size, _ in totals)
+    inodes = 1 + sum(inodes for _, inodes in totals)
+
+    blocks_by_inode = dict(((device, inode), blocks) for device, inode, blocks in linked)
+    size += sum(blocks_by_inode.values()) * BLOCK_SIZE
+    inodes += len(blocks_by_inode)
+    return LayerUsage(size, inodes), _digest_mtimes(directory, mtimes)
+
+
+def scan_usage(directory, parallelism=None):
+    '''
+    Get LayerUsage of everything in directory, including the directory itself
+    '''
+    usage, _ = _scan_usage(directory, parallelism=parallelism)
+    return usage
+
+
+def _cache_key(node, parallelism=None):
+    '''
+    Get the key usage of node is cached with, as _scan_usage would, without stat'ing files
+    '''
+    mtimes = []
+
+    def visit(directory):
+        mtimes.append((directory, os.lstat(directory).st_mtime_ns))
+        return [
+            entry.path for entry in naruto.walk.scan_directory(directory)
+            if entry.is_dir(follow_symlinks=False)]
+
+    naruto.walk.walk_parallel(node.contents_path, visit, parallelism=parallelism)
+    return _digest_mtimes(node.contents_path, mtimes)
+
+
+def get_layer_usage(node, parallelism=None, refresh=False):
+    '''
+    Get exclusive LayerUsage of a LayerNode's contents. Read only layers are cached in
+    metadata where it can be written.
+    '''
+    if not node.read_only:
+        return scan_usage(node.contents_path, parallelism=parallelism)
+
+    cached = node.metadata.get(USAGE_KEY)
+    if not refresh and cached is not None and \
+            cached.get('key') == _cache_key(node, parallelism=parallelism):
+        return LayerUsage(cached['bytes'], cached['inodes'])
+
+    DEV_LOGGER.debug('Scanning usage of %s', node.path)
+    usage, key = _scan_usage(node.contents_path, parallelism=parallelism)
+    try:
+        with naruto.metadata.update_metadata(
+                node.path / naruto.layer.METADATA_NAME) as metadata:
+            metadata[USAGE_KEY] = {'key': key, 'bytes': usage.bytes, 'inodes': usage.inodes}
+    except OSError as error:
+        # Read only commands work on trees they can't write to
+        DEV_LOGGER.debug('Unable to cache usage of %s: %s', node.path, error)
+    return usage
+
+
+def get_tree_usage(tree, nodes=None, parallelism=None, refresh=False):
+    '''
+    Get dict of node -> (exclusive LayerUsage, LayerUsage of node and all its descendants).
+
+    Only nodes and their descendants are looked at. nodes defaults to the whole tree.
+    '''
+    if nodes is None:
+        nodes = (tree.root,)
+
+    ordered = []
+    for node in nodes:
+        ordered.append(node)
+        ordered.extend(node.iter_descendants())
+
+    usage = {}
+    # Reversed pre-order always visits children before their parent
+    for node in reversed(ordered):
+        if node in usage:
+            continue
+        exclusive = get_layer_usage(node, parallelism=parallelism, refresh=refresh)
+        total_bytes, total_inodes = exclusive
+        for child in node.children:
+            _, child_total = usage[child]
+            total_bytes += child_total.bytes
+            total_inodes += child_total.inodes
+        usage[node] = (exclusive, LayerUsage(total_bytes, total_inodes))
+    return usage
@@ -19,12 +19,19 @@ setup_kwargs = {
     'name': 'naruto_aufs_snapshot',
     'version': '0.1',
     'packages': find_packages(),
-    'install_requires': ('sh', 'click', 'ipdb') + test_requirements,
-    'setup_requires': test_requirements,
+    # sh is only imported when mounting through sudo
+    'install_requires': ('sh', 'click'),
+    'tests_require': test_requirements,
+    'extras_require': {
+        'demo': ('ipdb',),
+        'test': test_requirements,
+        'zstd': ('zstandard',),
+    },
     'entry_points': {
         'console_scripts': [
-            'naruto=naruto.cli:naruto_cli',
+            'naruto=naruto.client:main',
             'naruto-demo=naruto.demo:demo_cli',
+            'naruto-bench=naruto.bench:bench_cli',
         ]
     },
 }